@@ -0,0 +1,71 @@
+#!/usr/bin/python2.6
+# bench_cc128
+#	 Measures the CC128 frame decoder against a generic XML parser.
+#
+#	cc128_frames.txt holds a CC128 session in the exact line format of the
+#	serial port: instantaneous frames of 4 sensors (sensor #0 on 3 phases),
+#	a full history dump (h004-h744, d001-d090, m001-m084 for 10 sensors),
+#	a startup banner and a truncated frame.
+#
+#	usage: bench_cc128.py [-n repeat] [frames file]
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from xml.etree import cElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128
+
+
+def decodeWithElementTree(line):
+	# same walk as cc128.php does with simplexml
+	if line.find('<') < 0:
+		return None
+	try:
+		msg = cElementTree.fromstring(line)
+	except SyntaxError:
+		return None
+	hist = msg.find('hist')
+	if hist is None:
+		watts = []
+		for ch in ('ch1', 'ch2', 'ch3'):
+			node = msg.find(ch)
+			if node is not None:
+				watts.append(int(node.findtext('watts')))
+		return (cc128.INSTANT, msg.findtext('time'), float(msg.findtext('tmpr')), int(msg.findtext('sensor')), tuple(watts))
+	values = []
+	for data in hist.findall('data'):
+		sensor = int(data.findtext('sensor'))
+		for node in data:
+			if node.tag != 'sensor':
+				values.append((sensor, node.tag[0], int(node.tag[1:]), float(node.text)))
+	return (cc128.HISTORY, msg.findtext('time'), int(hist.findtext('dsw')), hist.findtext('units'), values)
+
+def bench(name, decode, lines, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		for line in lines:
+			decode(line)
+		elapsed = time.time() - start
+		if best == None or elapsed < best:
+			best = elapsed
+	print "%-12s %8.2f ms/pass %10.0f frames/s" % (name, best * 1000, len(lines) / best)
+	return best
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-n repeat] [frames file]')
+	op.add_option('-n', '--repeat', type='int', default=20, help='passes over the corpus, the best one is kept (default: 20)')
+	options, args = op.parse_args()
+
+	filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cc128_frames.txt')
+	if args:
+		filename = args[0]
+	lines = open(filename).readlines()
+
+	print "%d lines, %d bytes" % (len(lines), sum(len(line) for line in lines))
+	baseline = bench('elementtree', decodeWithElementTree, lines, options.repeat)
+	decoder = bench('cc128', cc128.DecodeFrame, lines, options.repeat)
+	print "speedup: %.1fx" % (baseline / decoder)
@@ -0,0 +1,65 @@
+#!/usr/bin/python2.6
+# bench_import
+#	Measures the cold start of the upload tools: the time to import
+#	google_meter, and to start sqlite2googlepowermeter.py up to parsing its
+#	arguments (--version), each in a new interpreter.
+#
+#	The interpreter startup alone is measured too (python -c pass) and
+#	subtracted, and the modules each import loads are listed with -v.
+#
+#	usage: bench_import.py [-n repeat] [-v]
+
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CASES = [
+	('python -c pass', ['-c', 'pass']),
+	('import google_meter', ['-c', 'import google_meter']),
+	('import sqlite2googlepowermeter', ['-c', 'import sqlite2googlepowermeter']),
+	('sqlite2googlepowermeter.py --version', [os.path.join(ROOT, 'sqlite2googlepowermeter.py'), '--version']),
+]
+
+def run(args):
+	"""Seconds taken by a new interpreter running args."""
+	null = open(os.devnull, 'w')
+	try:
+		start = time.time()
+		subprocess.call([sys.executable] + args, cwd=ROOT, stdout=null, stderr=null)
+		return time.time() - start
+	finally:
+		null.close()
+
+def loadedModules(statement):
+	"""Modules loaded by statement, beyond those of the interpreter startup."""
+	script = 'import sys; before = set(sys.modules); %s; print(" ".join(sorted(set(sys.modules) - before)))' % statement
+	output = subprocess.Popen([sys.executable, '-c', script], cwd=ROOT, stdout=subprocess.PIPE).communicate()[0]
+	return [name for name in output.split() if sys.modules.get(name, 0) is not None]
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-n repeat] [-v]')
+	op.add_option('-n', '--repeat', type='int', default=30, help='runs of each case (default: 30)')
+	op.add_option('-v', '--verbose', action='store_true', default=False, help='list the modules loaded by each import')
+	options, args = op.parse_args()
+
+	print "%-40s %10s %10s %10s" % ('case', 'median ms', 'min ms', '- startup')
+	startup = None
+	for (name, args) in CASES:
+		times = [run(args) for i in range(options.repeat)]
+		if startup == None:
+			startup = median(times)
+		print "%-40s %10.1f %10.1f %10.1f" % (name, median(times) * 1000, min(times) * 1000, (median(times) - startup) * 1000)
+
+	for module in ('google_meter', 'sqlite2googlepowermeter'):
+		modules = loadedModules('import %s' % module)
+		print "import %s loads %d modules" % (module, len(modules))
+		if options.verbose:
+			print "  " + " ".join(modules)
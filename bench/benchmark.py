@@ -0,0 +1,299 @@
+#!/usr/bin/python2.6
+# benchmark
+#	Measures every stage of the ingest -> sqlite -> upload path on a
+#	synthetic dataset.
+#
+#	The dataset is --days of hourly readings for each of --sensors sensors
+#	(e.g. 1 day to 3650 days, 1 to 100 sensors). Each stage runs in a forked
+#	process and reports its throughput, the latency percentiles of its
+#	operations and its peak RSS. Uploads go to a local meterserver.
+#
+#	The read and analytics stages redo their work per sensor --repeat times,
+#	for enough latency samples.
+#
+#	usage: benchmark.py [--days n] [--sensors n] [--stage name ...]
+#	                    [--save file.json] [--compare file.json]
+
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128db
+import cc128sinks
+import cc128stats
+import google_meter
+import rfc3339
+import units
+
+import meterserver
+
+# events per timed operation of the stages working item by item
+CHUNK = 100
+
+VARIABLE = '/user/12345678901234567890/bench.example.com/variable/sensor%d.d1'
+
+def dataset(days, sensors, seed=0):
+	"""Hourly (sensor, channel, resolution, ts, kwatt) rows, like the ingest path stores."""
+	rand = random.Random(seed)
+	start = 1262304000 # 2010-01-01
+	rows = []
+	for sensor in range(sensors):
+		for hour in range(days * 24):
+			rows.append((sensor, 0, cc128db.HOURLY, start + hour * 3600, round(rand.random() * 2.5, 1)))
+	return rows
+
+def measures(rows):
+	events = []
+	last = {}
+	for (sensor, channel, resolution, ts, kwatt) in rows:
+		if sensor in last:
+			events.append(google_meter.DurMeasurement(VARIABLE % sensor, last[sensor], ts, kwatt * units.KILOWATT_HOUR, 1, 1, 0.001 * units.KILOWATT_HOUR))
+		last[sensor] = ts
+	return events
+
+def measureColumns(rows):
+	# the uploader's measures: google_meter.DurMeasurementColumns built from
+	# the rows of each sensor, without an object per measure
+	series = {}
+	for (sensor, channel, resolution, ts, kwatt) in rows:
+		series.setdefault(sensor, []).append((ts, kwatt))
+	columns = google_meter.DurMeasurementColumns()
+	for sensor in sorted(series):
+		cc128sinks.HourlyMeasurements(VARIABLE % sensor, series[sensor], 1, 0.001, columns)
+	return columns
+
+def chunked(items, size=CHUNK):
+	return [items[i:i + size] for i in range(0, len(items), size)]
+
+def timed(operation, chunks):
+	"""Runs operation on each chunk, returns the list of (items, seconds)."""
+	samples = []
+	for chunk in chunks:
+		start = time.time()
+		operation(chunk)
+		samples.append((len(chunk), time.time() - start))
+	return samples
+
+def repeated(operation, keys, repeats):
+	# times operation(key) repeats times for each key, operation returning
+	# the items it handled : the stages doing one operation per sensor would
+	# otherwise have a single sample with one sensor, and p50 = p90 = p99
+	samples = []
+	for i in range(repeats):
+		for key in keys:
+			start = time.time()
+			count = operation(key)
+			samples.append((count, time.time() - start))
+	return samples
+
+# the stages, each one a function of the options returning (items, seconds) samples
+
+def stageToTimestamp(options):
+	times = [ts for (_, _, _, ts, _) in dataset(options.days, options.sensors)]
+	return timed(lambda chunk: [rfc3339.ToTimestamp(t) for t in chunk], chunked(times))
+
+def stageFromTimestamp(options):
+	stamps = [rfc3339.ToTimestamp(ts) for (_, _, _, ts, _) in dataset(options.days, options.sensors)]
+	return timed(lambda chunk: [rfc3339.FromTimestamp(s) for s in chunk], chunked(stamps))
+
+def stageMeasures(options):
+	rows = dataset(options.days, options.sensors)
+	return timed(measures, chunked(rows))
+
+def stageMeasureColumns(options):
+	rows = dataset(options.days, options.sensors)
+	return timed(measureColumns, chunked(rows))
+
+def stageToXml(options):
+	events = measures(dataset(options.days, options.sensors))
+	return timed(lambda chunk: ''.join(event.ToXml() for event in chunk), chunked(events))
+
+def stageColumnsXml(options):
+	columns = measureColumns(dataset(options.days, options.sensors))
+	return timed(lambda chunk: ''.join(chunk.Entries()), chunked(columns))
+
+def stageParallelXml(options):
+	# the columns the uploader posts, serialized by the workers
+	events = measureColumns(dataset(options.days, options.sensors))
+	serializer = google_meter.ProcessSerializer(options.processes or None)
+	try:
+		entries = serializer.Entries(events)
+		samples = []
+		for chunk in chunked(events):
+			start = time.time()
+			''.join([entries.next() for event in chunk])
+			samples.append((len(chunk), time.time() - start))
+		return samples
+	finally:
+		serializer.Close()
+
+def stageParseEntries(options):
+	events = measures(dataset(options.days, options.sensors))
+	feeds = [(len(chunk), '<feed%s>%s</feed>' % (google_meter.XMLNS_ATTRIBUTES, ''.join(event.ToXml() for event in chunk))) for chunk in chunked(events)]
+	samples = []
+	for (count, feed) in feeds:
+		start = time.time()
+		google_meter.ParseEntries(feed)
+		samples.append((count, time.time() - start))
+	return samples
+
+def stageSqliteWrite(options):
+	rows = dataset(options.days, options.sensors)
+	(fd, filename) = tempfile.mkstemp(suffix='.db')
+	os.close(fd)
+	try:
+		con = cc128db.Connect(filename)
+		# one commit per history frame worth of rows (4 tags x 10 sensors)
+		return timed(lambda chunk: cc128db.StoreReadings(con, chunk), chunked(rows, 40))
+	finally:
+		os.unlink(filename)
+
+def stageSqliteRead(options):
+	(fd, filename) = tempfile.mkstemp(suffix='.db')
+	os.close(fd)
+	try:
+		con = cc128db.Connect(filename)
+		cc128db.StoreReadings(con, dataset(options.days, options.sensors))
+		return repeated(lambda sensor: len(cc128db.ReadSeries(con, sensor)), cc128db.GetSensors(con), options.repeat)
+	finally:
+		os.unlink(filename)
+
+def stageArchiveRead(options):
+	(fd, filename) = tempfile.mkstemp(suffix='.db')
+	os.close(fd)
+	try:
+		con = cc128db.Connect(filename)
+		cc128db.StoreReadings(con, dataset(options.days, options.sensors))
+		cc128db.ArchiveMonths(con, now=time.time() + 400 * 86400 * 10) # every month of the dataset
+		return repeated(lambda sensor: len(cc128db.ReadSeries(con, sensor)), cc128db.GetSensors(con), options.repeat)
+	finally:
+		os.unlink(filename)
+
+def stageAnalytics(options):
+	rows = dataset(options.days, options.sensors)
+	columns = {}
+	for (sensor, channel, resolution, ts, kwatt) in rows:
+		series = columns.setdefault(sensor, ([], []))
+		series[0].append(ts)
+		series[1].append(kwatt)
+	def analyze(sensor):
+		cc128stats.Analyze(columns[sensor], None, cc128stats.MONTH)
+		return len(columns[sensor][0])
+	return repeated(analyze, sorted(columns), options.repeat)
+
+def stageUpload(options):
+	events = measures(dataset(options.days, options.sensors))
+	server = meterserver.MeterServer(latency=options.latency / 1000.0)
+	server.start()
+	service = google_meter.Service('token', server.uri(), log=google_meter.Log(0))
+	samples = timed(service.BatchPostEvents, chunked(events, google_meter.MAX_BATCH_POST_COUNT))
+	server.shutdown()
+	return samples
+
+STAGES = [
+	('rfc3339.ToTimestamp', stageToTimestamp),
+	('rfc3339.FromTimestamp', stageFromTimestamp),
+	('DurMeasurement', stageMeasures),
+	('DurMeasurementColumns', stageMeasureColumns),
+	('DurMeasurement.ToXml', stageToXml),
+	('Columns.Entries', stageColumnsXml),
+	('ProcessSerializer', stageParallelXml),
+	('ParseEntries', stageParseEntries),
+	('sqlite write', stageSqliteWrite),
+	('sqlite read', stageSqliteRead),
+	('archived read', stageArchiveRead),
+	('analytics', stageAnalytics),
+	('BatchPostEvents', stageUpload),
+]
+
+def percentile(values, ratio):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def runStage(function, options):
+	"""Runs a stage in a child process, returns its report dict."""
+	(read_end, write_end) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read_end)
+		try:
+			start = time.time()
+			samples = function(options)
+			elapsed = time.time() - start
+			items = sum(count for (count, seconds) in samples)
+			busy = sum(seconds for (count, seconds) in samples) or 1e-9
+			latencies = [seconds / count for (count, seconds) in samples if count]
+			report = {
+				'items': items,
+				'throughput': items / busy,
+				'p50': percentile(latencies, 0.5),
+				'p90': percentile(latencies, 0.9),
+				'p99': percentile(latencies, 0.99),
+				'elapsed': elapsed,
+				'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			}
+			os.write(write_end, json.dumps(report))
+		finally:
+			os._exit(0)
+	os.close(write_end)
+	data = []
+	while True:
+		chunk = os.read(read_end, 65536)
+		if not chunk:
+			break
+		data.append(chunk)
+	os.close(read_end)
+	os.waitpid(pid, 0)
+	if not data:
+		return None
+	return json.loads(''.join(data))
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [--days n] [--sensors n] [--stage name ...] [--save file.json] [--compare file.json]')
+	op.add_option('', '--days', type='int', default=30, help='days of hourly data per sensor (default: 30)')
+	op.add_option('', '--sensors', type='int', default=1, help='number of sensors (default: 1)')
+	op.add_option('', '--stage', action='append', metavar='<name>', help='only run the stages whose name contains this (repeatable)')
+	op.add_option('', '--repeat', type='int', default=20, help='times the read and analytics stages redo each sensor, one latency sample each (default: 20)')
+	op.add_option('', '--processes', type='int', default=0, help='workers of the ProcessSerializer stage (default: one per CPU)')
+	op.add_option('', '--latency', type='float', default=0, metavar='<ms>', help='latency of the local server (default: 0)')
+	op.add_option('', '--save', metavar='<file.json>', help='save the results as a baseline')
+	op.add_option('', '--compare', metavar='<file.json>', help='compare the results with a saved baseline')
+	op.add_option('', '--tolerance', type='float', default=0.2, help='throughput loss reported as a regression (default: 0.2)')
+	options, args = op.parse_args()
+
+	baseline = {}
+	if options.compare:
+		baseline = json.load(open(options.compare))['stages']
+
+	print "dataset: %d days x %d sensors (%d hourly rows)" % (options.days, options.sensors, options.days * 24 * options.sensors)
+	print "%-22s %10s %12s %10s %10s %10s %10s %s" % ('stage', 'items', 'items/s', 'p50 us', 'p90 us', 'p99 us', 'rss MB', '')
+	results = {}
+	regressions = 0
+	for (name, function) in STAGES:
+		if options.stage and not [s for s in options.stage if s.lower() in name.lower()]:
+			continue
+		report = runStage(function, options)
+		if report == None:
+			print "%-22s failed" % name
+			continue
+		results[name] = report
+		comparison = ''
+		if name in baseline:
+			ratio = report['throughput'] / baseline[name]['throughput']
+			comparison = '%.2fx baseline' % ratio
+			if ratio < 1 - options.tolerance:
+				comparison += ' REGRESSION'
+				regressions += 1
+		print "%-22s %10d %12.0f %10.1f %10.1f %10.1f %10.1f %s" % (name, report['items'], report['throughput'],
+			report['p50'] * 1e6, report['p90'] * 1e6, report['p99'] * 1e6, report['peak_rss_kb'] / 1024.0, comparison)
+
+	if options.save:
+		json.dump({'days': options.days, 'sensors': options.sensors, 'stages': results}, open(options.save, 'w'), indent=1, sort_keys=True)
+	if regressions:
+		sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/python2.6
+# cc128sim
+#	Plays CC128 frames into pseudo-terminals, to load-test acquisition
+#	without a device.
+#
+#	Frames are either replayed from a recorded file (one frame per line,
+#	paced by their <time> tags) or synthesized: every 6 seconds of device
+#	time each sensor sends an instantaneous frame, and a full history dump
+#	is sent every --history-every seconds. --speed plays the device clock
+#	from 1x to 1000x (or 0 for as fast as possible).
+#
+#	usage: cc128sim.py [-n devices] [-s sensors] [--speed x] [-r frames.txt]
+#	then read the printed ptys, e.g. with cc128acquire.py
+
+import os
+import pty
+import random
+import sys
+import time
+import tty
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128
+import cc128db
+
+SOURCE = '<msg><src>CC128-v0.11</src><dsb>00089</dsb>'
+
+def deviceTime(t):
+	t = int(t) % 86400
+	return '%02d:%02d:%02d' % (t // 3600, t // 60 % 60, t % 60)
+
+def synthInstant(t, sensor, channels, rand=random):
+	watts = ''.join(['<ch%d><watts>%05d</watts></ch%d>' % (ch, rand.randint(0, 3500), ch) for ch in range(1, channels + 1)])
+	return '%s<time>%s</time><tmpr>%.1f</tmpr><sensor>%d</sensor><id>%05d</id><type>1</type>%s</msg>\n' % (
+		SOURCE, deviceTime(t), 18 + rand.random() * 4, sensor, 1234 + sensor, watts)
+
+def synthHistory(t, sensors, rand=random):
+	"""A full history dump, as a list of frames (4 hours, 3 days or 2 months per frame)."""
+	formats = {'h': '%05.1f', 'd': '%06.1f', 'm': '%08.2f'}
+	scales = {'h': 2.5, 'd': 30, 'm': 900}
+	chunks = []
+	hours = ['h%03d' % age for age in range(4, 746, 2)]
+	chunks.extend([hours[i:i + 4] for i in range(0, len(hours), 4)])
+	days = ['d%03d' % age for age in range(1, 91)]
+	chunks.extend([days[i:i + 3] for i in range(0, len(days), 3)])
+	months = ['m%03d' % age for age in range(1, 85)]
+	chunks.extend([months[i:i + 2] for i in range(0, len(months), 2)])
+	frames = []
+	for tags in chunks:
+		data = []
+		for sensor in range(10):
+			values = []
+			for tag in tags:
+				value = 0.0
+				if sensor < sensors:
+					value = rand.random() * scales[tag[0]]
+				values.append('<%s>%s</%s>' % (tag, formats[tag[0]] % value, tag))
+			data.append('<data><sensor>%d</sensor>%s</data>' % (sensor, ''.join(values)))
+		frames.append('%s<time>%s</time><hist><dsw>00032</dsw><type>1</type><units>kwhr</units>%s</hist></msg>\n' % (
+			SOURCE, deviceTime(t), ''.join(data)))
+	return frames
+
+def synthesize(sensors, channels, history_every, duration, rand=random):
+	"""Yields (device seconds, frame) for duration seconds of device time."""
+	start = time.time()
+	# a dump at most every frame
+	frames_between = max(1, int(history_every // cc128db.FRAME_INTERVAL))
+	for step in range(int(duration // cc128db.FRAME_INTERVAL)):
+		t = start + step * cc128db.FRAME_INTERVAL
+		if history_every and step % frames_between == 0:
+			for frame in synthHistory(t, sensors, rand):
+				yield (t, frame)
+		for sensor in range(sensors):
+			# the appliance sensor (#0) is the one measuring phases
+			yield (t, synthInstant(t, sensor, sensor == 0 and channels or 1, rand))
+
+def replay(filename):
+	"""Yields (device seconds, frame) from a recorded file, in a loop."""
+	lines = open(filename).readlines()
+	offset = 0
+	while True:
+		last = None
+		for line in lines:
+			frame = cc128.DecodeFrame(line)
+			if frame != None:
+				last = frame[1]
+			yield (offset + (last or 0), line.rstrip('\n') + '\n')
+		offset += 86400 # the file again, the next day
+
+def play(frames, masters, speed):
+	"""Writes frames to every pty, keeping the device clock at speed x the real one."""
+	sent = 0
+	start = time.time()
+	first = None
+	for (t, frame) in frames:
+		if first == None:
+			first = t
+		if speed:
+			delay = (t - first) / speed - (time.time() - start)
+			if delay > 0:
+				time.sleep(delay)
+		for master in masters:
+			os.write(master, frame)
+		sent += 1
+	return sent
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-n devices] [-s sensors] [--speed x] [-r frames.txt]')
+	op.add_option('-n', '--devices', type='int', default=1, help='pseudo-terminals to create (default: 1)')
+	op.add_option('-s', '--sensors', type='int', default=1, help='sensors per device, 1 to 10 (default: 1)')
+	op.add_option('-c', '--channels', type='int', default=1, help='channels of sensor #0, 1 to 3 (default: 1)')
+	op.add_option('', '--speed', type='float', default=1, help='device seconds per real second, 0 for no wait (default: 1)')
+	op.add_option('', '--history-every', type='int', default=3600, metavar='<seconds>', help='device seconds between history dumps, 0 for none (default: 3600)')
+	op.add_option('', '--duration', type='int', default=86400, metavar='<seconds>', help='device seconds to synthesize (default: 86400)')
+	op.add_option('-r', '--replay', metavar='<frames.txt>', help='replay recorded frames instead of synthesizing')
+	op.add_option('', '--seed', type='int', help='seed of the synthesized values')
+	options, args = op.parse_args()
+	if options.history_every < 0:
+		op.error('--history-every must be 0 or more seconds')
+
+	masters = []
+	for i in range(options.devices):
+		(master, slave) = pty.openpty()
+		tty.setraw(slave)
+		masters.append(master)
+		print os.ttyname(slave)
+	sys.stdout.flush()
+
+	if options.replay:
+		frames = replay(options.replay)
+	else:
+		frames = synthesize(options.sensors, options.channels, options.history_every, options.duration, random.Random(options.seed))
+	try:
+		start = time.time()
+		sent = play(frames, masters, options.speed)
+		print "%d frames in %.1f s" % (sent, time.time() - start)
+	except KeyboardInterrupt:
+		pass
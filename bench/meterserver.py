@@ -0,0 +1,205 @@
+#!/usr/bin/python2.6
+# meterserver
+#	A local stand-in for the Google PowerMeter feeds, to load-test uploads.
+#
+#	It implements what google_meter.Service uses: posting single events
+#	and entities, batch-posting events to /event, and getting entities
+#	and events back (GetEntity, GetEvents...), with gzip-compressed bodies
+#	both ways. Events are kept in memory. Entities have an ETag and a
+#	Last-Modified date, conditional GETs of unchanged ones get a 304.
+#
+#	usage: meterserver.py [-p port] [--latency ms] [--error-rate ratio] [--max-batch n]
+#	then upload with --service http://localhost:port/powermeter/feeds
+
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+import zlib
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import google_meter
+
+FEEDS_PATH = '/powermeter/feeds'
+
+
+class MeterHandler(BaseHTTPRequestHandler):
+	"""Serves one request of the google_meter.Service protocol."""
+
+	# keeps the connection open when asked to (Connection: keep-alive)
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.count('connections')
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def reply(self, code, content='', headers={}):
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/atom+xml')
+		for (name, value) in headers.items():
+			self.send_header(name, value)
+		if content and 'gzip' in (self.headers.getheader('Accept-Encoding') or ''):
+			content = google_meter.Gzip(content)
+			self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def path_and_query(self):
+		(_, _, path, _, query, _) = urlparse.urlparse(self.path)
+		if not path.startswith(FEEDS_PATH):
+			return (None, None)
+		return (path[len(FEEDS_PATH):], urlparse.parse_qs(query))
+
+	def misbehave(self):
+		"""Applies the configured latency and errors, true if it replied."""
+		server = self.server
+		if server.latency:
+			time.sleep(server.latency)
+		if server.error_rate and random.random() < server.error_rate:
+			self.reply(503, '<errors><error>Throttled</error></errors>')
+			server.count('errors')
+			return True
+		return False
+
+	def do_POST(self):
+		(path, _) = self.path_and_query()
+		length = int(self.headers.getheader('Content-Length') or 0)
+		content = self.rfile.read(length)
+		if self.headers.getheader('Content-Encoding') == 'gzip':
+			content = google_meter.Gunzip(content)
+		self.server.count('requests')
+		self.server.count('bytes_received', length)
+		if path == None:
+			return self.reply(404)
+		if self.misbehave():
+			return
+		try:
+			entries = google_meter.ParseEntries(content)
+		except Exception, e:
+			return self.reply(400, '<errors><error>%s</error></errors>' % google_meter.HtmlEscape(str(e)))
+		if path == '/event' and self.server.max_batch and len(entries) > self.server.max_batch:
+			self.server.count('errors')
+			return self.reply(413, '<errors><error>Too many entries</error></errors>')
+		self.server.store(entries)
+		if path == '/event':
+			self.server.count('batches')
+		self.reply(201, '<feed%s></feed>' % google_meter.XMLNS_ATTRIBUTES)
+
+	def do_GET(self):
+		(path, query) = self.path_and_query()
+		self.server.count('requests')
+		if path == None:
+			return self.reply(404)
+		if self.misbehave():
+			return
+		components = path.strip('/').split('/')
+		if len(components) < 2:
+			# events are under a subject
+			return self.reply(404)
+		if components[-1] in ('durMeasurement', 'instMeasurement', 'durMessage'):
+			field = components[-1].startswith('dur') and 'startTime' or 'occurTime'
+			events = self.server.events('/' + '/'.join(components[:-1]), components[-1],
+				query.get(field + 'Min', [None])[0], query.get(field + 'Max', [None])[0],
+				int(query.get('max-results', ['1000'])[0]))
+		elif len(components) > 2 and components[-2] == 'variable':
+			# every variable exists, as a durational electricity one
+			events = [google_meter.Variable(components[1], components[2], components[-1],
+				components[-1], '', '', 'electricity_consumption', 'kW h', False, True)]
+		else:
+			return self.reply(404)
+		content = '<feed%s>%s</feed>' % (google_meter.XMLNS_ATTRIBUTES, ''.join(event.ToXml() for event in events))
+		headers = {}
+		if components[-2] == 'variable':
+			# entities never change here
+			headers = {'ETag': '"%08x"' % (zlib.crc32(content) & 0xffffffff), 'Last-Modified': self.server.started}
+			if self.headers.getheader('If-None-Match') == headers['ETag'] or (
+					self.headers.getheader('If-None-Match') == None and self.headers.getheader('If-Modified-Since') == self.server.started):
+				self.server.count('not_modified')
+				return self.reply(304, '', headers)
+		self.server.count('bytes_sent', len(content))
+		self.reply(200, content, headers)
+
+
+class MeterServer(ThreadingMixIn, HTTPServer):
+	"""The stand-in server, keeping posted events by subject and kind."""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0, verbose=False, max_batch=None):
+		HTTPServer.__init__(self, address, MeterHandler)
+		self.latency = latency
+		self.error_rate = error_rate
+		self.max_batch = max_batch
+		self.verbose = verbose
+		self.lock = threading.Lock()
+		self.by_key = {} # (subject path, kind) => {key time: event}
+		self.stats = {'requests': 0, 'batches': 0, 'events': 0, 'errors': 0, 'bytes_received': 0, 'bytes_sent': 0, 'not_modified': 0, 'connections': 0}
+		self.started = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+
+	def uri(self):
+		"""The URI prefix to give to google_meter.Service."""
+		return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], FEEDS_PATH)
+
+	def count(self, name, value=1):
+		self.lock.acquire()
+		try:
+			self.stats[name] += value
+		finally:
+			self.lock.release()
+
+	def store(self, entries):
+		self.lock.acquire()
+		try:
+			for entry in entries:
+				if hasattr(entry, 'subject_path'):
+					key_time = getattr(entry, 'start_time', None) or getattr(entry, 'occur_time', None)
+					self.by_key.setdefault((entry.subject_path, entry.kind), {})[key_time] = entry
+					self.stats['events'] += 1
+		finally:
+			self.lock.release()
+
+	def events(self, subject_path, kind, min_timestamp, max_timestamp, max_results):
+		min_time = min_timestamp and google_meter.rfc3339.FromTimestamp(min_timestamp)
+		max_time = max_timestamp and google_meter.rfc3339.FromTimestamp(max_timestamp)
+		self.lock.acquire()
+		try:
+			by_time = self.by_key.get((subject_path, kind), {})
+			times = [t for t in sorted(by_time) if (min_time == None or t >= min_time) and (max_time == None or t < max_time)]
+			return [by_time[t] for t in times[:min(max_results, 1000)]]
+		finally:
+			self.lock.release()
+
+	def start(self):
+		"""Serves from a background thread, returns the thread."""
+		thread = threading.Thread(target=self.serve_forever, name='meterserver')
+		thread.setDaemon(True)
+		thread.start()
+		return thread
+
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-p port] [--latency ms] [--error-rate ratio]')
+	op.add_option('-p', '--port', type='int', default=8128, help='port to listen on (default: 8128)')
+	op.add_option('', '--latency', type='float', default=0, metavar='<ms>', help='delay added to each reply (default: 0)')
+	op.add_option('', '--error-rate', type='float', default=0, metavar='<ratio>', help='ratio of requests answered 503 (default: 0)')
+	op.add_option('', '--max-batch', type='int', metavar='<events>', help='batch posts larger than this are answered 413 (default: None)')
+	op.add_option('-v', '--verbose', action='store_true', default=False, help='log every request')
+	options, args = op.parse_args()
+
+	server = MeterServer(('127.0.0.1', options.port), options.latency / 1000.0, options.error_rate, options.verbose, options.max_batch)
+	print "Serving on %s" % server.uri()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print server.stats
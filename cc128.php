@@ -13,15 +13,15 @@ echo "CC128 PHP parser (".date("d/m/Y H:i").")\n";
 /**
  * config section
  */
-$nb_sensors = 1; // nb of sensors we want to handle
+$nb_sensors = 10; // nb of sensors we want to handle (appliance + 9 IAMs)
+$nb_channels = 3; // nb of channels (phases) per sensor
 $nb_frames = 10; // nb of trame to analysis
 
 /**
  * program section
  */
 
-$t_daily_stats = array();
-$t_hourly_stats = array();
+$t_stats = array(); // rows of (sensor, channel, resolution, ts, kwatt)
 
 $now = ''; // TimeStamp at the time we received data
 $t_xml = array();
@@ -53,15 +53,24 @@ foreach ($t_xml as $xml) {
 		continue;
 	}
 
-	if($o_xml->sensor) // instantaneous consumption
-		echo "at ".$o_xml->time." we were using ".$o_xml->ch1->watts." W\n";
+	if($o_xml->sensor) { // instantaneous consumption
+		for ($ch=1; $ch<=$nb_channels; $ch++) {
+			$channel = "ch$ch";
+			if(! $o_xml->$channel) continue;
+			echo "at ".$o_xml->time." sensor #".$o_xml->sensor." was using ".$o_xml->$channel->watts." W on $channel\n";
+		}
+	}
 	else { // historical data ...
 		echo "Data from last ".$o_xml->hist->dsw." days (current time : ".$o_xml->time."):\n\n";
 
 		// strtotime is magic ;) and for lazy people
-		$now = strtotime($o_xml->time); // note that we ignore minutes and seconds
+		$now = strtotime($o_xml->time);
 		//echo "TS now : $now\n";
 
+		// anchors of the tags, computed once per frame
+		$hour_anchor = $now - date("i", $now) * 60 - date("s", $now); // note that we ignore minutes and seconds
+		$day_anchor = getdate($now);
+
 		foreach ($o_xml->hist->data as $data) {
 
 			// we don't mind data for sensors that doesn't exist (first sensor is #0)
@@ -77,20 +86,22 @@ foreach ($t_xml as $xml) {
 				switch($precision) {
 
 					case "h":
-						echo "[".$tag."]".date("d/m/Y H:i", tsFromHTag($tag)) . " : ". $xdata." (".$o_xml->hist->units.")\n";
-						$t_hourly_stats[tsFromHTag($tag)] = $xdata;
+						$tstamp = tsFromHTag($tag, $hour_anchor);
 						break;
 
 					case "d":
-						echo "[".$tag."]".date("d/m/Y H:i", tsFromDTag($tag)) . " : ". $xdata." (".$o_xml->hist->units.")\n";
-						$t_daily_stats[tsFromDTag($tag)] = $xdata;
+						$tstamp = tsFromDTag($tag, $day_anchor);
 						break;
 
 					default:
 						echo "Precision $precision isn't handled\n";
-						break;
+						continue 2;
 				}
 
+				echo "[".$tag."]".date("d/m/Y H:i", $tstamp) . " : ". $xdata." (".$o_xml->hist->units.")\n";
+				// history only reports the sensor total, stored on channel 0
+				$t_stats[] = array((int)$data->sensor, 0, $precision, $tstamp, (float)$xdata);
+
 
 				//echo $tag . " : " . $xdata . "\n";
 			}
@@ -103,22 +114,47 @@ try {
 	// store data to sqlite ...
 	$db = new PDO('sqlite:cc128.db');
 
-	// does table already exist ?
-	$sql = 'CREATE TABLE IF NOT EXISTS consumption (date INTEGER PRIMARY KEY, kwatt REAL) ';
-	$db->exec($sql); // remove or 'comment out' this line after first run
-
-	foreach ($t_hourly_stats as $tstamp => $watt) {
-		addOrUpdateValue($db, $tstamp, $watt);
+	createSchema($db);
+
+	$db->beginTransaction();
+	$t_counts = array('inserted' => 0, 'updated' => 0, 'unchanged' => 0);
+	$t_updated = array(); // first ts updated, per series
+	foreach ($t_stats as $row) {
+		list($sensor, $channel, $resolution, $tstamp, $kwatt) = $row;
+		$status = addOrUpdateValue($db, $sensor, $channel, $resolution, $tstamp, $kwatt);
+		$t_counts[$status]++;
+		$key = "$sensor $channel $resolution";
+		if($status == 'updated' && (!isset($t_updated[$key]) || $tstamp < $t_updated[$key])) {
+			$t_updated[$key] = $tstamp;
+		}
 	}
+	if($t_counts['inserted'] > 0) {
+		updateCoverage($db, $t_stats);
+	}
+	rewindUploads($db, $t_updated);
+	$db->commit();
+	echo "Stored ".$t_counts['inserted']." new values, ".$t_counts['updated']." updated, ".$t_counts['unchanged']." unchanged\n";
 
 	/**
 	 * generate data.js ...
 	 */
 	$t_rows = array();
-	foreach ($db->query("select date, kwatt from consumption") as $row) {
+	// plot the hourly total of all sensors, archived months and partitioned
+	// years (cc128archive.py --partition) included
+	$t_kwatt = readArchivedTotals($db);
+	foreach (glob('cc128-[0-9][0-9][0-9][0-9].db') as $partition) {
+		$db->exec("ATTACH DATABASE '$partition' AS frozen");
+		$t_kwatt = readArchivedTotals($db, 'frozen', $t_kwatt);
+		$db->exec('DETACH DATABASE frozen');
+	}
+	foreach ($db->query("select ts, sum(kwatt) as kwatt from consumption where resolution = 'h' and channel = 0 group by ts") as $row) {
+		$t_kwatt[$row['ts']] = (isset($t_kwatt[$row['ts']]) ? $t_kwatt[$row['ts']] : 0) + $row['kwatt'];
+	}
+	ksort($t_kwatt);
+	foreach ($t_kwatt as $tstamp => $kwatt) {
 		// nomobjet = new Date(annee,mois,jour,heures,minutes,secondes);
-		$date = date("Y, n-1, j, G, i, s", $row['date']); // note that month index start at 0 in js
-		$t_rows[] = '[new Date('.$date.'), '.$row['kwatt']."]\n";
+		$date = date("Y, n-1, j, G, i, s", $tstamp); // note that month index start at 0 in js
+		$t_rows[] = '[new Date('.$date.'), '.$kwatt."]\n";
 	}
 	$js_rows = implode(',', $t_rows);
 
@@ -140,34 +176,208 @@ JS;
 
 
 /**
+ * create the consumption table (same schema as cc128db.py)
+ * and upgrade databases keyed on date alone
  *
- * @param unknown_type $db
- * @param unknown_type $tstamp
- * @param unknown_type $kwatt
+ * @param PDO $db
  */
-function addOrUpdateValue($db, $tstamp, $kwatt) {
-	$st = $db->prepare('REPLACE INTO consumption (date, kwatt) values (:date, :kwatt)');
-	$st->bindParam(':date', $tstamp);
-	$st->bindParam(':kwatt', $kwatt);
-	$st->execute();
+function createSchema($db) {
+	$schema = 'CREATE TABLE IF NOT EXISTS consumption (
+			sensor INTEGER NOT NULL, channel INTEGER NOT NULL,
+			resolution TEXT NOT NULL, ts INTEGER NOT NULL, kwatt REAL,
+			PRIMARY KEY (sensor, channel, resolution, ts)) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS consumption_by_time ON consumption (resolution, ts);';
+
+	$columns = array();
+	foreach ($db->query('PRAGMA table_info(consumption)') as $row) {
+		$columns[] = $row['name'];
+	}
+
+	if(in_array('date', $columns)) { // first releases stored a single hourly series
+		$db->exec('ALTER TABLE consumption RENAME TO consumption_v1');
+		$db->exec($schema);
+		$db->exec("INSERT INTO consumption (sensor, channel, resolution, ts, kwatt) SELECT 0, 0, 'h', date, kwatt FROM consumption_v1");
+		$db->exec('DROP TABLE consumption_v1');
+	} else {
+		$db->exec($schema);
+	}
 }
 
+/**
+ * hourly totals of all sensors in the months moved to the archive table by
+ * cc128archive.py (see PackArchive and UnpackArchive in cc128db.py), as
+ * ts => kwatt ; needs a 64 bits php >= 5.6.3 (unpack of little-endian 64
+ * bits numbers)
+ *
+ * @param PDO $db
+ * @param string $schema the attached database to read (a yearly partition)
+ * @param array $t_kwatt totals to add them to
+ * @return array
+ */
+function readArchivedTotals($db, $schema = 'main', $t_kwatt = array()) {
+	if(PHP_INT_SIZE < 8) {
+		die("Reading the archive needs a 64 bits php\n");
+	}
+	if(!$db->query("select count(*) from $schema.sqlite_master where name = 'archive'")->fetchColumn()) {
+		return $t_kwatt; // never archived
+	}
+	// unpack('d') reads the machine order, the blocks are little-endian
+	$big_endian = pack('S', 1) != pack('v', 1);
+	foreach ($db->query("select start_ts, count, data from $schema.archive where resolution = 'h' and channel = 0") as $row) {
+		$body = gzuncompress($row['data']);
+		if($body[0] != 'F' && $body[0] != 'X') {
+			echo "Skipping an archive block of unknown encoding '".$body[0]."' at ".date("d/m/Y H:i", $row['start_ts'])."\n";
+			continue;
+		}
+		$n = (int)$row['count'];
+		// delta-of-delta timestamps then the values, little-endian whatever
+		// the machine : V is an unsigned 32 bits (its sign is put back
+		// below), P 64 bits read into a (signed) 64 bits php int
+		$t_numbers = array_values(unpack('V'.$n.'dod/P'.$n.'value', substr($body, 1)));
+		$tstamp = (int)$row['start_ts'];
+		$delta = 0;
+		$bits = 0;
+		for($i = 0; $i < $n; $i++) {
+			$dod = $t_numbers[$i];
+			$delta += $dod >= 0x80000000 ? $dod - 0x100000000 : $dod;
+			$tstamp += $delta;
+			if($body[0] == 'F') {
+				// thousandths of kWh
+				$kwatt = $t_numbers[$n + $i] / 1000;
+			} else {
+				// the IEEE bits of the value XOR-ed with those of the previous one
+				$bits ^= $t_numbers[$n + $i];
+				if($bits == 0x7ff8dead00000000) continue; // a missing value (cc128db._NULL_BITS)
+				$double = pack('P', $bits);
+				list(, $kwatt) = unpack('d', $big_endian ? strrev($double) : $double);
+			}
+			$t_kwatt[$tstamp] = (isset($t_kwatt[$tstamp]) ? $t_kwatt[$tstamp] : 0) + $kwatt;
+		}
+	}
+	return $t_kwatt;
+}
 
-function tsFromHTag($htag) {
-	global $now;
+/**
+ * extend the ranges of the coverage table (see UpdateCoverage in cc128db.py)
+ * over the rows just stored ; databases cc128db.py never opened have no
+ * coverage table yet, it is computed from all the rows when it creates it
+ *
+ * @param PDO $db
+ * @param array $t_rows rows of (sensor, channel, resolution, ts, kwatt)
+ */
+function updateCoverage($db, $t_rows) {
+	if(!$db->query("select count(*) from sqlite_master where name = 'coverage'")->fetchColumn()) {
+		return;
+	}
+	// longest interval between two readings of a range (cc128db.MAX_STEP) :
+	// the hNNN tags are 2-hour blocks, plus an hour of slack
+	$t_steps = array('h' => 3 * 3600, 'd' => 25 * 3600, 'm' => 31 * 86400 + 3600);
+	$t_series = array();
+	foreach ($t_rows as $row) {
+		list($sensor, $channel, $resolution, $tstamp, $kwatt) = $row;
+		$t_series["$sensor $channel $resolution"][$tstamp] = true;
+	}
+	$st_select = $db->prepare('SELECT start_ts, end_ts FROM coverage WHERE sensor = ? AND channel = ? AND resolution = ? AND start_ts <= ? AND end_ts >= ? ORDER BY start_ts');
+	$st_delete = $db->prepare('DELETE FROM coverage WHERE sensor = ? AND channel = ? AND resolution = ? AND start_ts = ?');
+	$st_insert = $db->prepare('INSERT INTO coverage (sensor, channel, resolution, start_ts, end_ts) VALUES (?, ?, ?, ?, ?)');
+	foreach ($t_series as $key => $t_tstamps) {
+		list($sensor, $channel, $resolution) = explode(' ', $key);
+		$step = isset($t_steps[$resolution]) ? $t_steps[$resolution] : $t_steps['m'];
+		$t_tstamps = array_keys($t_tstamps);
+		sort($t_tstamps);
+		$st_select->execute(array($sensor, $channel, $resolution, end($t_tstamps) + $step, $t_tstamps[0] - $step));
+		$t_ranges = array();
+		foreach ($st_select->fetchAll(PDO::FETCH_NUM) as $range) {
+			$t_ranges[] = array((int)$range[0], (int)$range[1]);
+		}
+		$t_all = $t_ranges;
+		foreach ($t_tstamps as $tstamp) {
+			$t_all[] = array($tstamp, $tstamp);
+		}
+		sort($t_all);
+		$t_merged = array();
+		foreach ($t_all as $range) {
+			$last = count($t_merged) - 1;
+			if($last >= 0 && $range[0] <= $t_merged[$last][1] + $step) {
+				$t_merged[$last][1] = max($t_merged[$last][1], $range[1]);
+			} else {
+				$t_merged[] = $range;
+			}
+		}
+		if($t_merged == $t_ranges) continue; // covered already
+		foreach ($t_ranges as $range) {
+			$st_delete->execute(array($sensor, $channel, $resolution, $range[0]));
+		}
+		foreach ($t_merged as $range) {
+			$st_insert->execute(array($sensor, $channel, $resolution, $range[0], $range[1]));
+		}
+	}
+}
 
-	$xnow = strtotime(date("H", $now).":00:00"); // note that we ignore minutes and seconds
+/**
+ * set the uploads (see SetUploaded in cc128db.py) of the series whose values
+ * changed back before the first changed one, so that it is uploaded again
+ *
+ * @param PDO $db
+ * @param array $t_updated "sensor channel resolution" => first ts updated
+ */
+function rewindUploads($db, $t_updated) {
+	if(!$t_updated || !$db->query("select count(*) from sqlite_master where name = 'uploaded'")->fetchColumn()) {
+		return;
+	}
+	$st_rewind = $db->prepare('UPDATE uploaded SET ts = ? WHERE sensor = ? AND channel = ? AND resolution = ? AND ts >= ?');
+	foreach ($t_updated as $key => $tstamp) {
+		list($sensor, $channel, $resolution) = explode(' ', $key);
+		$st_rewind->execute(array($tstamp - 1, $sensor, $channel, $resolution, $tstamp));
+	}
+}
 
-	$nb = substr($htag, -3);
-	//echo "$tag => $nb";
-	return strtotime("-$nb hour", $xnow);
+/**
+ *
+ * @param PDO $db
+ * @param int $sensor
+ * @param int $channel
+ * @param string $resolution
+ * @param int $tstamp
+ * @param float $kwatt
+ */
+function addOrUpdateValue($db, $sensor, $channel, $resolution, $tstamp, $kwatt) {
+	// history dumps overlap, most of their values are already stored : only
+	// write rows that are new or whose value changed (REPLACE would delete
+	// and insert every row again)
+	static $st_insert = null, $st_update = null;
+	if($st_insert === null) {
+		$st_insert = $db->prepare('INSERT OR IGNORE INTO consumption (sensor, channel, resolution, ts, kwatt) values (:sensor, :channel, :resolution, :ts, :kwatt)');
+		$st_update = $db->prepare('UPDATE consumption SET kwatt = :kwatt WHERE sensor = :sensor AND channel = :channel AND resolution = :resolution AND ts = :ts AND kwatt IS NOT :kwatt');
+	}
+	$params = array(':sensor' => $sensor, ':channel' => $channel, ':resolution' => $resolution, ':ts' => $tstamp, ':kwatt' => $kwatt);
+	$st_insert->execute($params);
+	if($st_insert->rowCount() > 0) return 'inserted';
+	$st_update->execute($params);
+	if($st_update->rowCount() > 0) return 'updated';
+	return 'unchanged';
 }
 
-function tsFromDTag($dtag) {
 
-	$xnow = strtotime("12:00:00"); // at noon...
+/**
+ * hNNN is the hour starting NNN hours before the hour of the frame
+ *
+ * @param string $htag
+ * @param int $hour_anchor start of the hour of the frame
+ */
+function tsFromHTag($htag, $hour_anchor) {
+	$nb = (int)substr($htag, -3);
+	return $hour_anchor - $nb * 3600;
+}
 
-	$nb = substr($dtag, -3);
-	//echo "$tag => $nb";
-	return strtotime("-$nb day", $xnow);
+/**
+ * dNNN is the noon NNN days before the day of the frame
+ *
+ * @param string $dtag
+ * @param array $day_anchor getdate() of the frame
+ */
+function tsFromDTag($dtag, $day_anchor) {
+	$nb = (int)substr($dtag, -3);
+	// mktime normalizes the day and handles DST changes
+	return mktime(12, 0, 0, $day_anchor['mon'], $day_anchor['mday'] - $nb, $day_anchor['year']);
 }
@@ -0,0 +1,235 @@
+#	cc128
+#	 Decoding of the XML frames sent by a Current Cost CC128.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Decoding of the XML frames sent by a Current Cost CC128.
+
+The CC128 writes one <msg> element per line on its serial port, either an
+instantaneous reading:
+
+  <msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:02:39</time>
+  <tmpr>18.7</tmpr><sensor>1</sensor><id>01234</id><type>1</type>
+  <ch1><watts>00345</watts></ch1><ch2><watts>02151</watts></ch2></msg>
+
+or a chunk of its history, with one <data> element per sensor:
+
+  <msg><src>CC128-v0.11</src><dsb>00089</dsb><time>13:10:50</time>
+  <hist><dsw>00032</dsw><type>1</type><units>kwhr</units>
+  <data><sensor>0</sensor><h024>001.1</h024><d001>0012.3</d001></data>
+  </hist></msg>
+
+The schema is fixed, so frames are decoded with a few precompiled patterns
+instead of a generic XML parser, into plain tuples:
+
+  (INSTANT, seconds, tmpr, sensor, watts)
+      seconds: the device time as seconds since midnight
+      tmpr: the temperature as a float
+      sensor: the sensor number
+      watts: a tuple of ints, one per channel present (ch1, ch2, ch3)
+
+  (HISTORY, seconds, dsw, units, values)
+      seconds: the device time as seconds since midnight
+      dsw: days since the device was wiped, as an int
+      units: the unit of the values (e.g. 'kwhr')
+      values: a list of (sensor, resolution, age, value) tuples, where
+          resolution is 'h', 'd' or 'm' and age the number of hours, days or
+          months of the tag (h024 => 'h', 24)
+
+The device only sends its time of day.  FrameTime dates it against the host
+clock, and HistoryReadings turns the tags of a history frame into
+timestamps through a table computed once per frame time.
+"""
+
+import re
+import time
+
+INSTANT = 'i'
+HISTORY = 'h'
+
+TIME_RE = re.compile(r'<time>(\d\d):(\d\d):(\d\d)</time>')
+INSTANT_RE = re.compile(
+    r'<tmprF?>\s*(-?[\d.]+)</tmprF?>.*?<sensor>(\d+)</sensor>.*?'
+    r'<ch1><watts>(\d+)</watts></ch1>'
+    r'(?:<ch2><watts>(\d+)</watts></ch2>)?'
+    r'(?:<ch3><watts>(\d+)</watts></ch3>)?')
+HIST_RE = re.compile(
+    r'<hist><dsw>(\d+)</dsw>.*?<units>(\w+)</units>(.*)</hist>')
+# One pass over the <data> elements: a <sensor> tag applies to the value
+# tags that follow it.
+DATA_RE = re.compile(r'<sensor>(\d+)</sensor>|<([hdm])(\d+)>([\d.]+)</')
+
+
+def DecodeFrame(line):
+  """Decodes one line read from the CC128.
+
+  Args:
+    line: a line of text holding a <msg> element
+  Returns:
+    an INSTANT or HISTORY tuple (see the module documentation), or None if
+    the line isn't a complete frame
+  """
+  if '</msg>' not in line:
+    return None
+  match = TIME_RE.search(line)
+  if not match:
+    return None
+  hour, minute, second = match.groups()
+  seconds = int(hour) * 3600 + int(minute) * 60 + int(second)
+  pos = match.end()
+
+  if '<hist>' in line:
+    match = HIST_RE.search(line, pos)
+    if not match:
+      return None
+    dsw, units, data = match.groups()
+    values = []
+    append = values.append
+    sensor = None
+    for tag_sensor, resolution, age, value in DATA_RE.findall(data):
+      if tag_sensor:
+        sensor = int(tag_sensor)
+      elif sensor is not None:
+        append((sensor, resolution, int(age), float(value)))
+    return (HISTORY, seconds, int(dsw), units, values)
+
+  match = INSTANT_RE.search(line, pos)
+  if not match:
+    return None
+  tmpr, sensor, ch1, ch2, ch3 = match.groups()
+  if ch2 is None:
+    watts = (int(ch1),)
+  elif ch3 is None:
+    watts = (int(ch1), int(ch2))
+  else:
+    watts = (int(ch1), int(ch2), int(ch3))
+  return (INSTANT, seconds, float(tmpr), int(sensor), watts)
+
+
+def DecodeFrames(lines):
+  """Decodes an iterable of lines, skipping the ones that aren't frames."""
+  for line in lines:
+    frame = DecodeFrame(line)
+    if frame is not None:
+      yield frame
+
+
+# Seconds in an hour and in a day.
+HOUR = 3600
+DAY = 86400
+
+
+def FrameTime(seconds, now=None):
+  """Dates a frame sent at the given device time of day.
+
+  Args:
+    seconds: the device time as seconds since midnight
+    now: the host time at which the frame was read (default: now)
+  Returns:
+    the time of the frame in seconds since the epoch
+  """
+  if now is None:
+    now = time.time()
+  year, month, day = time.localtime(now)[:3]
+  hour, minute, second = seconds // HOUR, seconds // 60 % 60, seconds % 60
+  frame_time = time.mktime(
+      (year, month, day, hour, minute, second, 0, 0, -1))
+  # A frame sent just before midnight may be read just after it.
+  if frame_time > now + DAY / 2:
+    frame_time = time.mktime(
+        (year, month, day - 1, hour, minute, second, 0, 0, -1))
+  return int(frame_time)
+
+
+class TagTimes(object):
+  """The timestamps of the history tags of frames sent at a given time.
+
+  A hNNN tag is the hour starting NNN hours before the hour of the frame, a
+  dNNN tag the noon NNN days before the day of the frame and a mNNN tag the
+  first day of the month NNN months before the month of the frame, all in
+  local time.  Hours are counted in elapsed time, days and months on the
+  calendar, so a DST change within the history moves neither.
+
+  Each table is computed once, for every age up to the largest one asked
+  for, so that looking a tag up is a list index.
+  """
+
+  def __init__(self, frame_time):
+    self.frame_time = frame_time
+    local = time.localtime(frame_time)
+    self.year, self.month, self.day = local[:3]
+    self.hour_start = frame_time - local.tm_min * 60 - local.tm_sec
+    self.tables = {'h': [], 'd': [], 'm': []}
+
+  def Table(self, resolution, max_age):
+    """Returns the list of timestamps of ages 0 to max_age (at least)."""
+    table = self.tables[resolution]
+    if len(table) <= max_age:
+      ages = range(len(table), max_age + 1)
+      if resolution == 'h':
+        table.extend([self.hour_start - age * HOUR for age in ages])
+      elif resolution == 'd':
+        table.extend([int(time.mktime((self.year, self.month, self.day - age,
+                                       12, 0, 0, 0, 0, -1)))
+                      for age in ages])
+      else:
+        months = [self.year * 12 + self.month - 1 - age for age in ages]
+        table.extend([int(time.mktime((month // 12, month % 12 + 1, 1,
+                                       0, 0, 0, 0, 0, -1)))
+                      for month in months])
+    return table
+
+
+# The TagTimes of the last history frame; all the frames of a history dump
+# are sent within the same hour, so they share it.
+_last_tag_times = None
+
+
+def GetTagTimes(frame_time):
+  """Returns the TagTimes of a frame time, reusing the last one if possible."""
+  global _last_tag_times
+  tag_times = _last_tag_times
+  if (tag_times is None or
+      not 0 <= frame_time - tag_times.hour_start < HOUR or
+      time.localtime(frame_time)[:3] !=
+      (tag_times.year, tag_times.month, tag_times.day)):
+    tag_times = _last_tag_times = TagTimes(frame_time)
+  return tag_times
+
+
+def HistoryReadings(frame, now=None):
+  """Converts a HISTORY frame into consumption rows.
+
+  Args:
+    frame: a HISTORY tuple returned by DecodeFrame
+    now: the host time at which the frame was read (default: now)
+  Returns:
+    a list of (sensor, channel, resolution, ts, value) tuples, as expected by
+    cc128db.StoreReadings (history values are sensor totals, on channel 0)
+  """
+  values = frame[4]
+  if not values:
+    return []
+  tag_times = GetTagTimes(FrameTime(frame[1], now))
+  max_ages = {}
+  for sensor, resolution, age, value in values:
+    if age > max_ages.get(resolution, -1):
+      max_ages[resolution] = age
+  tables = {}
+  for resolution, max_age in max_ages.items():
+    tables[resolution] = tag_times.Table(resolution, max_age)
+  return [(sensor, 0, resolution, tables[resolution][age], value)
+          for sensor, resolution, age, value in values]
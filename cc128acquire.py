@@ -0,0 +1,300 @@
+#!/usr/bin/python2.6
+# cc128acquire
+#	Reads many CC128 serial ports from one process and stores their data
+#	in a sqlite file.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Every serial port is opened non-blocking and watched by a single epoll
+# (poll where epoll is missing) loop, which splits what it reads into
+# lines, one buffer per port. Complete lines are appended to a spool, a few
+# memory-mapped files (see cc128spool), read back by one writer thread
+# which decodes the frames and owns the sqlite connection. Reading the
+# ports never waits on the database, and the writer keeps its position in
+# the spool in the database, committed with the frames it stored : after a
+# crash, or a stop with the database busy, exactly the lines not stored yet
+# are read again when it starts. The acquisition stops if the writer dies.
+#
+# Sensors of each device are stored under device base + sensor number. By
+# default the base of the Nth device on the command line is N*10 (the CC128
+# handles 10 sensors), or it can be given after the device name :
+#	$ ./cc128acquire.py -d cc128.db /dev/ttyUSB0 /dev/ttyUSB1:40
+
+import errno
+import os
+import select
+import sys
+import termios
+import threading
+import time
+from optparse import OptionParser
+
+import cc128
+import cc128db
+import cc128spool
+
+programVersion = '0.1'
+programName = 'cc128acquire'
+
+# the CC128 talks at 57600 bauds, 8N1
+BAUD_RATE = termios.B57600
+
+# a frame never gets this long, something is wrong with the port
+MAX_LINE = 65536
+
+# seconds between two attempts to reopen a port that went away
+REOPEN_DELAY = 10
+
+# seconds between two syncs of the spool to the disk
+SYNC_DELAY = 1
+
+def parseArguments():
+	op = OptionParser('%prog [-d Filename.db] [--spool dir] device[:base] ...', version="%s %s" % (programName, programVersion))
+	op.add_option('-d', '--database', metavar='<Filename.db>', help='sqlite file to store data into (default: cc128.db)')
+	op.add_option('', '--spool', metavar='<dir>', help='directory of the lines read and not stored yet (default: the database name with .spool)')
+	op.add_option('', '--spool-size', type='int', metavar='<MB>', help='spool size before the readers drop lines (default: 1024)')
+	op.add_option('', '--batch-frames', type='int', metavar='<frames>', help='instantaneous frames per commit (default: 100)')
+	op.add_option('', '--batch-seconds', type='int', metavar='<seconds>', help='maximum delay before a commit (default: 60)')
+	op.add_option('', '--retention', type='int', metavar='<days>', help='days of instantaneous readings kept at full resolution (default: 7)')
+	op.set_defaults(database='cc128.db', spool_size=1024, batch_frames=100, batch_seconds=60, retention=7)
+
+	options, args = op.parse_args()
+	if options.spool == None:
+		options.spool = os.path.splitext(options.database)[0] + '.spool'
+	if len(args) < 1:
+		sys.stderr.write('Error: No serial port specified.\n')
+		op.exit(2, op.format_help())
+
+	devices = []
+	for i in range(len(args)):
+		device, sep, base = args[i].partition(':')
+		if sep:
+			devices.append((device, int(base)))
+		else:
+			devices.append((device, i * cc128db.MAX_SENSORS))
+	return (devices, options)
+
+
+class Port(object):
+	"""A CC128 serial port and the partial line read from it."""
+
+	def __init__(self, device, base):
+		self.device = device
+		self.base = base
+		self.fd = None
+		self.buffer = ''
+		self.next_open = 0
+
+	def open(self):
+		self.fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+		# raw mode, so that the tty layer doesn't interpret anything
+		attrs = termios.tcgetattr(self.fd)
+		attrs[0] = termios.IGNPAR # iflag
+		attrs[1] = 0 # oflag
+		attrs[2] = termios.CS8 | termios.CLOCAL | termios.CREAD # cflag
+		attrs[3] = 0 # lflag
+		attrs[4] = attrs[5] = BAUD_RATE
+		try:
+			termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+		except termios.error:
+			pass # not a tty (e.g. a fifo), read it as is
+		self.buffer = ''
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		self.next_open = time.time() + REOPEN_DELAY
+
+	def readLines(self):
+		"""Reads what is available, returns the complete lines (None at EOF)."""
+		try:
+			data = os.read(self.fd, 4096)
+		except OSError, e:
+			if e.errno in (errno.EAGAIN, errno.EINTR):
+				return []
+			raise
+		if not data:
+			return None
+		lines = (self.buffer + data).split('\n')
+		self.buffer = lines.pop()
+		if len(self.buffer) > MAX_LINE:
+			self.buffer = ''
+		return lines
+
+
+class Poller(object):
+	"""epoll where available, poll otherwise."""
+
+	def __init__(self):
+		if hasattr(select, 'epoll'):
+			self.poll = select.epoll()
+			self.flags = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+			self.unit = 1 # epoll timeouts are in seconds
+		else:
+			self.poll = select.poll()
+			self.flags = select.POLLIN | select.POLLERR | select.POLLHUP
+			self.unit = 1000 # poll ones in milliseconds
+
+	def register(self, fd):
+		self.poll.register(fd, self.flags)
+
+	def unregister(self, fd):
+		self.poll.unregister(fd)
+
+	def wait(self, timeout):
+		return self.poll.poll(timeout * self.unit)
+
+
+class Writer(threading.Thread):
+	"""Decodes spooled lines and stores them, the only user of the database."""
+
+	def __init__(self, options):
+		threading.Thread.__init__(self, name='writer')
+		self.options = options
+		self.stopping = threading.Event()
+		self.frames = 0
+		self.counts = [0, 0, 0] # history readings inserted, updated, unchanged
+
+	def run(self):
+		con = cc128db.Connect(self.options.database)
+		position = cc128db.GetSpoolPosition(con, self.options.spool)
+		self.position = position # of the lines stored so far, committed or not
+		self.committed = position # of the lines committed
+		store = cc128db.InstantStore(con, self.options.batch_frames, self.options.batch_seconds, self.options.retention * 86400, on_commit=lambda: self.checkpoint(con))
+		reader = cc128spool.SpoolReader(self.options.spool, position)
+		released = position
+		idle = 0
+		# on a stop request, the lines not read yet stay in the spool
+		while not self.stopping.isSet():
+			records = reader.Read(self.options.batch_frames, 1)
+			if not records:
+				idle += 1
+				if idle >= self.options.batch_seconds and (store.pending_frames or self.position != self.committed):
+					store.Flush() # nothing came in, commit what is buffered
+			else:
+				idle = 0
+				for (position, base, read_time, line) in records:
+					self.store(con, store, position, (base, read_time, line))
+			if self.committed != released:
+				# the lines before it are in the database, their segments can go
+				reader.Commit(self.committed)
+				released = self.committed
+		store.Flush()
+		if self.committed != released:
+			reader.Commit(self.committed)
+		reader.Close()
+		con.close()
+
+	def checkpoint(self, con):
+		# in the transaction committing the lines read so far
+		if self.position != None:
+			cc128db.SetSpoolPosition(con, self.options.spool, self.position)
+		self.committed = self.position
+
+	def store(self, con, store, position, item):
+		# position: of the spool after the line, committed with it
+		(base, read_time, line) = item
+		frame = cc128.DecodeFrame(line)
+		if frame == None:
+			self.position = position # committed with the next frame
+			return
+		self.frames += 1
+		if frame[0] == cc128.INSTANT:
+			self.position = position
+			store.Append(base + frame[3], cc128.FrameTime(frame[1], read_time), frame[4])
+		else:
+			# the buffered instantaneous frames are committed first, the
+			# history commits the position after it
+			if store.pending_frames:
+				store.Flush()
+			self.position = position
+			self.checkpoint(con)
+			readings = cc128.HistoryReadings(frame, read_time)
+			counts = cc128db.StoreReadings(con, [(base + sensor, channel, resolution, ts, kwatt) for (sensor, channel, resolution, ts, kwatt) in readings])
+			for i in range(3):
+				self.counts[i] += counts[i]
+
+
+def acquire(ports, spool, writer):
+	"""Reads all the ports until interrupted, spooling (base, time, line).
+
+	Returns if the writer died: the frames would only pile up in the spool."""
+	poller = Poller()
+	by_fd = {}
+	dropped = 0
+	synced = time.time()
+	while writer.isAlive():
+		# (re)open the ports that aren't opened yet
+		now = time.time()
+		for port in ports:
+			if port.fd is None and port.next_open <= now:
+				try:
+					port.open()
+				except OSError, e:
+					sys.stderr.write("Warning: Can not open '%s' (%s)\n" % (port.device, e.strerror))
+					port.close()
+					continue
+				poller.register(port.fd)
+				by_fd[port.fd] = port
+
+		for (fd, event) in poller.wait(1):
+			port = by_fd[fd]
+			try:
+				lines = port.readLines()
+			except OSError, e:
+				sys.stderr.write("Warning: Error reading '%s' (%s)\n" % (port.device, e.strerror))
+				lines = None
+			if lines == None: # unplugged, try again later
+				poller.unregister(fd)
+				del by_fd[fd]
+				port.close()
+				continue
+			read_time = time.time()
+			for line in lines:
+				if not spool.Append(port.base, read_time, line):
+					dropped += 1
+					if dropped % 1000 == 1:
+						sys.stderr.write("Warning: Writer is late and the spool is full, %d frames dropped\n" % dropped)
+		if time.time() - synced >= SYNC_DELAY:
+			spool.Sync()
+			synced = time.time()
+
+if __name__ == '__main__':
+
+	(devices, options) = parseArguments()
+	ports = [Port(device, base) for (device, base) in devices]
+
+	spool = cc128spool.Spool(options.spool, max_segments=max(1, options.spool_size * 1024 * 1024 / cc128spool.SEGMENT_SIZE))
+	writer = Writer(options)
+	writer.start()
+	died = False
+	try:
+		try:
+			acquire(ports, spool, writer)
+			died = True
+		except KeyboardInterrupt:
+			pass
+	finally:
+		spool.Close()
+		writer.stopping.set()
+		writer.join()
+		print "%d frames stored." % writer.frames
+		print "History readings : %d new, %d updated, %d unchanged." % tuple(writer.counts)
+	if died:
+		sys.stderr.write('Error: The writer stopped, the frames are kept in the spool.\n')
+		sys.exit(1)
@@ -0,0 +1,69 @@
+#!/usr/bin/python2.6
+# cc128archive
+#	Moves the hourly readings of old months into compressed archive blocks,
+#	and those of old years into read-only partition files.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# A month is archived once it ended more than 31 days ago, when no history
+# dump can bring its hours again. Archived readings are still read by the
+# uploader (cc128db.ReadSeries decodes the blocks it needs). Run it from cron,
+# e.g. once a day :
+#	$ ./cc128archive.py -d cc128.db --vacuum
+#
+# With --partition, the blocks of each year whose months are all archived
+# then move to cc128-<year>.db, next to the database. Those files are left
+# read-only: back them up once. The uploader reads them through a
+# cc128db.Router, attaching only the years it reads.
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import cc128db
+
+programVersion = '0.1'
+programName = 'cc128archive'
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-d Filename.db] [--partition] [--vacuum]', version="%s %s" % (programName, programVersion))
+	op.add_option('-d', '--database', metavar='<Filename.db>', help='sqlite file to archive (default: cc128.db)')
+	op.add_option('', '--partition', action='store_true', help='move the past years to one read-only file per year')
+	op.add_option('', '--vacuum', action='store_true', help='rebuild the file afterwards, to give the freed pages back')
+	op.set_defaults(database='cc128.db', partition=False, vacuum=False)
+	options, args = op.parse_args()
+
+	if not os.path.exists(options.database):
+		sys.stderr.write("Error: Can not find database '%s'\n" % options.database)
+		sys.exit(2)
+	size = os.path.getsize(options.database)
+	con = cc128db.Connect(options.database)
+
+	start = time.time()
+	count = cc128db.ArchiveMonths(con)
+	years = []
+	if options.partition:
+		years = cc128db.FreezeYears(con, options.database)
+	if options.vacuum:
+		con.execute('VACUUM')
+	con.close()
+	print "%d hourly readings archived in %.1f s, database %d KB -> %d KB" % (count, time.time() - start,
+		size / 1024, os.path.getsize(options.database) / 1024)
+	for year in years:
+		path = cc128db.PartitionPath(options.database, year)
+		print "%d partitioned to %s (%d KB), read-only" % (year, path, os.path.getsize(path) / 1024)
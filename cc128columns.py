@@ -0,0 +1,297 @@
+#	cc128columns
+#	 Columnar export of the CC128 readings, for analysis.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar export of the CC128 readings, for analysis.
+
+An export directory holds two raw little-endian files per
+(sensor, channel, resolution) series, and a manifest:
+
+  0-0-h.ts       the timestamps, signed 64-bit integers, oldest first
+  0-0-h.kwatt    the values, 64-bit floats (NaN for a missing value)
+  manifest.json  the series, their row count and time range
+
+The files are plain arrays, loaded without a copy: Load maps them with
+numpy.memmap when numpy is installed, and into Columns reading the mapped
+bytes on demand otherwise.  Only the first count rows of a file are valid,
+the manifest being rewritten last.
+
+Export is incremental: a series is read again from REWRITE_SPAN before its
+last exported reading, the span a history dump may still change, and the
+files are only written from the first row that differs.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+
+import cc128db
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# dtype of each column, in the numpy notation, and its struct format.
+COLUMNS = (
+    ('ts', '<i8', 'q'),
+    ('kwatt', '<f8', 'd'),
+)
+
+# How far back a history dump can change readings: h744, d090 and m084 are
+# the oldest tags.
+REWRITE_SPAN = {
+    cc128db.HOURLY: 744 * 3600,
+    cc128db.DAILY: 91 * 86400,
+    cc128db.MONTHLY: 84 * 31 * 86400,
+}
+
+_NAN = float('nan')
+
+
+class Error(Exception):
+  """An export directory that can't be read."""
+
+
+def SeriesName(sensor, channel, resolution):
+  """The file name prefix of a series: '0-0-h'."""
+  return '%d-%d-%s' % (sensor, channel, resolution)
+
+
+def ReadManifest(directory):
+  """Returns the manifest of an export directory, an empty one if none.
+
+  Raises:
+    Error: if the manifest is invalid or of another version.
+  """
+  path = os.path.join(directory, MANIFEST)
+  if not os.path.exists(path):
+    return {'version': FORMAT_VERSION,
+            'columns': dict((name, dtype) for (name, dtype, _) in COLUMNS),
+            'series': {}}
+  f = open(path)
+  try:
+    try:
+      manifest = json.load(f)
+    except ValueError, e:
+      raise Error('%s: %s' % (path, e))
+  finally:
+    f.close()
+  if manifest.get('version') != FORMAT_VERSION:
+    raise Error('%s: unknown version %r' % (path, manifest.get('version')))
+  return manifest
+
+
+def _WriteManifest(directory, manifest):
+  # Written aside then renamed, readers never see half a manifest.
+  path = os.path.join(directory, MANIFEST)
+  f = open(path + '.tmp', 'w')
+  try:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  finally:
+    f.close()
+  os.rename(path + '.tmp', path)
+
+
+def _CommonRows(f, position, data, size):
+  """The number of leading rows of data already in f from position."""
+  f.seek(position * size)
+  stored = f.read(len(data))
+  rows = min(len(stored), len(data)) // size
+  for row in range(rows):
+    start = row * size
+    if stored[start:start + size] != data[start:start + size]:
+      return row
+  return rows
+
+
+def ExportSeries(store, directory, key, entry):
+  """Exports the readings of one series added or changed since entry.
+
+  Args:
+    store: a cc128db.Router
+    directory: the export directory
+    key: the (sensor, channel, resolution) of the series
+    entry: its manifest entry, updated in place
+  Returns:
+    the number of rows written
+  """
+  sensor, channel, resolution = key
+  name = SeriesName(*key)
+  count = entry.get('count', 0)
+  position = 0
+  since = None
+  if count:
+    since = entry['last_ts'] - REWRITE_SPAN.get(resolution, 0)
+    timestamps = Column(os.path.join(directory, name + '.ts'), '<i8', count)
+    try:
+      position = bisect.bisect_left(timestamps, since)
+    finally:
+      timestamps.Close()
+  rows = store.ReadSeries(sensor, channel, resolution, min_ts=since)
+
+  values = {
+      'ts': [ts for (ts, _) in rows],
+      'kwatt': [kwatt is None and _NAN or kwatt for (_, kwatt) in rows],
+  }
+  files = []
+  for (column, dtype, code) in COLUMNS:
+    path = os.path.join(directory, '%s.%s' % (name, column))
+    mode = os.path.exists(path) and 'r+b' or 'w+b'
+    files.append((open(path, mode), struct.calcsize('<' + code),
+                  struct.pack('<%d%s' % (len(rows), code), *values[column])))
+  try:
+    # Rows still stored as exported are left alone; the rows of an
+    # interrupted export, past count, are not trusted.
+    common = min(len(rows), count - position)
+    for (f, size, data) in files:
+      common = min(common, _CommonRows(f, position, data, size))
+    for (f, size, data) in files:
+      f.seek((position + common) * size)
+      f.truncate()
+      f.write(data[common * size:])
+  finally:
+    for (f, _, _) in files:
+      f.close()
+
+  entry.update(sensor=sensor, channel=channel, resolution=resolution,
+               count=position + len(rows))
+  if rows:
+    if not position:
+      entry['first_ts'] = rows[0][0]
+    entry['last_ts'] = rows[-1][0]
+  return len(rows) - common
+
+
+def Export(store, directory):
+  """Exports every series of a database, incrementally.
+
+  Args:
+    store: a cc128db.Router
+    directory: the export directory, created if needed
+  Returns:
+    a (series, rows written) tuple
+  Raises:
+    Error: if the directory holds an invalid manifest.
+  """
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  manifest = ReadManifest(directory)
+  written = 0
+  keys = store.ListSeries()
+  for key in keys:
+    entry = manifest['series'].setdefault(SeriesName(*key), {})
+    written += ExportSeries(store, directory, tuple(key), entry)
+  _WriteManifest(directory, manifest)
+  return (len(keys), written)
+
+
+class Column(object):
+  """A read-only column of an export file, mapped in memory.
+
+  Items are decoded from the mapped bytes when read: indexing, slicing,
+  iteration and bisect work without loading the file.
+  """
+
+  def __init__(self, path, dtype, count):
+    """Maps the first count items of a column file.
+
+    Args:
+      path: the column file
+      dtype: its dtype in COLUMNS
+      count: the number of valid items
+    """
+    for (_, column_dtype, code) in COLUMNS:
+      if column_dtype == dtype:
+        self.code = '<' + code
+    self.size = struct.calcsize(self.code)
+    self.count = count
+    self._map = None
+    if count:
+      f = open(path, 'rb')
+      try:
+        self._map = mmap.mmap(f.fileno(), count * self.size,
+                              access=mmap.ACCESS_READ)
+      finally:
+        f.close()
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(self.count)
+      if step != 1:
+        return self[start:stop][::step]
+      return list(struct.unpack_from(
+          '<%d%s' % (max(0, stop - start), self.code[1]), self._map or '',
+          start * self.size))
+    if index < 0:
+      index += self.count
+    if not 0 <= index < self.count:
+      raise IndexError('column index out of range')
+    return struct.unpack_from(self.code, self._map, index * self.size)[0]
+
+  def __iter__(self):
+    return iter(self[:])
+
+  def Close(self):
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+
+
+def _MapColumn(path, dtype, count, use_numpy):
+  if not use_numpy:
+    return Column(path, dtype, count)
+  import numpy
+  if not count:
+    return numpy.zeros(0, dtype=dtype)
+  return numpy.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+def Load(directory, use_numpy=None):
+  """Maps the columns of every exported series.
+
+  Args:
+    directory: the export directory
+    use_numpy: map the files with numpy.memmap (default: if numpy is
+      installed), or into Columns
+  Returns:
+    a dict mapping (sensor, channel, resolution) to a dict of columns,
+    {'ts': ..., 'kwatt': ...}
+  Raises:
+    Error: if the manifest is missing or invalid.
+  """
+  if not os.path.exists(os.path.join(directory, MANIFEST)):
+    raise Error('%s: no %s' % (directory, MANIFEST))
+  if use_numpy is None:
+    try:
+      import numpy
+      use_numpy = True
+    except ImportError:
+      use_numpy = False
+  manifest = ReadManifest(directory)
+  series = {}
+  for (name, entry) in manifest['series'].items():
+    key = (entry['sensor'], entry['channel'], entry['resolution'])
+    columns = {}
+    for (column, dtype, _) in COLUMNS:
+      path = os.path.join(directory, '%s.%s' % (name, column))
+      columns[column] = _MapColumn(path, dtype, entry['count'], use_numpy)
+    series[key] = columns
+  return series
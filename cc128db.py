@@ -0,0 +1,1126 @@
+#	cc128db
+#	 Storage of CC128 readings in a sqlite database.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage of CC128 readings in a sqlite database.
+
+Every reading lives in the consumption table, keyed by
+(sensor, channel, resolution, ts).  The key is the clustered primary key of
+a WITHOUT ROWID table, so the rows of one sensor/channel/resolution series
+are stored contiguously and a time range of that series is a single b-tree
+range scan.
+
+The instantaneous frames sent every ~6 seconds are kept apart, in the
+instant table, by an InstantStore: readings are packed into blocks of
+integers, only a fixed window of them is kept at full resolution, and older
+blocks are rolled up into hourly consumption rows.
+
+Hourly rows of past months are packed into archive blocks (ArchiveMonths),
+and the rows and blocks of past years can be moved to a partition file per
+year (FreezeYears), which is then left read-only.  A Router reads a series
+across the database and the partitions its time range overlaps.
+"""
+
+import os
+import re
+import struct
+import sqlite3
+import time
+import zlib
+
+# Resolutions, named after the prefix of the CC128 history tags.
+HOURLY = 'h'
+DAILY = 'd'
+MONTHLY = 'm'
+
+# History dumps only report one total per sensor, stored on channel 0;
+# instantaneous frames report up to 3 phases, stored on channels 1 to 3.
+TOTAL_CHANNEL = 0
+MAX_CHANNELS = 3
+
+# The CC128 handles an appliance sensor (#0) and up to 9 IAMs (#1 to #9).
+MAX_SENSORS = 10
+
+# The hNNN history tags of the CC128 are 2-hour blocks, dated by their start:
+# the hourly readings of a sensor total are that far apart.
+HISTORY_STEP = 2 * 3600
+
+# The longest interval between two consecutive readings of a series, in
+# seconds (days and months vary in length, and with daylight saving time;
+# an hour of slack lets a dump dated in the next hour of the host join the
+# previous ones, while a missing block is still a gap).  Readings further
+# apart are separated by a gap in the coverage table.
+MAX_STEP = {
+    HOURLY: HISTORY_STEP + 3600,
+    DAILY: 25 * 3600,
+    MONTHLY: 31 * 86400 + 3600,
+}
+
+# The tables of the readings, also found in partitions.
+CONSUMPTION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS consumption (
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  resolution TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  kwatt REAL,
+  PRIMARY KEY (sensor, channel, resolution, ts)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS consumption_by_time
+  ON consumption (resolution, ts);
+
+CREATE TABLE IF NOT EXISTS archive (
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  resolution TEXT NOT NULL,
+  start_ts INTEGER NOT NULL,
+  end_ts INTEGER NOT NULL,
+  count INTEGER NOT NULL,
+  min_kwatt REAL,
+  max_kwatt REAL,
+  data BLOB NOT NULL,
+  PRIMARY KEY (sensor, channel, resolution, start_ts)
+) WITHOUT ROWID;
+'''
+
+SCHEMA = CONSUMPTION_SCHEMA + '''
+CREATE TABLE IF NOT EXISTS instant (
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  start_ts INTEGER NOT NULL,
+  end_ts INTEGER NOT NULL,
+  count INTEGER NOT NULL,
+  data BLOB NOT NULL,
+  PRIMARY KEY (sensor, channel, start_ts)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS instant_by_end ON instant (end_ts);
+
+CREATE TABLE IF NOT EXISTS rollup (
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  start_ts INTEGER NOT NULL,
+  end_ts INTEGER NOT NULL,
+  ts INTEGER NOT NULL,
+  kwatt REAL NOT NULL,
+  PRIMARY KEY (sensor, channel, start_ts, ts)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS rollup_by_end ON rollup (sensor, channel, end_ts);
+
+CREATE TABLE IF NOT EXISTS spool (
+  directory TEXT NOT NULL PRIMARY KEY,
+  segment INTEGER NOT NULL,
+  offset INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS uploaded (
+  uploader TEXT NOT NULL,
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  resolution TEXT NOT NULL,
+  ts INTEGER NOT NULL,
+  PRIMARY KEY (uploader, sensor, channel, resolution)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS coverage (
+  sensor INTEGER NOT NULL,
+  channel INTEGER NOT NULL,
+  resolution TEXT NOT NULL,
+  start_ts INTEGER NOT NULL,
+  end_ts INTEGER NOT NULL,
+  PRIMARY KEY (sensor, channel, resolution, start_ts)
+) WITHOUT ROWID;
+'''
+
+# The first releases stored a single hourly series keyed on date alone.
+MIGRATE_V1 = '''
+ALTER TABLE consumption RENAME TO consumption_v1;
+%s
+INSERT INTO consumption (sensor, channel, resolution, ts, kwatt)
+  SELECT 0, 0, 'h', date, kwatt FROM consumption_v1;
+DROP TABLE consumption_v1;
+''' % SCHEMA
+
+
+def Connect(filename):
+  """Opens a database, creating or upgrading its schema when needed."""
+  con = sqlite3.connect(filename)
+  CreateSchema(con)
+  return con
+
+
+def CreateSchema(con):
+  """Creates the tables of a new database, or upgrades an old one."""
+  columns = [row[1] for row in con.execute('PRAGMA table_info(consumption)')]
+  has_coverage = con.execute("SELECT 1 FROM sqlite_master "
+                             "WHERE name = 'coverage'").fetchone()
+  if 'date' in columns:
+    con.executescript(MIGRATE_V1)
+  else:
+    con.executescript(SCHEMA)
+  # The coverage was kept by a trigger on every insert, UpdateCoverage does
+  # it now once per batch.
+  con.execute('DROP TRIGGER IF EXISTS coverage_on_insert')
+  if not has_coverage:
+    RebuildCoverage(con)
+  else:
+    MergeCoverage(con)
+  con.commit()
+
+
+def RebuildCoverage(con):
+  """Computes the coverage table again from all the consumption rows.
+
+  The table is kept up to date by UpdateCoverage on every write; this is
+  only needed for databases written before it existed, which have no
+  archived or partitioned rows (those are not read again).
+  """
+  con.execute('DELETE FROM coverage')
+  ranges = []
+  last = None
+  for (sensor, channel, resolution, ts) in con.execute(
+      'SELECT sensor, channel, resolution, ts FROM consumption '
+      'ORDER BY sensor, channel, resolution, ts'):
+    if (last is not None and tuple(last[:3]) == (sensor, channel, resolution) and
+        ts - last[4] <= MAX_STEP.get(resolution, MAX_STEP[MONTHLY])):
+      last[4] = ts
+    else:
+      last = [sensor, channel, resolution, ts, ts]
+      ranges.append(last)
+  con.executemany('INSERT INTO coverage '
+                  '(sensor, channel, resolution, start_ts, end_ts) '
+                  'VALUES (?, ?, ?, ?, ?)', ranges)
+
+
+def MergeCoverage(con):
+  """Joins the ranges of the coverage table that are MAX_STEP apart or less.
+
+  The ranges of databases written while the hourly step was a single hour
+  were cut between every two history blocks.  Only the coverage table is
+  read, so the ranges of archived and partitioned rows are kept.
+
+  Args:
+    con: an open sqlite connection, the caller commits
+  """
+  ranges = con.execute('SELECT sensor, channel, resolution, start_ts, end_ts '
+                       'FROM coverage ORDER BY 1, 2, 3, 4').fetchall()
+  merged = []
+  for (sensor, channel, resolution, start, end) in ranges:
+    last = merged and merged[-1]
+    if (last and tuple(last[:3]) == (sensor, channel, resolution) and
+        start <= last[4] + MAX_STEP.get(resolution, MAX_STEP[MONTHLY])):
+      last[4] = max(last[4], end)
+    else:
+      merged.append([sensor, channel, resolution, start, end])
+  if len(merged) == len(ranges):
+    return
+  con.execute('DELETE FROM coverage')
+  con.executemany('INSERT INTO coverage '
+                  '(sensor, channel, resolution, start_ts, end_ts) '
+                  'VALUES (?, ?, ?, ?, ?)', merged)
+
+
+def UpdateCoverage(con, readings):
+  """Extends the coverage table over readings just stored.
+
+  The ranges of each series near the readings are merged with them and
+  written back; no consumption row is read, so the ranges of archived and
+  partitioned rows are kept.  Readings covered already change nothing.
+
+  Args:
+    con: an open sqlite connection, the caller commits
+    readings: an iterable of (sensor, channel, resolution, ts, kwatt) tuples
+  """
+  series = {}
+  for (sensor, channel, resolution, ts, kwatt) in readings:
+    series.setdefault((sensor, channel, resolution), set()).add(ts)
+  for (key, stamps) in series.items():
+    step = MAX_STEP.get(key[2], MAX_STEP[MONTHLY])
+    stamps = sorted(stamps)
+    ranges = con.execute(
+        'SELECT start_ts, end_ts FROM coverage '
+        'WHERE sensor = ? AND channel = ? AND resolution = ? '
+        'AND start_ts <= ? AND end_ts >= ? ORDER BY start_ts',
+        key + (stamps[-1] + step, stamps[0] - step)).fetchall()
+    merged = []
+    for (start, end) in sorted(ranges + [(ts, ts) for ts in stamps]):
+      if merged and start <= merged[-1][1] + step:
+        merged[-1][1] = max(merged[-1][1], end)
+      else:
+        merged.append([start, end])
+    merged = [tuple(r) for r in merged]
+    if merged == ranges:
+      continue
+    con.executemany('DELETE FROM coverage WHERE sensor = ? AND channel = ? '
+                    'AND resolution = ? AND start_ts = ?',
+                    [key + (start,) for (start, end) in ranges])
+    con.executemany('INSERT INTO coverage '
+                    '(sensor, channel, resolution, start_ts, end_ts) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [key + r for r in merged])
+
+
+def GetUploaded(con, uploader):
+  """Returns how far an uploader got, see SetUploaded.
+
+  Returns:
+    a dict mapping (sensor, channel, resolution) to the timestamp of the
+    last reading uploaded
+  """
+  return dict(((sensor, channel, resolution), ts)
+              for (sensor, channel, resolution, ts) in con.execute(
+                  'SELECT sensor, channel, resolution, ts FROM uploaded '
+                  'WHERE uploader = ?', (uploader,)))
+
+
+def SetUploaded(con, uploader, uploaded, previous):
+  """Stores how far an uploader got, and commits.
+
+  A reading changed once uploaded (a history dump correcting it) sets the
+  series of every uploader back to before it, in the transaction changing
+  it.  A series set back since previous was read keeps that position: the
+  next GetUploaded tells the uploader to read the changed readings again.
+
+  Args:
+    con: an open sqlite connection
+    uploader: the name of the uploader
+    uploaded: a dict mapping (sensor, channel, resolution) to the timestamp
+      of the last reading uploaded
+    previous: what the database held for the uploader, as far as it knows
+  """
+  for (key, ts) in uploaded.items():
+    if key in previous:
+      con.execute('UPDATE uploaded SET ts = ? WHERE uploader = ? '
+                  'AND sensor = ? AND channel = ? AND resolution = ? '
+                  'AND ts = ?', (ts, uploader) + tuple(key) + (previous[key],))
+    else:
+      con.execute('INSERT OR IGNORE INTO uploaded '
+                  '(uploader, sensor, channel, resolution, ts) '
+                  'VALUES (?, ?, ?, ?, ?)', (uploader,) + tuple(key) + (ts,))
+  con.commit()
+
+
+def _RewindUploads(con, key, ts):
+  """Sets the uploads of a series past a changed reading back before it."""
+  con.execute('UPDATE uploaded SET ts = ? WHERE sensor = ? AND channel = ? '
+              'AND resolution = ? AND ts >= ?', (ts - 1,) + tuple(key) + (ts,))
+
+
+def StoreReadings(con, readings):
+  """Stores readings, replacing any previous value with the same key.
+
+  Successive history dumps overlap, so most readings are usually stored
+  already: only new rows and rows whose value changed are written.
+
+  Args:
+    con: an open sqlite connection
+    readings: an iterable of (sensor, channel, resolution, ts, kwatt) tuples
+  Returns:
+    a (inserted, updated, unchanged) tuple of reading counts
+  """
+  readings = list(readings)
+  inserted = con.executemany(
+      'INSERT OR IGNORE INTO consumption '
+      '(sensor, channel, resolution, ts, kwatt) '
+      'VALUES (?, ?, ?, ?, ?)', readings).rowcount
+  # Only the rows whose value changed are updated (the rows just inserted
+  # hold theirs already).  They may have been uploaded already: the uploads
+  # of their series go back to them.
+  series = {}
+  for reading in readings:
+    series.setdefault(reading[:3], []).append(reading)
+  updated = 0
+  for (key, rows) in series.items():
+    stamps = [row[3] for row in rows]
+    stored = dict(con.execute(
+        'SELECT ts, kwatt FROM consumption '
+        'WHERE sensor = ? AND channel = ? AND resolution = ? '
+        'AND ts BETWEEN ? AND ?', key + (min(stamps), max(stamps))))
+    changed = [row for row in rows
+               if row[3] in stored and stored[row[3]] != row[4]]
+    if changed:
+      updated += con.executemany(
+          'UPDATE consumption SET kwatt = ? '
+          'WHERE sensor = ? AND channel = ? AND resolution = ? AND ts = ?',
+          [(kwatt, sensor, channel, resolution, ts)
+           for (sensor, channel, resolution, ts, kwatt) in changed]).rowcount
+      _RewindUploads(con, key, min(row[3] for row in changed))
+  if inserted:
+    UpdateCoverage(con, readings)
+  con.commit()
+  return (inserted, updated, len(readings) - inserted - updated)
+
+
+def GetSensors(con, channel=TOTAL_CHANNEL, resolution=HOURLY):
+  """Returns the sorted list of sensors having data on a channel.
+
+  The coverage table keeps the ranges of every series, including its
+  archived and partitioned rows.
+  """
+  sensors = []
+  # Skip from one sensor to the next instead of scanning every row.
+  row = con.execute('SELECT min(sensor) FROM coverage '
+                    'WHERE channel = ? AND resolution = ?',
+                    (channel, resolution)).fetchone()
+  while row[0] is not None:
+    sensors.append(row[0])
+    row = con.execute('SELECT min(sensor) FROM coverage '
+                      'WHERE sensor > ? AND channel = ? AND resolution = ?',
+                      (row[0], channel, resolution)).fetchone()
+  return sensors
+
+
+def ListSeries(con):
+  """Returns the sorted list of the (sensor, channel, resolution) series."""
+  return con.execute('SELECT DISTINCT sensor, channel, resolution '
+                     'FROM coverage ORDER BY 1, 2, 3').fetchall()
+
+
+def ReadSeries(con, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+               min_ts=None, max_ts=None, schema='main'):
+  """Returns the list of (ts, kwatt) rows of one series, oldest first.
+
+  Rows moved to the archive by ArchiveMonths are read back from the blocks
+  overlapping the time range.  Rows moved to partitions are not read, see
+  Router.ReadSeries.
+
+  Args:
+    con: an open sqlite connection
+    sensor: the sensor number
+    channel: the channel number (default: the sensor total)
+    resolution: one of HOURLY, DAILY or MONTHLY
+    min_ts: if given, the smallest timestamp to return
+    max_ts: if given, the largest timestamp to return
+    schema: the name of the attached database to read
+  """
+  if min_ts is None:
+    min_ts = -2**63
+  if max_ts is None:
+    max_ts = 2**63 - 1
+  rows = con.execute('SELECT ts, kwatt FROM %s.consumption '
+                     'WHERE sensor = ? AND channel = ? AND resolution = ? '
+                     'AND ts BETWEEN ? AND ? ORDER BY ts' % schema,
+                     (sensor, channel, resolution, min_ts, max_ts)).fetchall()
+  archived = ReadArchive(con, sensor, channel, resolution, min_ts, max_ts,
+                         schema)
+  return _MergeRows(archived, rows)
+
+
+def _MergeRows(older, newer):
+  """Merges two lists of (ts, kwatt) rows, those of newer taking precedence.
+
+  Rows stored again after being archived or partitioned are the newer ones.
+  """
+  if not older:
+    return newer
+  if not newer or newer[0][0] > older[-1][0]:
+    return older + newer
+  merged = dict(older)
+  merged.update(newer)
+  return sorted(merged.items())
+
+
+def GetCoverage(con, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+                min_ts=None, max_ts=None):
+  """Returns the ranges of a series without gaps, oldest first.
+
+  Two consecutive readings are in the same range when they are at most
+  MAX_STEP[resolution] seconds apart.
+
+  Args:
+    con: an open sqlite connection
+    sensor: the sensor number
+    channel: the channel number (default: the sensor total)
+    resolution: one of HOURLY, DAILY or MONTHLY
+    min_ts: if given, only the ranges ending at or after it
+    max_ts: if given, only the ranges starting at or before it
+  Returns:
+    a list of (start_ts, end_ts) tuples, the timestamps of the first and
+    last readings of each range
+  """
+  if min_ts is None:
+    min_ts = -2**63
+  if max_ts is None:
+    max_ts = 2**63 - 1
+  # The first range is the one holding min_ts, if any.
+  return con.execute(
+      'SELECT start_ts, end_ts FROM coverage '
+      'WHERE sensor = ?1 AND channel = ?2 AND resolution = ?3 '
+      'AND start_ts BETWEEN coalesce('
+      '  (SELECT max(start_ts) FROM coverage WHERE sensor = ?1 '
+      '   AND channel = ?2 AND resolution = ?3 AND start_ts <= ?4), ?4) '
+      'AND ?5 AND end_ts >= ?4 ORDER BY start_ts',
+      (sensor, channel, resolution, min_ts, max_ts)).fetchall()
+
+
+def GetGaps(con, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+            min_ts=None, max_ts=None):
+  """Returns the gaps of a series, oldest first.
+
+  Args:
+    the same as GetCoverage
+  Returns:
+    a list of (last_ts, next_ts) tuples, the timestamps of the readings
+    before and after each gap
+  """
+  ranges = GetCoverage(con, sensor, channel, resolution, min_ts, max_ts)
+  return [(ranges[i][1], ranges[i + 1][0]) for i in range(len(ranges) - 1)]
+
+
+# Seconds between two instantaneous frames of the CC128.
+FRAME_INTERVAL = 6
+
+# A reading following a longer silence only accounts for one FRAME_INTERVAL,
+# so that a disconnected receiver doesn't count as consumption.
+MAX_FRAME_GAP = 60
+
+# Readings per instant block; a block also ends before any delta that
+# doesn't fit in 16 bits.
+BLOCK_READINGS = 600
+
+
+def PackReadings(readings):
+  """Packs (ts, watts) readings into a block blob.
+
+  The blob holds the timestamp deltas as little-endian 16-bit integers (the
+  first delta is 0, the block start being stored in its row) followed by the
+  watts as little-endian 32-bit integers.
+  """
+  deltas = [0]
+  for i in range(1, len(readings)):
+    deltas.append(readings[i][0] - readings[i - 1][0])
+  watts = [reading[1] for reading in readings]
+  return struct.pack('<%dH%dI' % (len(deltas), len(watts)), *(deltas + watts))
+
+
+def UnpackReadings(start_ts, count, data):
+  """Returns the list of (ts, watts) readings packed by PackReadings."""
+  values = struct.unpack('<%dH%dI' % (count, count), data)
+  readings = []
+  ts = start_ts
+  for i in range(count):
+    ts += values[i]
+    readings.append((ts, values[count + i]))
+  return readings
+
+
+def GetSpoolPosition(con, directory):
+  """Returns the (segment, offset) stored for a spool, or None.
+
+  See cc128spool: a reader storing the spooled records keeps its position
+  in the transactions storing them.
+  """
+  row = con.execute('SELECT segment, offset FROM spool WHERE directory = ?',
+                    (os.path.abspath(directory),)).fetchone()
+  return row and tuple(row)
+
+
+def SetSpoolPosition(con, directory, position):
+  """Stores the position of a spool, committed by the caller."""
+  con.execute('REPLACE INTO spool (directory, segment, offset) '
+              'VALUES (?, ?, ?)',
+              (os.path.abspath(directory),) + tuple(position))
+
+
+def ReadInstant(con, sensor, channel, min_ts=None, max_ts=None):
+  """Returns the list of (ts, watts) instantaneous readings of a channel."""
+  if min_ts is None:
+    min_ts = -2**63
+  if max_ts is None:
+    max_ts = 2**63 - 1
+  readings = []
+  for start_ts, count, data in con.execute(
+      'SELECT start_ts, count, data FROM instant '
+      'WHERE sensor = ? AND channel = ? AND end_ts >= ? AND start_ts <= ? '
+      'ORDER BY start_ts', (sensor, channel, min_ts, max_ts)):
+    for reading in UnpackReadings(start_ts, count, str(data)):
+      if min_ts <= reading[0] <= max_ts:
+        readings.append(reading)
+  return readings
+
+
+def HourlyEnergy(readings, last_ts=None):
+  """Integrates (ts, watts) readings into a {hour ts: kwatt hour} dict.
+
+  Each reading accounts for the time elapsed since the previous one (one
+  FRAME_INTERVAL for the first reading or after a gap) at its power.
+
+  Args:
+    readings: (ts, watts) readings, oldest first
+    last_ts: if given, the time of the reading before them
+  """
+  energy = {}
+  for ts, watts in readings:
+    elapsed = FRAME_INTERVAL
+    if last_ts is not None and ts - last_ts <= MAX_FRAME_GAP:
+      elapsed = ts - last_ts
+    hour = ts - ts % 3600
+    energy[hour] = energy.get(hour, 0.0) + watts * elapsed / 3600000.0
+    last_ts = ts
+  return energy
+
+
+class InstantStore(object):
+  """Buffers instantaneous readings and group-commits them to the database.
+
+  Appended frames are written every batch_frames frames or batch_seconds
+  seconds, whichever comes first.  The readings of each channel go into
+  blocks of up to BLOCK_READINGS readings; the open block is rewritten in
+  place until it is full.  Blocks that ended more than retention seconds ago
+  are rolled up into the hourly consumption rows of their sensor and
+  channel, then deleted.
+
+  The energy of each rolled block is kept per hour in the rollup table, and
+  an hourly row is the sum of the blocks of its hour: rolling a block again
+  replaces its share, the readings of a block rolled already (frames
+  replayed into another block) are not counted twice, and the row is
+  computed again whatever was written to it in between.
+  """
+
+  def __init__(self, con, batch_frames=100, batch_seconds=60,
+               retention=7 * 86400, clock=time.time, on_commit=None):
+    """Creates a store writing to an open database.
+
+    Args:
+      con: an open sqlite connection (see Connect)
+      batch_frames: the number of frames buffered before a commit
+      batch_seconds: the maximum age of a buffered frame, in seconds
+      retention: how long readings are kept at full resolution, in seconds
+      clock: a function returning the current time
+      on_commit: if given, a function called before each commit, writing
+        more in the same transaction (e.g. SetSpoolPosition)
+    """
+    self.con = con
+    self.on_commit = on_commit
+    self.batch_frames = batch_frames
+    self.batch_seconds = batch_seconds
+    self.retention = retention
+    self.clock = clock
+    self.pending = {}  # (sensor, channel) => list of (ts, watts)
+    self.pending_frames = 0
+    self.first_pending = None
+    self.blocks = {}  # (sensor, channel) => readings of the open block
+
+  def Append(self, sensor, ts, watts):
+    """Buffers one instantaneous frame.
+
+    Args:
+      sensor: the sensor number
+      ts: the time of the frame in seconds since the epoch
+      watts: the power of channels 1, 2, 3... (None for a missing channel)
+    """
+    for i in range(len(watts)):
+      if watts[i] is not None:
+        self.pending.setdefault((sensor, i + 1), []).append(
+            (int(ts), int(watts[i])))
+    self.pending_frames += 1
+    now = self.clock()
+    if self.first_pending is None:
+      self.first_pending = now
+    if (self.pending_frames >= self.batch_frames or
+        now - self.first_pending >= self.batch_seconds):
+      self.Flush()
+
+  def Flush(self):
+    """Commits the buffered frames and rolls expired blocks up."""
+    for key, readings in self.pending.items():
+      block = self.blocks.get(key, [])
+      written = bool(block)  # the open block is in the database already
+      for reading in readings:
+        if block and (len(block) >= BLOCK_READINGS or
+                      not 0 <= reading[0] - block[-1][0] < 65536):
+          self._WriteBlock(key, block, written)
+          block = []
+          written = False
+        block.append(reading)
+      self.blocks[key] = self._WriteBlock(key, block, written)
+    self.pending = {}
+    self.pending_frames = 0
+    self.first_pending = None
+    self.Expire()
+    if self.on_commit is not None:
+      self.on_commit()
+    self.con.commit()
+
+  def Expire(self):
+    """Rolls the blocks older than the retention window into consumption."""
+    cutoff = int(self.clock()) - self.retention
+    hours = set()
+    last = {}  # (sensor, channel) => ts of the last reading rolled up
+    for sensor, channel, start_ts, end_ts, count, data in self.con.execute(
+        'SELECT sensor, channel, start_ts, end_ts, count, data FROM instant '
+        'WHERE end_ts < ? ORDER BY sensor, channel, start_ts',
+        (cutoff,)).fetchall():
+      key = (sensor, channel)
+      rolled = self.con.execute(
+          'SELECT DISTINCT start_ts, end_ts FROM rollup '
+          'WHERE sensor = ? AND channel = ? AND end_ts >= ? '
+          'AND start_ts <= ? AND start_ts != ?',
+          (sensor, channel, start_ts, end_ts, start_ts)).fetchall()
+      readings = [(ts, watts) for (ts, watts)
+                  in UnpackReadings(start_ts, count, str(data))
+                  if not [r for r in rolled if r[0] <= ts <= r[1]]]
+      self.con.execute('DELETE FROM rollup WHERE sensor = ? AND channel = ? '
+                       'AND start_ts = ?', (sensor, channel, start_ts))
+      energy = HourlyEnergy(readings, last.get(key))
+      self.con.executemany('INSERT INTO rollup '
+                           '(sensor, channel, start_ts, end_ts, ts, kwatt) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(sensor, channel, start_ts, end_ts, hour, kwatt)
+                            for (hour, kwatt) in energy.items()])
+      hours.update((sensor, channel, hour) for hour in energy)
+      if readings:
+        last[key] = readings[-1][0]
+    rows = []
+    first = {}  # (sensor, channel, HOURLY) => first hour written
+    for (sensor, channel, hour) in sorted(hours):
+      kwatt = self.con.execute(
+          'SELECT sum(kwatt) FROM rollup WHERE sensor = ? AND channel = ? '
+          'AND ts = ?', (sensor, channel, hour)).fetchone()[0]
+      rows.append((sensor, channel, HOURLY, hour, kwatt))
+      first.setdefault((sensor, channel, HOURLY), hour)
+    for (key, hour) in first.items():
+      _RewindUploads(self.con, key, hour)
+    self.con.executemany('REPLACE INTO consumption '
+                         '(sensor, channel, resolution, ts, kwatt) '
+                         'VALUES (?, ?, ?, ?, ?)', rows)
+    UpdateCoverage(self.con, rows)
+    self.con.execute('DELETE FROM instant WHERE end_ts < ?', (cutoff,))
+    for key in self.blocks.keys():
+      if self.blocks[key][-1][0] < cutoff:
+        del self.blocks[key]
+
+  def _WriteBlock(self, key, block, written):
+    """Writes a block of readings.
+
+    A block starting at the same time as a stored one that isn't the open
+    block (frames read again after a restart) is merged with it, the new
+    readings replacing the stored ones of the same time.
+
+    Args:
+      key: the (sensor, channel) of the block
+      block: its (ts, watts) readings
+      written: whether it is the open block, stored by a previous Flush
+    Returns:
+      the readings of the block now open: block, or the merged readings
+    """
+    sensor, channel = key
+    row = (block[-1][0], len(block), sqlite3.Binary(PackReadings(block)),
+           sensor, channel, block[0][0])
+    if written:
+      self.con.execute('UPDATE instant SET end_ts = ?, count = ?, data = ? '
+                       'WHERE sensor = ? AND channel = ? AND start_ts = ?',
+                       row)
+      return block
+    try:
+      self.con.execute('INSERT INTO instant '
+                       '(end_ts, count, data, sensor, channel, start_ts) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', row)
+      return block
+    except sqlite3.IntegrityError:
+      pass
+    count, data = self.con.execute(
+        'SELECT count, data FROM instant '
+        'WHERE sensor = ? AND channel = ? AND start_ts = ?',
+        (sensor, channel, block[0][0])).fetchone()
+    merged = dict(UnpackReadings(block[0][0], count, str(data)))
+    merged.update(block)
+    merged = sorted(merged.items())
+    # The merged readings are split as Flush splits them, the first block
+    # replacing the stored one.
+    blocks = [[]]
+    for reading in merged:
+      if blocks[-1] and (len(blocks[-1]) >= BLOCK_READINGS or
+                         reading[0] - blocks[-1][-1][0] >= 65536):
+        blocks.append([])
+      blocks[-1].append(reading)
+    opened = self._WriteBlock(key, blocks[0], True)
+    for block in blocks[1:]:
+      opened = self._WriteBlock(key, block, False)
+    return opened
+
+
+# Hourly rows of a month are archived once the month ended that long ago:
+# history dumps (h004 to h744) can't bring them again.
+ARCHIVE_AGE = 31 * 86400
+
+# Archived values that are a whole number of thousandths of a kWh (the
+# CC128 sends tenths and hundredths) are stored as fixed-point integers.
+ARCHIVE_SCALE = 1000
+
+# The 'X' block encoding of NULL values, a NaN no computation returns.
+_NULL_BITS = 0x7ff8dead00000000
+
+
+def PackArchive(rows):
+  """Packs (ts, kwatt) rows, sorted by ts, into an archive block blob.
+
+  The block is zlib-compressed.  It starts with its value encoding:
+    'F': the timestamps as delta-of-deltas (signed 32-bit), then the values
+         times ARCHIVE_SCALE (signed 64-bit);
+    'X': the timestamps likewise, then the IEEE bits of each value XOR-ed
+         with those of the previous one (unsigned 64-bit), for values that
+         aren't fixed-point.
+  Regular series become runs of zeros, which zlib squeezes away.
+  """
+  count = len(rows)
+  dods = []
+  last_ts = rows[0][0]
+  last_delta = 0
+  for ts, _ in rows:
+    delta = ts - last_ts
+    dods.append(delta - last_delta)
+    last_ts, last_delta = ts, delta
+
+  values = [kwatt for _, kwatt in rows]
+  fixed = []
+  for kwatt in values:
+    if kwatt is None:
+      break
+    scaled = int(round(kwatt * ARCHIVE_SCALE))
+    if scaled / float(ARCHIVE_SCALE) != kwatt:
+      break
+    fixed.append(scaled)
+  if len(fixed) == count:
+    body = 'F' + struct.pack('<%di%dq' % (count, count), *(dods + fixed))
+  else:
+    bits = list(struct.unpack('<%dQ' % count, struct.pack(
+        '<%dd' % count, *[kwatt or 0.0 for kwatt in values])))
+    for i in range(count):
+      if values[i] is None:
+        bits[i] = _NULL_BITS
+    xors = [bits[0]] + [bits[i] ^ bits[i - 1] for i in range(1, count)]
+    body = 'X' + struct.pack('<%di%dQ' % (count, count), *(dods + xors))
+  return zlib.compress(body, 9)
+
+
+def UnpackArchive(start_ts, count, data):
+  """Returns the list of (ts, kwatt) rows packed by PackArchive."""
+  body = zlib.decompress(data)
+  kind = body[0]
+  if kind == 'F':
+    numbers = struct.unpack('<%di%dq' % (count, count), body[1:])
+  else:
+    numbers = struct.unpack('<%di%dQ' % (count, count), body[1:])
+  if count <= 2 or numbers[2:count].count(0) == count - 2:
+    # A regular series, the usual case.
+    step = count > 1 and numbers[1] or 1
+    timestamps = range(start_ts, start_ts + count * step, step)
+  else:
+    timestamps = []
+    ts = start_ts
+    delta = 0
+    for dod in numbers[:count]:
+      delta += dod
+      ts += delta
+      timestamps.append(ts)
+  if kind == 'F':
+    scale = float(ARCHIVE_SCALE)
+    values = [value / scale for value in numbers[count:]]
+  else:
+    values = []
+    value = 0
+    for change in numbers[count:]:
+      value ^= change
+      values.append(value)
+    nulls = [i for i in range(count) if values[i] == _NULL_BITS]
+    values = list(struct.unpack('<%dd' % count,
+                                struct.pack('<%dQ' % count, *values)))
+    for i in nulls:
+      values[i] = None
+  return zip(timestamps, values)
+
+
+def ReadArchive(con, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+                min_ts=None, max_ts=None, schema='main'):
+  """Returns the list of archived (ts, kwatt) rows of a series, oldest first.
+
+  Only the blocks overlapping the time range are decoded.
+  """
+  if min_ts is None:
+    min_ts = -2**63
+  if max_ts is None:
+    max_ts = 2**63 - 1
+  rows = []
+  for start_ts, count, data in con.execute(
+      'SELECT start_ts, count, data FROM %s.archive '
+      'WHERE sensor = ? AND channel = ? AND resolution = ? '
+      'AND end_ts >= ? AND start_ts <= ? ORDER BY start_ts' % schema,
+      (sensor, channel, resolution, min_ts, max_ts)):
+    block = UnpackArchive(start_ts, count, str(data))
+    if block[0][0] < min_ts or block[-1][0] > max_ts:
+      block = [row for row in block if min_ts <= row[0] <= max_ts]
+    rows.extend(block)
+  return rows
+
+
+def _MonthStart(ts, months=0):
+  """The local time of the first day of the month of ts, plus months."""
+  year, month = time.localtime(ts)[:2]
+  month += months - 1
+  return int(time.mktime((year + month // 12, month % 12 + 1, 1,
+                          0, 0, 0, 0, 0, -1)))
+
+
+def ArchiveMonths(con, now=None):
+  """Moves the hourly rows of old months into compressed archive blocks.
+
+  Every (sensor, channel) series gets one block per month that ended more
+  than ARCHIVE_AGE ago; rows of a month stored again after it was archived
+  are merged into its block.  Daily and monthly rows are few and stay in
+  the consumption table.
+
+  Args:
+    con: an open sqlite connection
+    now: the current time (default: time.time())
+  Returns:
+    the number of rows archived
+  """
+  if now is None:
+    now = time.time()
+  cutoff = _MonthStart(now - ARCHIVE_AGE)
+  months = {}  # (sensor, channel, month start) => list of (ts, kwatt)
+  for sensor, channel, ts, kwatt in con.execute(
+      'SELECT sensor, channel, ts, kwatt FROM consumption '
+      'WHERE resolution = ? AND ts < ? ORDER BY sensor, channel, ts',
+      (HOURLY, cutoff)):
+    months.setdefault((sensor, channel, _MonthStart(ts)), []).append(
+        (ts, kwatt))
+
+  for (sensor, channel, month), rows in months.items():
+    key = (sensor, channel, HOURLY)
+    _WriteArchiveBlock(con, key, month, rows)
+    con.execute('DELETE FROM consumption WHERE sensor = ? AND channel = ? '
+                'AND resolution = ? AND ts BETWEEN ? AND ?',
+                key + (month, _MonthStart(month, 1) - 1))
+  con.commit()
+  return sum([len(rows) for rows in months.values()])
+
+
+def _WriteArchiveBlock(con, key, month, rows, schema='main'):
+  """Writes the block of a month, merging rows into any previous one."""
+  sensor, channel, resolution = key
+  month_end = _MonthStart(month, 1)
+  rows = _MergeRows(ReadArchive(con, sensor, channel, resolution,
+                                month, month_end - 1, schema), rows)
+  values = [kwatt for _, kwatt in rows if kwatt is not None]
+  extremes = (None, None)
+  if values:
+    extremes = (min(values), max(values))
+  con.execute('DELETE FROM %s.archive WHERE sensor = ? AND channel = ? '
+              'AND resolution = ? AND start_ts BETWEEN ? AND ?' % schema,
+              key + (month, month_end - 1))
+  con.execute('INSERT INTO %s.archive (sensor, channel, resolution, '
+              'start_ts, end_ts, count, min_kwatt, max_kwatt, data) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % schema,
+              key + (rows[0][0], rows[-1][0], len(rows)) + extremes +
+              (sqlite3.Binary(PackArchive(rows)),))
+
+
+# Attached databases are limited to 10 by default, sqlite build option.
+MAX_ATTACHED = 8
+
+# Bytes of a frozen partition a Router reads through a memory map.
+PARTITION_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def PartitionPath(filename, year):
+  """The file of the partition of a year: cc128.db => cc128-2010.db."""
+  root, ext = os.path.splitext(filename)
+  return '%s-%04d%s' % (root, year, ext)
+
+
+def ListPartitions(filename):
+  """Returns the sorted list of the years having a partition file."""
+  root, ext = os.path.splitext(filename)
+  directory, prefix = os.path.split(root)
+  pattern = re.compile(r'%s-(\d{4})%s$' % (re.escape(prefix), re.escape(ext)))
+  years = []
+  for name in os.listdir(directory or os.curdir):
+    match = pattern.match(name)
+    if match:
+      years.append(int(match.group(1)))
+  return sorted(years)
+
+
+def _YearStart(year):
+  """The local time of the first day of a year."""
+  return int(time.mktime((year, 1, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def FreezeYears(con, filename, now=None):
+  """Moves the hourly rows and blocks of past years to partition files.
+
+  A year is partitioned once all its months are archived (see ArchiveMonths,
+  which should run first).  Each year gets its own file, next to the
+  database, holding the consumption and archive tables; the file is then
+  compacted and made read-only, so that it can be backed up once and
+  memory-mapped by a Router.  Rows of a year stored again later are merged
+  into its partition by the next call.  The coverage table stays in the
+  database and still describes the partitioned rows.
+
+  Args:
+    con: an open sqlite connection to filename
+    filename: path of the database
+    now: the current time (default: time.time())
+  Returns:
+    the list of the years written
+  """
+  if now is None:
+    now = time.time()
+  last_year = time.localtime(_MonthStart(now - ARCHIVE_AGE)).tm_year - 1
+  cutoff = _YearStart(last_year + 1)
+  first = con.execute(
+      'SELECT min(ts) FROM (SELECT min(ts) AS ts FROM consumption '
+      '  WHERE resolution = ?1 AND ts < ?2 '
+      '  UNION ALL SELECT min(start_ts) FROM archive '
+      '  WHERE resolution = ?1 AND start_ts < ?2)',
+      (HOURLY, cutoff)).fetchone()[0]
+  if first is None:
+    return []
+
+  years = []
+  for year in range(time.localtime(first).tm_year, last_year + 1):
+    start, end = _YearStart(year), _YearStart(year + 1) - 1
+    blocks = con.execute('SELECT sensor, channel, start_ts, count, data '
+                         'FROM archive WHERE resolution = ? '
+                         'AND start_ts BETWEEN ? AND ?',
+                         (HOURLY, start, end)).fetchall()
+    has_rows = con.execute('SELECT 1 FROM consumption WHERE resolution = ? '
+                           'AND ts BETWEEN ? AND ? LIMIT 1',
+                           (HOURLY, start, end)).fetchone()
+    if not blocks and not has_rows:
+      continue
+
+    path = PartitionPath(filename, year)
+    if os.path.exists(path):
+      os.chmod(path, 0644)
+    part = sqlite3.connect(path)
+    part.executescript(CONSUMPTION_SCHEMA)
+    part.close()
+    con.commit()
+    con.execute('ATTACH DATABASE ? AS frozen', (path,))
+    try:
+      for sensor, channel, start_ts, count, data in blocks:
+        _WriteArchiveBlock(con, (sensor, channel, HOURLY),
+                           _MonthStart(start_ts),
+                           UnpackArchive(start_ts, count, str(data)), 'frozen')
+      con.execute('INSERT OR REPLACE INTO frozen.consumption '
+                  'SELECT * FROM main.consumption WHERE resolution = ? '
+                  'AND ts BETWEEN ? AND ?', (HOURLY, start, end))
+      con.execute('DELETE FROM main.archive WHERE resolution = ? '
+                  'AND start_ts BETWEEN ? AND ?', (HOURLY, start, end))
+      con.execute('DELETE FROM main.consumption WHERE resolution = ? '
+                  'AND ts BETWEEN ? AND ?', (HOURLY, start, end))
+      con.commit()
+    finally:
+      con.rollback()
+      con.execute('DETACH DATABASE frozen')
+
+    part = sqlite3.connect(path)
+    part.execute('VACUUM')
+    part.close()
+    os.chmod(path, 0444)
+    years.append(year)
+  return years
+
+
+class Router(object):
+  """Reads the series of a database and of its yearly partitions.
+
+  A partition is only attached when a read overlaps its year, and kept
+  attached for the next reads, up to max_attached partitions (the least
+  recently read ones are detached first).  Partitions are read-only and
+  read through a memory map.  GetSensors and GetCoverage only need the
+  database.
+  """
+
+  def __init__(self, filename, max_attached=MAX_ATTACHED,
+               mmap_size=PARTITION_MMAP_SIZE):
+    """Opens the database and lists its partitions.
+
+    Args:
+      filename: path of the database
+      max_attached: the most partitions attached at once
+      mmap_size: bytes of each partition to memory-map
+    """
+    self.filename = filename
+    self.con = Connect(filename)
+    self.max_attached = max_attached
+    self.mmap_size = mmap_size
+    self.years = ListPartitions(filename)
+    self._attached = []  # years, the least recently read first
+
+  def Refresh(self):
+    """Lists the partitions again, after FreezeYears ran elsewhere."""
+    self.years = ListPartitions(self.filename)
+    for year in list(self._attached):
+      if year not in self.years:
+        self._Detach(year)
+
+  def Close(self):
+    self.con.close()
+
+  def GetSensors(self, channel=TOTAL_CHANNEL, resolution=HOURLY):
+    """Returns the sorted list of sensors having data on a channel."""
+    return GetSensors(self.con, channel, resolution)
+
+  def ListSeries(self):
+    """Returns the sorted list of the (sensor, channel, resolution) series."""
+    return ListSeries(self.con)
+
+  def GetCoverage(self, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+                  min_ts=None, max_ts=None):
+    """Returns the ranges of a series without gaps, see GetCoverage."""
+    return GetCoverage(self.con, sensor, channel, resolution, min_ts, max_ts)
+
+  def ReadSeries(self, sensor, channel=TOTAL_CHANNEL, resolution=HOURLY,
+                 min_ts=None, max_ts=None):
+    """Returns the list of (ts, kwatt) rows of one series, oldest first.
+
+    The same as ReadSeries, with the rows of the partitions overlapping the
+    time range; rows of the database take precedence.
+    """
+    partitioned = []
+    for year in self.years:
+      if ((max_ts is not None and _YearStart(year) > max_ts) or
+          (min_ts is not None and _YearStart(year + 1) <= min_ts)):
+        continue
+      partitioned.extend(ReadSeries(self.con, sensor, channel, resolution,
+                                    min_ts, max_ts, self._Attach(year)))
+    rows = ReadSeries(self.con, sensor, channel, resolution, min_ts, max_ts)
+    return _MergeRows(partitioned, rows)
+
+  def _Attach(self, year):
+    """Attaches the partition of a year if needed, returns its schema name."""
+    schema = 'p%04d' % year
+    if year in self._attached:
+      self._attached.remove(year)
+    else:
+      if len(self._attached) >= self.max_attached:
+        self._Detach(self._attached[0])
+      self.con.execute('ATTACH DATABASE ? AS %s' % schema,
+                       (PartitionPath(self.filename, year),))
+      self.con.execute('PRAGMA %s.mmap_size = %d' % (schema, self.mmap_size))
+    self._attached.append(year)
+    return schema
+
+  def _Detach(self, year):
+    self._attached.remove(year)
+    self.con.execute('DETACH DATABASE p%04d' % year)
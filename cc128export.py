@@ -0,0 +1,61 @@
+#!/usr/bin/python2.6
+# cc128export
+#	Exports the readings into memory-mappable columns, for analysis.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Each series gets a file of timestamps and a file of values, raw
+# little-endian arrays described by manifest.json (see cc128columns.py).
+# Running it again only writes what changed since, e.g. from cron :
+#	$ ./cc128export.py -d cc128.db -o export
+# then, in python :
+#	>>> series = cc128columns.Load('export')
+#	>>> series[(0, 0, 'h')]['kwatt'].mean()	# a numpy.memmap, if installed
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import cc128columns
+import cc128db
+
+programVersion = '0.1'
+programName = 'cc128export'
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-d Filename.db] [-o directory]', version="%s %s" % (programName, programVersion))
+	op.add_option('-d', '--database', metavar='<Filename.db>', help='sqlite file to export (default: cc128.db)')
+	op.add_option('-o', '--output', metavar='<directory>', help='export directory, created if needed (default: export)')
+	op.set_defaults(database='cc128.db', output='export')
+	options, args = op.parse_args()
+
+	if not os.path.exists(options.database):
+		sys.stderr.write("Error: Can not find database '%s'\n" % options.database)
+		sys.exit(2)
+
+	start = time.time()
+	# read through the router : partitioned years are exported too
+	store = cc128db.Router(options.database)
+	try:
+		(series, written) = cc128columns.Export(store, options.output)
+	except cc128columns.Error, e:
+		sys.stderr.write("Error: %s\n" % e)
+		sys.exit(1)
+	finally:
+		store.Close()
+	print "%d series exported to %s, %d rows written in %.1f s" % (series, options.output, written, time.time() - start)
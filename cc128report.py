@@ -0,0 +1,89 @@
+#!/usr/bin/python2.6
+# cc128report
+#	Prints the statistics of each sensor: consumption by hour of the day,
+#	standby baseline, peak hours and totals per period.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# The series are read from the database (through cc128db.Router), or from
+# an export of cc128export.py with -e, mapped without copy (see
+# cc128stats.py; numpy makes it much faster when installed) :
+#	$ ./cc128report.py -d cc128.db --period month --last 12
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import cc128columns
+import cc128db
+import cc128stats
+
+programVersion = '0.1'
+programName = 'cc128report'
+
+def formatKwh(kwh):
+	if kwh == None:
+		return '-'
+	return '%.2f' % kwh
+
+def printSummary(sensor, summary, options):
+	print "sensor #%d: %d hourly readings" % (sensor, summary.readings)
+	if not summary.readings:
+		return
+	print "  baseline      %s kW" % formatKwh(summary.baseline)
+	print "  peak hours    %s" % ', '.join(["%02d:00 (%s kWh)" % (hour, formatKwh(kwh)) for (hour, kwh) in summary.peak_hours])
+	print "  by hour (kWh) %s" % ' '.join([formatKwh(kwh) for kwh in summary.daily_profile])
+	for (start, kwh, hours, change) in summary.periods[-options.last:]:
+		delta = ''
+		if change != None:
+			delta = '%+.1f' % change
+		print "  %s %10.1f kWh %8s  (%d h)" % (time.strftime('%Y-%m-%d', time.localtime(start)), kwh, delta, hours)
+
+if __name__ == '__main__':
+	op = OptionParser('%prog [-d Filename.db | -e directory] [--period day|week|month] [-s sensor ...]', version="%s %s" % (programName, programVersion))
+	op.add_option('-d', '--database', metavar='<Filename.db>', help='sqlite file to read (default: cc128.db)')
+	op.add_option('-e', '--export', metavar='<directory>', help='read an export of cc128export.py instead of the database')
+	op.add_option('-s', '--sensor', type='int', action='append', metavar='<n>', help='only report this sensor (repeatable, default: all)')
+	op.add_option('', '--period', type='choice', choices=cc128stats.PERIODS, help='period of the totals, day, week or month (default: week)')
+	op.add_option('', '--last', type='int', metavar='<n>', help='number of periods printed (default: 8)')
+	op.set_defaults(database='cc128.db', period=cc128stats.WEEK, last=8)
+	options, args = op.parse_args()
+
+	start = time.time()
+	if options.export:
+		try:
+			series = cc128columns.Load(options.export)
+		except cc128columns.Error, e:
+			sys.stderr.write("Error: %s\n" % e)
+			sys.exit(2)
+		sensors = sorted(set([sensor for (sensor, channel, resolution) in series if channel == cc128db.TOTAL_CHANNEL and resolution == cc128db.HOURLY]))
+		read = lambda sensor: cc128stats.ReadExport(series, sensor)
+	else:
+		if not os.path.exists(options.database):
+			sys.stderr.write("Error: Can not find database '%s'\n" % options.database)
+			sys.exit(2)
+		store = cc128db.Router(options.database)
+		sensors = store.GetSensors()
+		read = lambda sensor: cc128stats.ReadStore(store, sensor)
+
+	for sensor in sensors:
+		if options.sensor and sensor not in options.sensor:
+			continue
+		(hourly, daily) = read(sensor)
+		printSummary(sensor, cc128stats.Analyze(hourly, daily, options.period), options)
+	sys.stderr.write("%d sensors in %.2f s\n" % (len(sensors), time.time() - start))
@@ -0,0 +1,514 @@
+#	cc128sinks
+#	 Batched outputs of the CC128 readings: the meter service, files, sockets.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Batched outputs of the CC128 readings.
+
+A sink receives the readings as batches of columns, a dict of parallel
+lists keyed by COLUMNS, and has three methods:
+
+  WriteBatch(columns)  takes a batch (and may keep it until Flush)
+  Flush()              makes the batches written so far durable or sent
+  Close()              flushes and releases the sink
+
+ServiceSink posts them to a google_meter.Service as durational
+measurements; FileSink appends them to a CSV or NDJSON file;
+LineProtocolSink sends them to a local InfluxDB (or Telegraf) listener in
+line protocol; SqliteSink stores them in another cc128db database.
+
+ReadBatches reads the series of a database once, and Fanout writes each
+batch to several sinks, each in its own thread: a slow or unreachable sink
+doesn't hold the others back, only the reads once its queue is full.
+Fanout keeps how far each sink went, advanced when its Flush succeeds: the
+batches a sink failed to write are read again for it alone.
+"""
+
+import os
+import Queue
+import threading
+
+import cc128db
+import google_meter
+
+# The keys of a batch, each a list with one item per reading.  kwatt is
+# None for a missing value.
+COLUMNS = ('sensor', 'channel', 'resolution', 'ts', 'kwatt')
+
+BATCH_ROWS = 5000
+
+
+class Error(Exception):
+  """Some sinks of a Fanout failed.
+
+  Attributes:
+    errors: a list of (sink, exception) tuples
+  """
+
+  def __init__(self, errors):
+    Exception.__init__(self, '; '.join('%s: %s' % (sink.__class__.__name__, e)
+                                       for (sink, e) in errors))
+    self.errors = errors
+
+
+def _Rows(columns):
+  """The (sensor, channel, resolution, ts, kwatt) rows of a batch."""
+  return zip(*[columns[name] for name in COLUMNS])
+
+
+def ReadBatches(store, since=None, batch_rows=BATCH_ROWS):
+  """Reads every series of a database, as batches of columns.
+
+  Args:
+    store: a cc128db.Router
+    since: if given, a dict mapping (sensor, channel, resolution) to the
+      timestamp of the last reading already read; only later readings are
+      read, and the dict is updated as the batches are read
+    batch_rows: the most readings of a batch
+  Yields:
+    dicts of columns, the readings of each series oldest first
+  """
+  batch = dict((name, []) for name in COLUMNS)
+  for key in store.ListSeries():
+    key = tuple(key)
+    last = None
+    if since is not None:
+      last = since.get(key)
+    sensor, channel, resolution = key
+    for (ts, kwatt) in store.ReadSeries(sensor, channel, resolution,
+                                        min_ts=last):
+      if ts == last:
+        continue
+      batch['sensor'].append(sensor)
+      batch['channel'].append(channel)
+      batch['resolution'].append(resolution)
+      batch['ts'].append(ts)
+      batch['kwatt'].append(kwatt)
+      if since is not None:
+        since[key] = ts
+      if len(batch['ts']) >= batch_rows:
+        yield batch
+        batch = dict((name, []) for name in COLUMNS)
+  if batch['ts']:
+    yield batch
+
+
+def HourlyMeasurements(variable, rows, time_uncertainty=1,
+                       uncertainty=0.001, measurements=None):
+  """The measurements of the hourly readings of a sensor total.
+
+  Each reading is a history block of the CC128, the energy of the
+  cc128db.HISTORY_STEP seconds it starts, so it is the measurement of
+  those; a next reading sooner than that (dumps dated an hour apart) ends
+  it, so that the measurements don't overlap.  The first reading after a
+  gap is a measurement too, and a block sent again (its value corrected)
+  replaces itself on the service, which keys the measurements by their
+  start time.  Missing values are not measurements.
+
+  Args:
+    variable: the variable of the sensor
+    rows: its (ts, kwatt) hourly readings, oldest first, kwatt None for a
+      missing value
+    time_uncertainty: the uncertainty of the times, in seconds
+    uncertainty: the uncertainty of the readings, in kWh
+    measurements: the google_meter.DurMeasurementColumns to append to
+  Returns:
+    measurements, or new google_meter.DurMeasurementColumns
+  """
+  if measurements is None:
+    measurements = google_meter.DurMeasurementColumns()
+  starts = []
+  ends = []
+  kwhs = []
+  for i in range(len(rows)):
+    ts, kwatt = rows[i]
+    if kwatt is None:
+      continue
+    end = ts + cc128db.HISTORY_STEP
+    if i + 1 < len(rows):
+      end = min(end, rows[i + 1][0])
+    starts.append(ts)
+    ends.append(end)
+    kwhs.append(kwatt)
+  measurements.AppendSeries(variable, starts, ends, kwhs, time_uncertainty,
+                            time_uncertainty, uncertainty)
+  return measurements
+
+
+class ServiceSink(object):
+  """Posts the hourly totals of the sensors to a google_meter.Service.
+
+  The hourly readings of the sensor totals become measurements as in
+  HourlyMeasurements.  They are kept until Flush posts them, and dropped if
+  the post fails: a Fanout writes them again.
+  """
+
+  def __init__(self, service, variables, time_uncertainty=1,
+               uncertainty=0.001):
+    """Initializes a ServiceSink.
+
+    Args:
+      service: a google_meter.Service
+      variables: a dict mapping sensor numbers to their variable, the
+        readings of other sensors are ignored
+      time_uncertainty: the uncertainty of the times, in seconds
+      uncertainty: the uncertainty of the readings, in kWh
+    """
+    self.service = service
+    self.variables = variables
+    self.time_uncertainty = time_uncertainty
+    self.uncertainty = uncertainty
+    self.pending = google_meter.DurMeasurementColumns()
+
+  def WriteBatch(self, columns):
+    rows = {}
+    for (sensor, channel, resolution, ts, kwatt) in _Rows(columns):
+      if (channel == cc128db.TOTAL_CHANNEL and resolution == cc128db.HOURLY
+          and sensor in self.variables):
+        rows.setdefault(sensor, []).append((ts, kwatt))
+    for sensor in sorted(rows):
+      HourlyMeasurements(self.variables[sensor], rows[sensor],
+                         self.time_uncertainty, self.uncertainty,
+                         self.pending)
+
+  def Flush(self):
+    """Posts the pending measurements.
+
+    Raises:
+      IOError: if the post failed, the measurements are dropped.
+    """
+    pending, self.pending = self.pending, google_meter.DurMeasurementColumns()
+    if pending:
+      self.service.BatchPostEvents(pending)
+
+  def Close(self):
+    self.Flush()
+
+
+class FileSink(object):
+  """Appends the readings to a CSV or NDJSON file.
+
+  CSV files start with a header line, written when the file is created;
+  missing values are empty fields in CSV and null in NDJSON.
+  """
+
+  FORMATS = ('csv', 'ndjson')
+
+  def __init__(self, filename, format='csv', sync=True):
+    """Opens a file for appending.
+
+    Args:
+      filename: the file, created if needed
+      format: 'csv' or 'ndjson'
+      sync: whether Flush waits for the data to reach the disk (fsync)
+    Raises:
+      ValueError: for an unknown format.
+    """
+    if format not in self.FORMATS:
+      raise ValueError('unknown format %r' % format)
+    self.filename = filename
+    self.format = format
+    self.sync = sync
+    self.f = open(filename, 'ab')
+    self.f.seek(0, os.SEEK_END)
+    if format == 'csv' and not self.f.tell():
+      self.f.write(','.join(COLUMNS) + '\n')
+
+  def WriteBatch(self, columns):
+    lines = []
+    if self.format == 'csv':
+      for (sensor, channel, resolution, ts, kwatt) in _Rows(columns):
+        lines.append('%d,%d,%s,%d,%s\n' % (
+            sensor, channel, resolution, ts,
+            kwatt is not None and repr(kwatt) or ''))
+    else:
+      for (sensor, channel, resolution, ts, kwatt) in _Rows(columns):
+        lines.append('{"sensor": %d, "channel": %d, "resolution": "%s", '
+                     '"ts": %d, "kwatt": %s}\n' % (
+                         sensor, channel, resolution, ts,
+                         kwatt is not None and repr(kwatt) or 'null'))
+    self.f.write(''.join(lines))
+
+  def Flush(self):
+    self.f.flush()
+    if self.sync:
+      os.fsync(self.f.fileno())
+
+  def Close(self):
+    self.Flush()
+    self.f.close()
+
+
+class LineProtocolSink(object):
+  """Sends the readings in InfluxDB line protocol to a local listener.
+
+  One line per reading, the series as tags and nanosecond timestamps:
+
+    consumption,channel=0,resolution=h,sensor=0 kwatt=0.45 1286002800000000000
+
+  Missing values are not sent.  Over UDP, lines are grouped in datagrams of
+  at most max_datagram bytes; over TCP they are streamed on one connection,
+  opened again after an error.
+  """
+
+  def __init__(self, host='127.0.0.1', port=8089, transport='udp',
+               measurement='consumption', max_datagram=8192):
+    """Initializes a LineProtocolSink.
+
+    Args:
+      host, port: the address of the listener
+      transport: 'udp' or 'tcp'
+      measurement: the measurement name of the lines
+      max_datagram: the most bytes of a UDP datagram
+    Raises:
+      ValueError: for an unknown transport.
+    """
+    if transport not in ('udp', 'tcp'):
+      raise ValueError('unknown transport %r' % transport)
+    self.address = (host, port)
+    self.transport = transport
+    self.measurement = measurement
+    self.max_datagram = max_datagram
+    self.sock = None
+
+  def WriteBatch(self, columns):
+    lines = ['%s,channel=%d,resolution=%s,sensor=%d kwatt=%r %d000000000\n' % (
+        self.measurement, channel, resolution, sensor, float(kwatt), ts)
+             for (sensor, channel, resolution, ts, kwatt) in _Rows(columns)
+             if kwatt is not None]
+    if not lines:
+      return
+    import socket
+    if self.transport == 'tcp':
+      if self.sock is None:
+        self.sock = socket.create_connection(self.address)
+      try:
+        self.sock.sendall(''.join(lines))
+      except socket.error:
+        self.sock.close()
+        self.sock = None
+        raise
+      return
+    if self.sock is None:
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packet, size = [], 0
+    for line in lines:
+      if packet and size + len(line) > self.max_datagram:
+        self.sock.sendto(''.join(packet), self.address)
+        packet, size = [], 0
+      packet.append(line)
+      size += len(line)
+    self.sock.sendto(''.join(packet), self.address)
+
+  def Flush(self):
+    pass  # lines are sent as soon as written
+
+  def Close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+
+class SqliteSink(object):
+  """Stores the readings in another cc128db database.
+
+  The database is opened by the first WriteBatch, in the thread writing
+  the batches (sqlite connections stay in their thread).  Each batch is
+  stored and committed with cc128db.StoreReadings.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.con = None
+    self.counts = [0, 0, 0]  # inserted, updated, unchanged
+
+  def WriteBatch(self, columns):
+    if self.con is None:
+      self.con = cc128db.Connect(self.filename)
+    counts = cc128db.StoreReadings(self.con, _Rows(columns))
+    self.counts = [total + count for (total, count) in zip(self.counts, counts)]
+
+  def Flush(self):
+    pass  # every batch is committed
+
+  def Close(self):
+    if self.con is not None:
+      self.con.close()
+      self.con = None
+
+
+_STOP = object()
+
+
+class Fanout(object):
+  """Writes the same batches to several sinks concurrently.
+
+  Each sink gets a thread and a queue of at most queue_batches batches;
+  WriteBatch only blocks when a queue is full.  The sinks share the
+  batches, they must not change them.  The exceptions raised by the sinks
+  are collected and raised together, as an Error, by the next Flush or
+  Close.
+
+  Each sink is only written the readings after its position, the last
+  reading of each series it flushed.  A sink that failed is written
+  nothing more until the next Flush, and its position stays where it was:
+  read from Since, the next batches give it what it missed, while the other
+  sinks skip the readings they have.
+
+  Attributes:
+    positions: for each sink, a dict mapping (sensor, channel, resolution)
+      to the timestamp of the last reading it flushed
+  """
+
+  def __init__(self, sinks, queue_batches=4):
+    """Starts a thread per sink.
+
+    Args:
+      sinks: the sinks
+      queue_batches: the most batches waiting for each sink
+    """
+    self.sinks = list(sinks)
+    self.positions = [{} for sink in self.sinks]
+    self._written = [{} for sink in self.sinks]
+    self._failed = [False for sink in self.sinks]
+    self._queues = []
+    self._threads = []
+    self._errors = []
+    self._lock = threading.Lock()
+    for (index, sink) in enumerate(self.sinks):
+      queue = Queue.Queue(queue_batches)
+      thread = threading.Thread(target=self._Run, args=(index, queue),
+                                name='sink-%s' % sink.__class__.__name__)
+      thread.setDaemon(True)
+      thread.start()
+      self._queues.append(queue)
+      self._threads.append(thread)
+
+  def _Run(self, index, queue):
+    while True:
+      method, args = queue.get()
+      try:
+        if method is _STOP:
+          return
+        try:
+          method(index, *args)
+        except Exception, e:
+          self._lock.acquire()
+          try:
+            self._errors.append((self.sinks[index], e))
+          finally:
+            self._lock.release()
+      finally:
+        queue.task_done()
+
+  def _Call(self, method, *args):
+    for queue in self._queues:
+      queue.put((method, args))
+
+  def _Wait(self):
+    """Waits for the sinks to be done, raises their errors."""
+    for queue in self._queues:
+      queue.join()
+    self._lock.acquire()
+    try:
+      errors, self._errors = self._errors, []
+    finally:
+      self._lock.release()
+    if errors:
+      raise Error(errors)
+
+  def _WriteBatch(self, index, columns):
+    if self._failed[index]:
+      return
+    positions = self.positions[index]
+    written = self._written[index]
+    rows = []
+    for (i, key) in enumerate(zip(columns['sensor'], columns['channel'],
+                                  columns['resolution'])):
+      last = written.get(key, positions.get(key))
+      if last is None or columns['ts'][i] > last:
+        rows.append(i)
+        written[key] = columns['ts'][i]
+    if not rows:
+      return
+    if len(rows) < len(columns['ts']):
+      columns = dict((name, [columns[name][i] for i in rows])
+                     for name in COLUMNS)
+    try:
+      self.sinks[index].WriteBatch(columns)
+    except Exception:
+      self._failed[index] = True
+      raise
+
+  def _Flush(self, index):
+    written, self._written[index] = self._written[index], {}
+    if self._failed[index]:
+      self._failed[index] = False  # written again from its position
+      return
+    self.sinks[index].Flush()
+    self.positions[index].update(written)
+
+  def _Close(self, index):
+    self.sinks[index].Close()
+
+  def Since(self):
+    """Where to read the next batches from, for ReadBatches.
+
+    Only call it after a Flush: the sinks are idle then.
+
+    Returns:
+      a dict mapping (sensor, channel, resolution) to the timestamp of the
+      last reading every sink flushed; the series a sink has not flushed
+      anything of are missing.
+    """
+    since = {}
+    if self.positions:
+      since.update(self.positions[0])
+    for positions in self.positions[1:]:
+      for (key, ts) in since.items():
+        if key in positions:
+          since[key] = min(ts, positions[key])
+        else:
+          del since[key]
+    return since
+
+  def WriteBatch(self, columns):
+    self._Call(self._WriteBatch, columns)
+
+  def Flush(self):
+    """Flushes every sink, once the batches written so far are written.
+
+    The positions of the sinks that flushed are advanced.
+
+    Raises:
+      Error: if some sinks failed since the last Flush.
+    """
+    self._Call(self._Flush)
+    self._Wait()
+
+  def Close(self):
+    """Closes every sink and stops the threads.
+
+    Raises:
+      Error: if some sinks failed.
+    """
+    self._Call(self._Close)
+    try:
+      self._Wait()
+    finally:
+      self._Call(_STOP)
+      for thread in self._threads:
+        thread.join()
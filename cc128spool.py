@@ -0,0 +1,350 @@
+#	cc128spool
+#	 Crash-safe spool of the raw lines read from the CC128 ports.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Crash-safe spool of the raw lines read from the CC128 ports.
+
+The acquisition appends every line it reads to a Spool, and the stage
+decoding and storing them reads it back with a SpoolReader: reading the
+ports never waits on the database, and the lines outlive a crash of
+either side.
+
+A spool is a directory of segment files of segment_size bytes, 00000001.spool
+and on, each mapped in memory and filled with records:
+
+  length     uint32, the bytes of the line (0: not written yet,
+             0xffffffff: the records go on in the next segment)
+  crc        uint32, the CRC-32 of base, time and line
+  base       int32, the first sensor number of the port
+  time       float64, when the line was read
+  line       the raw bytes
+
+The length is written last, so a reader never sees half a record.  The
+reader checkpoints the position of the last record it is done with in a
+checkpoint file, and deletes the segments before it; after a restart it
+replays the records from there.  A reader storing the records in a
+database rather keeps its position there, in the transaction storing them,
+and gives it back when it opens the spool.  A writer restarting after a
+crash goes on after the last valid record of the last segment.
+"""
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# The most segments of a spool: past that, Append drops the lines until the
+# reader catches up.
+MAX_SEGMENTS = 256
+
+CHECKPOINT = 'checkpoint'
+
+# Seconds between two looks at the spool of a reader waiting for records.
+POLL_INTERVAL = 0.1
+
+_LENGTH = struct.Struct('<I')
+_HEADER = struct.Struct('<IIid')
+_CONTINUED = 0xffffffff
+
+
+def _SegmentPath(directory, number):
+  return os.path.join(directory, '%08d.spool' % number)
+
+
+def _ListSegments(directory):
+  """The sorted numbers of the segments of a spool."""
+  numbers = []
+  for name in os.listdir(directory):
+    if name.endswith('.spool') and name[:-6].isdigit():
+      numbers.append(int(name[:-6]))
+  numbers.sort()
+  return numbers
+
+
+def _MapSegment(directory, number, size=None, access=mmap.ACCESS_WRITE):
+  """Maps a segment, created with size bytes if size is given.
+
+  Returns:
+    the map, or None if the segment is still empty (being created)
+  """
+  path = _SegmentPath(directory, number)
+  if size is not None:
+    f = open(path, 'w+b')
+    f.truncate(size)
+  elif access == mmap.ACCESS_READ:
+    f = open(path, 'rb')
+  else:
+    f = open(path, 'r+b')
+  try:
+    length = os.fstat(f.fileno()).st_size
+    if not length:
+      return None
+    return mmap.mmap(f.fileno(), length, access=access)
+  finally:
+    f.close()
+
+
+def _Crc(base, read_time, line):
+  return zlib.crc32(struct.pack('<id', base, read_time) + line) & 0xffffffff
+
+
+def _ReadRecord(segment, offset):
+  """Decodes the record at an offset of a mapped segment.
+
+  Returns:
+    a (base, time, line, next offset) tuple, _CONTINUED if the records go
+    on in the next segment, or None if there is no valid record there (not
+    written yet, or torn by a crash)
+  """
+  if offset + _LENGTH.size > len(segment):
+    return _CONTINUED
+  length = _LENGTH.unpack_from(segment, offset)[0]
+  if length == _CONTINUED:
+    return _CONTINUED
+  end = offset + _HEADER.size + length
+  if not length or end > len(segment):
+    return None
+  (_, crc, base, read_time) = _HEADER.unpack_from(segment, offset)
+  line = segment[offset + _HEADER.size:end]
+  if crc != _Crc(base, read_time, line):
+    return None
+  return (base, read_time, line, end)
+
+
+class Spool(object):
+  """The writing end of a spool, appending records to its last segment."""
+
+  def __init__(self, directory, segment_size=SEGMENT_SIZE,
+               max_segments=MAX_SEGMENTS):
+    """Opens a spool, creating it if needed.
+
+    Args:
+      directory: the spool directory
+      segment_size: the bytes of the new segments
+      max_segments: the most segments before lines are dropped
+    """
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.segment_size = segment_size
+    self.max_segments = max_segments
+    numbers = _ListSegments(directory)
+    if numbers:
+      self.number = numbers[-1]
+      self.segment = _MapSegment(directory, self.number)
+      if self.segment is None:  # crashed while creating it
+        self.segment = _MapSegment(directory, self.number, segment_size)
+      self.offset = self._Recover()
+    else:
+      self.number = 1
+      self.segment = _MapSegment(directory, self.number, segment_size)
+      self.offset = 0
+
+  def _Recover(self):
+    """Finds the end of the valid records, clears a torn one after them."""
+    offset = 0
+    while True:
+      record = _ReadRecord(self.segment, offset)
+      if record is None:
+        break
+      if record is _CONTINUED:
+        # Crashed right after ending the segment, before the next one.
+        self.offset = len(self.segment)
+        self._Rotate()
+        return 0
+      offset = record[3]
+    if self.segment[offset:].strip('\0'):
+      self.segment[offset:] = '\0' * (len(self.segment) - offset)
+    return offset
+
+  def _Rotate(self):
+    """Ends the current segment and starts the next one."""
+    if self.offset + _LENGTH.size <= len(self.segment):
+      self.segment[self.offset:self.offset + _LENGTH.size] = _LENGTH.pack(
+          _CONTINUED)
+    self.segment.close()
+    self.number += 1
+    self.segment = _MapSegment(self.directory, self.number, self.segment_size)
+    self.offset = 0
+
+  def Append(self, base, read_time, line):
+    """Appends a line.
+
+    Args:
+      base: the first sensor number of the port it was read from
+      read_time: when it was read, in seconds since the epoch
+      line: the raw line
+    Returns:
+      False if the spool is full and the line was dropped, True otherwise.
+      Empty lines are not spooled.
+    Raises:
+      ValueError: if the line is longer than a segment.
+    """
+    if not line:
+      return True  # a length of 0 would end the records
+    size = _HEADER.size + len(line)
+    if size + _LENGTH.size > self.segment_size:
+      raise ValueError('line of %d bytes longer than a segment' % len(line))
+    # Room is kept for the mark of the end of the segment.
+    if self.offset + size + _LENGTH.size > len(self.segment):
+      if len(_ListSegments(self.directory)) >= self.max_segments:
+        return False
+      self._Rotate()
+    end = self.offset + size
+    self.segment[self.offset + _LENGTH.size:end] = (
+        _HEADER.pack(0, _Crc(base, read_time, line), base,
+                     read_time)[_LENGTH.size:] + line)
+    self.segment[self.offset:self.offset + _LENGTH.size] = _LENGTH.pack(
+        len(line))
+    self.offset = end
+    return True
+
+  def Sync(self):
+    """Writes the appended records to the disk (a crash of the process
+    loses nothing already, this is for a crash of the system)."""
+    self.segment.flush()
+
+  def Close(self):
+    self.segment.flush()
+    self.segment.close()
+
+
+class SpoolReader(object):
+  """The reading end of a spool, from its checkpoint on.
+
+  Attributes:
+    position: the (segment, offset) of the next record to read
+  """
+
+  def __init__(self, directory, position=None):
+    """Opens a spool at a position, its checkpoint, or its first record.
+
+    An unreadable checkpoint (a crash of the system while writing it) reads
+    the spool from its first record.
+
+    Args:
+      directory: the spool directory, created if needed
+      position: if given, the (segment, offset) to read from, rather than
+        the checkpoint
+    """
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.position = (1, 0)
+    path = os.path.join(directory, CHECKPOINT)
+    if position is not None:
+      self.position = tuple(position)
+    elif os.path.exists(path):
+      f = open(path)
+      try:
+        try:
+          number, offset = f.read().split()
+          self.position = (int(number), int(offset))
+        except ValueError:
+          pass
+      finally:
+        f.close()
+    numbers = _ListSegments(directory)
+    if numbers and numbers[0] > self.position[0]:
+      self.position = (numbers[0], 0)
+    self.segment = None
+
+  def _Map(self):
+    """Maps the segment of the position, False if it isn't there yet."""
+    if self.segment is None:
+      if not os.path.exists(_SegmentPath(self.directory, self.position[0])):
+        return False
+      self.segment = _MapSegment(self.directory, self.position[0],
+                                 access=mmap.ACCESS_READ)
+    return self.segment is not None
+
+  def _Next(self):
+    """Returns the next record, moving to the next segments as needed.
+
+    Returns:
+      a ((segment, offset) after it, base, time, line) tuple, or None
+    """
+    while self._Map():
+      number, offset = self.position
+      record = _ReadRecord(self.segment, offset)
+      if record is None:
+        # Nothing more in the last segment; a later segment means this one
+        # was cut short by a crash.
+        if not [n for n in _ListSegments(self.directory) if n > number]:
+          return None
+        record = _CONTINUED
+      if record is _CONTINUED:
+        numbers = [n for n in _ListSegments(self.directory) if n > number]
+        if not numbers:
+          return None
+        self.segment.close()
+        self.segment = None
+        self.position = (numbers[0], 0)
+        continue
+      base, read_time, line, end = record
+      self.position = (number, end)
+      return (self.position, base, read_time, line)
+    return None
+
+  def Read(self, max_records=100, timeout=0):
+    """Reads the next records, waiting for some up to timeout seconds.
+
+    Returns:
+      a list of ((segment, offset) after the record, base, time, line)
+      tuples, oldest first, empty if none came in time
+    """
+    deadline = time.time() + timeout
+    records = []
+    while True:
+      while len(records) < max_records:
+        record = self._Next()
+        if record is None:
+          break
+        records.append(record)
+      if records or time.time() >= deadline:
+        return records
+      time.sleep(POLL_INTERVAL)
+
+  def Commit(self, position):
+    """Checkpoints a position returned by Read, the records before it being
+    done with: they are not read again, and their segments are deleted."""
+    path = os.path.join(self.directory, CHECKPOINT)
+    f = open(path + '.tmp', 'w')
+    try:
+      f.write('%d %d\n' % position)
+      f.flush()
+      os.fsync(f.fileno())
+    finally:
+      f.close()
+    os.rename(path + '.tmp', path)
+    # The rename is on the disk before any segment is deleted.
+    fd = os.open(self.directory, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    for number in _ListSegments(self.directory):
+      if number < position[0]:
+        os.remove(_SegmentPath(self.directory, number))
+
+  def Close(self):
+    if self.segment is not None:
+      self.segment.close()
+      self.segment = None
@@ -0,0 +1,402 @@
+#	cc128stats
+#	 Statistics of the stored consumption series.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Statistics of the stored consumption series.
+
+Analyze summarizes the hourly readings of a sensor: its mean consumption
+by hour of the day and of the week, its standby baseline, its peak hours
+and its totals per day, week or month with the change from the previous
+period.  Day totals come from the daily readings (the CC128's own rollups)
+when there are some, from the hourly ones otherwise.
+
+An hourly reading of a sensor total is a history block of the CC128, the
+energy of the cc128db.HISTORY_STEP seconds it starts: the statistics share
+it evenly between the hours of that block, so that a day of 12 blocks is a
+day of 24 hours.
+
+The series are whole columns, read in bulk from a cc128db.Router or from a
+cc128columns export.  With numpy, each statistic is a few array operations
+(bincount, reduceat, searchsorted) over all the readings; without it the
+same results are computed in plain Python, more slowly.
+
+Hours and days are local time.  The UTC offset of each reading is looked up
+in a table of the offset changes over the range of the series, computed
+once per range.
+"""
+
+import bisect
+import calendar
+import collections
+import itertools
+import time
+
+import cc128db
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+PERIODS = (DAY, WEEK, MONTH)
+
+# Days with fewer hours covered by readings (10 history blocks) don't count
+# for the baseline: their minimum may miss the night.
+MIN_DAY_HOURS = 20
+
+# The first local day (1970-01-01) was a Thursday; weeks start on Monday.
+_EPOCH_WEEKDAY = 3
+
+Summary = collections.namedtuple('Summary', (
+    'readings',        # number of hourly readings
+    'daily_profile',   # mean kWh of each hour of the day, 0 to 23
+    'weekly_profile',  # 7 daily profiles, Monday first
+    'baseline',        # standby consumption, in kWh per hour (= kW)
+    'peak_hours',      # (hour, mean kWh) of the busiest hours, busiest first
+    'periods',         # (start ts, kWh, hours, change from the previous)
+))
+
+_transitions = {}  # (first day, last day) => (starts, offsets)
+
+
+def _Numpy():
+  """Returns the numpy module, or None if it isn't installed."""
+  try:
+    import numpy
+  except ImportError:
+    return None
+  return numpy
+
+
+def _UtcOffset(ts):
+  return calendar.timegm(time.localtime(ts)) - int(ts)
+
+
+def _Transitions(min_ts, max_ts):
+  """Returns the UTC offset changes between two times.
+
+  Returns:
+    a (starts, offsets) tuple of lists: offsets[i] applies from starts[i]
+    on, starts[0] being min_ts rounded down to the day.
+  """
+  first, last = int(min_ts) // 86400, int(max_ts) // 86400 + 1
+  if (first, last) not in _transitions:
+    starts = [first * 86400]
+    offsets = [_UtcOffset(starts[0])]
+    for day in range(first + 1, last + 1):
+      offset = _UtcOffset(day * 86400)
+      if offset != offsets[-1]:
+        # The change happened within the last day, find its second.
+        low, high = (day - 1) * 86400, day * 86400
+        while high - low > 1:
+          middle = (low + high) // 2
+          if _UtcOffset(middle) == offsets[-1]:
+            low = middle
+          else:
+            high = middle
+        starts.append(high)
+        offsets.append(offset)
+    _transitions[(first, last)] = (starts, offsets)
+  return _transitions[(first, last)]
+
+
+def _SpreadBlocks(ts, kwatt):
+  """Shares the hourly readings between the hours they cover.
+
+  A reading covers the cc128db.HISTORY_STEP seconds it starts, up to the
+  next reading if that is sooner (as the measurements uploaded do), and at
+  least an hour.
+
+  Args:
+    ts: the timestamps of a series, sorted
+    kwatt: its values, None or NaN when missing
+  Returns:
+    the (ts, kwatt) columns of the hours, as arrays (with numpy) or lists
+  """
+  numpy = _Numpy()
+  if numpy is not None:
+    ts = numpy.asarray(ts, dtype=numpy.int64)
+    kwatt = numpy.asarray(kwatt, dtype=numpy.float64)
+    if not len(ts):
+      return ts, kwatt
+    ends = numpy.minimum(ts + cc128db.HISTORY_STEP,
+                         numpy.append(ts[1:], ts[-1] + cc128db.HISTORY_STEP))
+    spans = numpy.maximum((ends - ts) // 3600, 1)
+    firsts = numpy.cumsum(spans) - spans
+    hours = numpy.arange(spans.sum()) - numpy.repeat(firsts, spans)
+    return (numpy.repeat(ts, spans) + hours * 3600,
+            numpy.repeat(kwatt / spans, spans))
+
+  hour_ts = []
+  hour_kwatt = []
+  for i in range(len(ts)):
+    end = ts[i] + cc128db.HISTORY_STEP
+    if i + 1 < len(ts):
+      end = min(end, ts[i + 1])
+    span = max(int(end - ts[i]) // 3600, 1)
+    for hour in range(span):
+      hour_ts.append(ts[i] + hour * 3600)
+      if kwatt[i] is None:
+        hour_kwatt.append(None)
+      else:
+        hour_kwatt.append(kwatt[i] / float(span))
+  return hour_ts, hour_kwatt
+
+
+def _LocalTimes(ts, kwatt):
+  """Drops the missing values, shifts the timestamps to local time.
+
+  Args:
+    ts: the timestamps of a series, sorted
+    kwatt: its values, None or NaN when missing
+  Returns:
+    a (local seconds, kwatt) tuple of arrays (with numpy) or of lists
+  """
+  numpy = _Numpy()
+  if numpy is not None:
+    ts = numpy.asarray(ts, dtype=numpy.int64)
+    kwatt = numpy.asarray(kwatt, dtype=numpy.float64)
+    present = ~numpy.isnan(kwatt)
+    ts, kwatt = ts[present], kwatt[present]
+    if not len(ts):
+      return ts, kwatt
+    starts, offsets = _Transitions(ts[0], ts[-1])
+    shift = numpy.asarray(offsets)[
+        numpy.searchsorted(starts, ts, side='right') - 1]
+    return ts + shift, kwatt
+
+  rows = [(t, k) for (t, k) in itertools.izip(ts, kwatt)
+          if k is not None and k == k]
+  if not rows:
+    return [], []
+  starts, offsets = _Transitions(rows[0][0], rows[-1][0])
+  return ([t + offsets[bisect.bisect_right(starts, t) - 1] for (t, _) in rows],
+          [k for (_, k) in rows])
+
+
+def _GroupSums(keys, values, size):
+  """Returns the (sums, counts) lists of values by integer key."""
+  numpy = _Numpy()
+  if numpy is not None:
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    return (numpy.bincount(keys, weights=values, minlength=size).tolist(),
+            numpy.bincount(keys, minlength=size).tolist())
+  sums = [0.0] * size
+  counts = [0] * size
+  for (key, value) in itertools.izip(keys, values):
+    sums[key] += value
+    counts[key] += 1
+  return sums, counts
+
+
+def _Means(sums, counts):
+  means = []
+  for (total, count) in zip(sums, counts):
+    if count:
+      means.append(total / count)
+    else:
+      means.append(None)
+  return means
+
+
+def DailyProfile(local, kwatt):
+  """Returns the mean kWh of each hour of the day, None for hours without data.
+
+  Args:
+    local, kwatt: the columns returned by _LocalTimes
+  """
+  numpy = _Numpy()
+  if numpy is not None:
+    hours = local // 3600 % 24
+  else:
+    hours = [t // 3600 % 24 for t in local]
+  return _Means(*_GroupSums(hours, kwatt, 24))
+
+
+def WeeklyProfile(local, kwatt):
+  """Returns 7 lists of the mean kWh of each hour, Monday first."""
+  numpy = _Numpy()
+  if numpy is not None:
+    hours = (local // 86400 + _EPOCH_WEEKDAY) % 7 * 24 + local // 3600 % 24
+  else:
+    hours = [(t // 86400 + _EPOCH_WEEKDAY) % 7 * 24 + t // 3600 % 24
+             for t in local]
+  means = _Means(*_GroupSums(hours, kwatt, 7 * 24))
+  return [means[day * 24:day * 24 + 24] for day in range(7)]
+
+
+def Baseline(local, kwatt):
+  """Returns the standby consumption, in kWh per hour.
+
+  That's the median of the lowest hour of each day with at least
+  MIN_DAY_HOURS hours, or None if there is no such day.
+  """
+  numpy = _Numpy()
+  if numpy is not None:
+    if not len(local):
+      return None
+    days = local // 86400
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(days)) + 1))
+    counts = numpy.diff(numpy.concatenate((starts, [len(days)])))
+    lowest = numpy.minimum.reduceat(kwatt, starts)[counts >= MIN_DAY_HOURS]
+    if not len(lowest):
+      return None
+    return float(numpy.median(lowest))
+
+  lowest = []
+  for (_, rows) in itertools.groupby(itertools.izip(local, kwatt),
+                                     lambda row: row[0] // 86400):
+    values = [k for (_, k) in rows]
+    if len(values) >= MIN_DAY_HOURS:
+      lowest.append(min(values))
+  if not lowest:
+    return None
+  lowest.sort()
+  middle = len(lowest) // 2
+  if len(lowest) % 2:
+    return lowest[middle]
+  return (lowest[middle - 1] + lowest[middle]) / 2.0
+
+
+def PeakHours(daily_profile, count=3):
+  """Returns the (hour, mean kWh) of the count busiest hours of the day."""
+  hours = [(kwh, hour) for (hour, kwh) in enumerate(daily_profile)
+           if kwh is not None]
+  hours.sort(reverse=True)
+  return [(hour, kwh) for (kwh, hour) in hours[:count]]
+
+
+def _DayStart(day):
+  """The timestamp of the local midnight starting a day number."""
+  return int(time.mktime(time.gmtime(day * 86400)[:3] + (0, 0, 0, 0, 0, -1)))
+
+
+def _PeriodKey(day, period):
+  if period == DAY:
+    return day
+  if period == WEEK:
+    return (day + _EPOCH_WEEKDAY) // 7
+  year, month = time.gmtime(day * 86400)[:2]
+  return year * 12 + month - 1
+
+
+def PeriodTotals(local, kwatt, daily=None, period=WEEK):
+  """Returns the consumption of each period, with its change.
+
+  Args:
+    local, kwatt: the columns of the hours returned by _LocalTimes
+    daily: the (local, kwatt) columns of the daily readings, if any; a day
+      having one is counted as 24 hours of that total
+    period: DAY, WEEK or MONTH
+  Returns:
+    a list of (start ts, kWh, hours, change) tuples, oldest first: the
+    local time the period starts, its consumption, the hours it has
+    readings of, and the kWh more than in the previous period (None for
+    the first one).
+  """
+  if period not in PERIODS:
+    raise ValueError('unknown period %r' % period)
+  days = []
+  if len(local):
+    days.extend([local[0] // 86400, local[-1] // 86400])
+  if daily is not None and len(daily[0]):
+    days.extend([daily[0][0] // 86400, daily[0][-1] // 86400])
+  if not days:
+    return []
+  first, last = min(days), max(days)
+
+  numpy = _Numpy()
+  if numpy is not None:
+    sums, counts = _GroupSums(local // 86400 - first, kwatt, last - first + 1)
+  else:
+    sums, counts = _GroupSums([t // 86400 - first for t in local], kwatt,
+                              last - first + 1)
+  if daily is not None:
+    # The rollups of the CC128 take precedence over the sums of the hours.
+    for (t, kwh) in itertools.izip(*daily):
+      sums[t // 86400 - first] = kwh
+      counts[t // 86400 - first] = 24
+
+  periods = []
+  for day in range(first, last + 1):
+    key = _PeriodKey(day, period)
+    if not periods or periods[-1][0] != key:
+      periods.append([key, _DayStart(day), 0.0, 0])
+    if counts[day - first]:
+      periods[-1][2] += sums[day - first]
+      periods[-1][3] += counts[day - first]
+  totals = []
+  previous = None
+  for (_, start, kwh, hours) in periods:
+    change = None
+    if previous is not None:
+      change = kwh - previous
+    totals.append((start, kwh, hours, change))
+    previous = kwh
+  return totals
+
+
+def Analyze(hourly, daily=None, period=WEEK, peaks=3):
+  """Summarizes the readings of a sensor.
+
+  Args:
+    hourly: the (ts, kwatt) columns of its hourly readings, oldest first
+    daily: the (ts, kwatt) columns of its daily readings, or None
+    period: the periods of the totals, DAY, WEEK or MONTH
+    peaks: the number of peak hours
+  Returns:
+    a Summary
+  """
+  local, kwatt = _LocalTimes(*_SpreadBlocks(*hourly))
+  if daily is not None:
+    daily = _LocalTimes(*daily)
+  profile = DailyProfile(local, kwatt)
+  return Summary(
+      readings=len([k for k in hourly[1] if k is not None and k == k]),
+      daily_profile=profile,
+      weekly_profile=WeeklyProfile(local, kwatt),
+      baseline=Baseline(local, kwatt),
+      peak_hours=PeakHours(profile, peaks),
+      periods=PeriodTotals(local, kwatt, daily, period))
+
+
+def _Columns(rows):
+  """Splits (ts, kwatt) rows into a (ts, kwatt) tuple of lists."""
+  return ([ts for (ts, _) in rows], [kwatt for (_, kwatt) in rows])
+
+
+def ReadStore(store, sensor, channel=cc128db.TOTAL_CHANNEL, min_ts=None,
+              max_ts=None):
+  """Returns the (hourly, daily) columns of a series of a cc128db.Router.
+
+  daily is None when the series has no daily readings.
+  """
+  hourly = _Columns(store.ReadSeries(sensor, channel, cc128db.HOURLY,
+                                     min_ts, max_ts))
+  daily = store.ReadSeries(sensor, channel, cc128db.DAILY, min_ts, max_ts)
+  return hourly, daily and _Columns(daily) or None
+
+
+def ReadExport(series, sensor, channel=cc128db.TOTAL_CHANNEL):
+  """Returns the (hourly, daily) columns of a series of a cc128columns export.
+
+  Args:
+    series: the dict returned by cc128columns.Load
+  """
+  columns = []
+  for resolution in (cc128db.HOURLY, cc128db.DAILY):
+    found = series.get((sensor, channel, resolution))
+    columns.append(found and (found['ts'], found['kwatt']) or None)
+  return columns[0] or ([], []), columns[1]
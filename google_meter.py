@@ -25,28 +25,48 @@ To batch-post events, create a Service object and call BatchPostEvents on
 a list of event objects.
 
 To retrieve entities and events, create a Service object and call GetEntity,
-GetEntities, GetEvent, or GetEvents.
+GetEntities, GetEvent, or GetEvents.  Pass the Service an EntityCache to keep
+the entities it gets, revalidated with conditional requests once stale.
+
+To collect request and batch metrics, pass the Service a Metrics object,
+optionally with a sink (PrometheusFileSink, StatsdSink or SnapshotSink).
 """
 
+import array
+import bisect
+import os
 import posixpath
 import re
-import socket
 import sys
 import time
-import urllib
-import urlparse
-import xml.sax
 
 import rfc3339
 import units
 
+# multiprocessing, socket, threading, urlparse, xml.sax and zlib are imported
+# by the functions needing them: scripts that only build events or read their
+# settings don't pay for loading them.  array is imported above: a small
+# extension module, which DurMeasurementColumns is made of.
+
 
 # The location of the standard Google Meter service.
 DEFAULT_URI_PREFIX = 'https://www.google.com/powermeter/feeds'
 
-# Max number of events we'll post at a time.
+# Number of events we'll post at a time, at first (see BatchSizer).
 MAX_BATCH_POST_COUNT = 100
 
+# HTTP status codes telling us to slow down.
+THROTTLE_STATUS_CODES = (429, 503)
+
+# Patterns matched in every reply.
+_STATUS_OK_RE = re.compile(r' 2\d\d ')
+_STATUS_NOT_MODIFIED_RE = re.compile(r' 304 ')
+_STATUS_THROTTLE_RE = re.compile(
+    r' (%s) ' % '|'.join([str(code) for code in THROTTLE_STATUS_CODES]))
+_STATUS_CODE_RE = re.compile(r' (\d\d\d) ')
+_HEADERS_END_RE = re.compile('\n\r?\n')
+_GZIP_ENCODING_RE = re.compile(r'(?im)^content-encoding:\s*gzip\s*$')
+
 # XML namespace attributes for the Google Meter API.
 XMLNS_ATTRIBUTES = (' xmlns="http://www.w3.org/2005/Atom"'
                     ' xmlns:meter="http://schemas.google.com/meter/2008"')
@@ -57,6 +77,19 @@ def HtmlEscape(text):
   return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;')
 
 
+def Gzip(data):
+  """Compresses data in the gzip format (Content-Encoding: gzip)."""
+  import zlib
+  compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+def Gunzip(data):
+  """Decompresses gzip-compressed data."""
+  import zlib
+  return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
 def IncludeIfTrue(flag, string):
   """Returns the given string or an empty string, depending on the flag."""
   if flag:
@@ -91,6 +124,7 @@ def GetPathComponents(uri_or_path):
 def ParseEntries(content):
   """Parses any <entry> elements in the given XML document into a list of
   entity or event objects."""
+  import xml.sax
   handler = GdataHandler()
   xml.sax.parseString(content, handler)
   results = []
@@ -137,13 +171,16 @@ def ParseEntries(content):
   return results
 
 
-class GdataHandler(xml.sax.ContentHandler):
+class GdataHandler(object):
   """A simple SAX ContentHandler that turns the contents of each <entry>
   element into a flat dictionary of key-value pairs.  Each child element
   becomes a key in the dictionary, with its character content as the value.
   Each attribute of a child element becomes another key in the dictionary
   in the form "element/attribute", with the attribute value as the value.
-  After parsing, the list of dictionaries is available in self.entries."""
+  After parsing, the list of dictionaries is available in self.entries.
+
+  It implements the xml.sax.ContentHandler interface without deriving from
+  it, so that xml.sax is only imported by ParseEntries."""
 
   def __init__(self):
     self.entries = []
@@ -172,25 +209,233 @@ class GdataHandler(xml.sax.ContentHandler):
     elif name == self.field:  # end of an element inside an <entry>
       self.entry[self.field] = self.content
 
+  def _Ignore(self, *args):
+    pass
+
+  setDocumentLocator = startDocument = endDocument = _Ignore
+  startPrefixMapping = endPrefixMapping = _Ignore
+  ignorableWhitespace = processingInstruction = skippedEntity = _Ignore
+
 
 class Log(object):
   """A logging service with a configurable level of detail."""
 
-  def __init__(self, level=1, outfile=sys.stderr):
+  def __init__(self, level=1, outfile=sys.stderr, autoflush=True):
     """Creates an instance of the logging service.
 
     Args:
       level: a number indicating the logging level (higher means more messages)
       outfile: a file object to which log messages will be written
+      autoflush: a flag, true to flush outfile after each message
     """
     self.level = level
     self.outfile = outfile
+    self.autoflush = autoflush
+
+  def IsEnabled(self, level):
+    """Returns true if messages of the given level are written out."""
+    return self.level >= level
 
-  def Log(self, level, message):
-    """Writes out a log message if its level is low enough for this Log."""
+  def Log(self, level, message, *args):
+    """Writes out a log message if its level is low enough for this Log.
+
+    The message is only formatted with args (message % args) when it is
+    written out, so that messages of disabled levels cost nothing.
+    """
     if self.level >= level:
+      if args:
+        message = message % args
       self.outfile.write(message + '\n')
-      self.outfile.flush()
+      if self.autoflush:
+        self.outfile.flush()
+
+
+# Upper bounds of the histogram buckets (the last bucket is unbounded).
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100,
+                   500, 1000, 5000, 10000, 50000, 100000)
+
+
+class Histogram(object):
+  """Counts of observed values per bucket, with their count and sum."""
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    """Adds a value to the histogram."""
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def Quantile(self, ratio):
+    """Returns the upper bound of the bucket holding the given quantile."""
+    rank = ratio * self.count
+    seen = 0
+    for i in range(len(self.buckets)):
+      seen += self.counts[i]
+      if seen >= rank:
+        return self.buckets[i]
+    return float('inf')
+
+  def Snapshot(self):
+    """Returns the histogram as a dict of plain values."""
+    return {'count': self.count, 'sum': self.sum,
+            'buckets': zip(self.buckets + (float('inf'),), self.counts)}
+
+
+class Metrics(object):
+  """Counters and histograms describing the work done by a Service.
+
+  The Service updates them in place; a sink, if any, gets a snapshot of all
+  of them at most every flush_interval seconds and on Flush().
+
+  Metrics updated by Service:
+    requests, errors, throttles: counters of HTTP requests
+    retries: counter of batch posts retried after a timeout, 413 or throttle
+    bytes_sent, bytes_received: counters of HTTP payload bytes
+    request_seconds: histogram of the HTTP request latency
+    connect_seconds: histogram of the time to connect (and TLS handshake)
+    wait_seconds: histogram of the time from request sent to reply read
+    events_per_batch: histogram of the number of events per successful batch
+        post, i.e. of the sizes chosen by the BatchSizer
+    serialize_seconds: histogram of the time spent building XML feeds
+  """
+
+  def __init__(self, sink=None, flush_interval=10, clock=time.time):
+    """Creates an empty set of metrics.
+
+    Args:
+      sink: an object with a Write(snapshot) method (see the *Sink classes)
+      flush_interval: the minimum number of seconds between two writes
+      clock: a function returning the current time
+    """
+    self.sink = sink
+    self.flush_interval = flush_interval
+    self.clock = clock
+    self.counters = {}
+    self.histograms = {}
+    self.last_flush = clock()
+
+  def Count(self, name, value=1):
+    """Adds value to a counter."""
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def Observe(self, name, value):
+    """Adds a value to a histogram."""
+    histogram = self.histograms.get(name)
+    if histogram is None:
+      histogram = self.histograms[name] = Histogram()
+    histogram.Observe(value)
+
+  def Snapshot(self):
+    """Returns the current values as a dict of plain values."""
+    histograms = {}
+    for name, histogram in self.histograms.items():
+      histograms[name] = histogram.Snapshot()
+    return {'time': self.clock(), 'counters': dict(self.counters),
+            'histograms': histograms}
+
+  def MaybeFlush(self):
+    """Writes a snapshot to the sink if flush_interval has elapsed."""
+    if self.sink is not None and (
+        self.clock() - self.last_flush >= self.flush_interval):
+      self.Flush()
+
+  def Flush(self):
+    """Writes a snapshot to the sink."""
+    self.last_flush = self.clock()
+    if self.sink is not None:
+      self.sink.Write(self.Snapshot())
+
+
+class SnapshotSink(object):
+  """A sink keeping the last snapshot in memory, in self.snapshot."""
+
+  def __init__(self):
+    self.snapshot = None
+
+  def Write(self, snapshot):
+    self.snapshot = snapshot
+
+
+class PrometheusFileSink(object):
+  """A sink writing snapshots to a file in the Prometheus text format,
+  e.g. for the textfile collector of the Prometheus node exporter."""
+
+  def __init__(self, filename, prefix='google_meter_'):
+    self.filename = filename
+    self.prefix = prefix
+
+  def Write(self, snapshot):
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+      name = self.prefix + name + '_total'
+      lines.append('# TYPE %s counter' % name)
+      lines.append('%s %s' % (name, value))
+    for name, histogram in sorted(snapshot['histograms'].items()):
+      name = self.prefix + name
+      lines.append('# TYPE %s histogram' % name)
+      cumulative = 0
+      for bound, count in histogram['buckets']:
+        cumulative += count
+        label = bound == float('inf') and '+Inf' or repr(bound)
+        lines.append('%s_bucket{le="%s"} %d' % (name, label, cumulative))
+      lines.append('%s_sum %r' % (name, histogram['sum']))
+      lines.append('%s_count %d' % (name, histogram['count']))
+    # Replace the file at once, so that it is never read half-written.
+    temp_filename = self.filename + '.tmp'
+    outfile = open(temp_filename, 'w')
+    try:
+      outfile.write('\n'.join(lines) + '\n')
+    finally:
+      outfile.close()
+    os.rename(temp_filename, self.filename)
+
+
+class StatsdSink(object):
+  """A sink sending the changes since the last snapshot to a StatsD daemon
+  over UDP: counters as counts, and for each histogram the count of new
+  observations and their mean (as a timing, in milliseconds for *_seconds
+  histograms)."""
+
+  def __init__(self, host='127.0.0.1', port=8125, prefix='google_meter.'):
+    self.address = (host, port)
+    self.prefix = prefix
+    self.last = {'counters': {}, 'histograms': {}}
+    self.sock = None
+
+  def Write(self, snapshot):
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+      delta = value - self.last['counters'].get(name, 0)
+      if delta:
+        lines.append('%s%s:%s|c' % (self.prefix, name, delta))
+    for name, histogram in sorted(snapshot['histograms'].items()):
+      last = self.last['histograms'].get(name, {'count': 0, 'sum': 0.0})
+      count = histogram['count'] - last['count']
+      if count:
+        mean = (histogram['sum'] - last['sum']) / count
+        if name.endswith('_seconds'):
+          lines.append('%s%s:%f|ms' % (self.prefix, name[:-8], mean * 1000))
+        else:
+          lines.append('%s%s:%f|ms' % (self.prefix, name, mean))
+        lines.append('%s%s.count:%d|c' % (self.prefix, name, count))
+    self.last = snapshot
+    if self.sock is None:
+      import socket
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Keep datagrams small enough not to be fragmented.
+    packet = []
+    for line in lines:
+      if packet and len('\n'.join(packet + [line])) > 512:
+        self.sock.sendto('\n'.join(packet), self.address)
+        packet = []
+      packet.append(line)
+    if packet:
+      self.sock.sendto('\n'.join(packet), self.address)
 
 
 class InstMeasurement(object):
@@ -312,7 +557,22 @@ class DurMeasurement(object):
 
   def ToXml(self):
     """Produces the XML <entry> element for this event."""
-    return '''
+    return DurMeasurementXml(
+        self.subject_path, self.start_time, self.end_time,
+        self.quantity.ConvertTo(units.KILOWATT_HOUR).value,
+        self.start_time_uncertainty, self.end_time_uncertainty,
+        self.quantity_uncertainty.ConvertTo(units.KILOWATT_HOUR).value)
+
+
+def DurMeasurementXml(subject_path, start_time, end_time, kwh,
+                      start_time_uncertainty, end_time_uncertainty,
+                      kwh_uncertainty):
+  """Produces the XML <entry> element of a DurMeasurement from its fields.
+
+  The quantity and its uncertainty are given in kWh.
+  """
+  event_id = rfc3339.ToTimestamp(start_time).replace(':', '_')
+  return '''
 <entry%s>
   <id>%s</id>
   <category scheme="http://schemas.google.com/g/2005#kind"
@@ -325,14 +585,14 @@ class DurMeasurement(object):
   </meter:quantity>
 </entry>
 ''' % (XMLNS_ATTRIBUTES,
-       GetAtomId(self.subject_path + '/' + self.kind + '/' + self.id),
-       GetAtomId(self.subject_path),
-       self.start_time_uncertainty,
-       rfc3339.ToTimestamp(self.start_time),
-       self.end_time_uncertainty,
-       rfc3339.ToTimestamp(self.end_time),
-       self.quantity_uncertainty.ConvertTo(units.KILOWATT_HOUR).value,
-       self.quantity.ConvertTo(units.KILOWATT_HOUR).value)
+       GetAtomId(subject_path + '/' + DurMeasurement.kind + '/' + event_id),
+       GetAtomId(subject_path),
+       start_time_uncertainty,
+       rfc3339.ToTimestamp(start_time),
+       end_time_uncertainty,
+       rfc3339.ToTimestamp(end_time),
+       kwh_uncertainty,
+       kwh)
 
 
 class DurMessage(object):
@@ -532,22 +792,562 @@ class MessageStream(Entity):
 ''' % (XMLNS_ATTRIBUTES, GetAtomId(self.path), self.id, self.name, self.text)
 
 
+def GetStatusCode(error):
+  """Returns the HTTP status code of an IOError raised by Service.Request,
+  or None if the error happened before a reply was received."""
+  import socket
+  match = _STATUS_CODE_RE.search(' %s ' % (error.args and error.args[0]))
+  if match and not isinstance(error, socket.error):
+    return int(match.group(1))
+  return None
+
+
+class BatchSizer(object):
+  """Chooses the number of events per batch post.
+
+  The size grows while posts succeed and the time per event doesn't get
+  worse, steps back when it gets worse, and is cut down when a post times
+  out or is refused as too large (413) or throttled (429, 503).
+  """
+
+  def __init__(self, initial=MAX_BATCH_POST_COUNT, minimum=10, maximum=1000,
+               growth=1.25, shrink=0.5, tolerance=0.1):
+    """Creates a batch sizer.
+
+    Args:
+      initial: the size of the first batch
+      minimum: the smallest size chosen
+      maximum: the largest size chosen
+      growth: the factor applied to the size after a good post
+      shrink: the factor applied to the size of a failed post
+      tolerance: how much worse the time per event may get and still count
+          as a good post (0.1 is 10% worse)
+    """
+    self.minimum = minimum
+    self.maximum = maximum
+    self.growth = growth
+    self.shrink = shrink
+    self.tolerance = tolerance
+    self.size = max(minimum, min(maximum, initial))
+    self.last_per_event = None
+
+  def __repr__(self):
+    return '<BatchSizer size=%d in [%d, %d]>' % (
+        self.size, self.minimum, self.maximum)
+
+  def Succeeded(self, count, seconds):
+    """Adapts the size after a post of count events that took seconds."""
+    per_event = seconds / max(count, 1)
+    if (self.last_per_event is None or
+        per_event <= self.last_per_event * (1 + self.tolerance)):
+      if count >= self.size:  # only a full batch tells us about the size
+        self.size = int(self.size * self.growth + 1)
+    else:
+      self.size = int(self.size / self.growth)
+    self.size = max(self.minimum, min(self.maximum, self.size))
+    self.last_per_event = per_event
+
+  def Failed(self, count):
+    """Adapts the size after a post of count events failed."""
+    self.size = max(self.minimum, min(self.size, int(count * self.shrink)))
+    self.last_per_event = None
+
+
+class DurMeasurementColumns(object):
+  """DurMeasurements kept as columns of numbers rather than objects.
+
+  A sequence of DurMeasurements: len, indexing (which builds the event),
+  slicing (columns again), deleting slices and iteration work as on a list
+  of events, at a fraction of the memory.  Service.BatchPostEvents and
+  ProcessSerializer take it as it is: Entries serializes the measurements
+  without building events, and Pack gives the bytes sent to the workers.
+
+  The quantities and their uncertainties are numbers of kWh.
+  """
+
+  def __init__(self, events=()):
+    """Creates columns, of the given DurMeasurements if any."""
+    self.subjects = []  # the distinct subject paths
+    self._indexes = {}  # subject path => its index in subjects
+    self.indexes = array.array('i')
+    self.columns = [array.array('d') for _ in range(6)]
+    for event in events:
+      self.Append(event.subject_path, event.start_time, event.end_time,
+                  event.quantity.ConvertTo(units.KILOWATT_HOUR).value,
+                  event.start_time_uncertainty, event.end_time_uncertainty,
+                  event.quantity_uncertainty.ConvertTo(
+                      units.KILOWATT_HOUR).value)
+
+  def __repr__(self):
+    return '<DurMeasurementColumns of %d measurements>' % len(self)
+
+  def _Index(self, subject_path):
+    index = self._indexes.get(subject_path)
+    if index is None:
+      index = self._indexes[subject_path] = len(self.subjects)
+      self.subjects.append(subject_path)
+    return index
+
+  def Append(self, subject_path, start_time, end_time, kwh,
+             start_time_uncertainty, end_time_uncertainty, kwh_uncertainty):
+    """Appends a measurement, given by its fields."""
+    self.indexes.append(self._Index(subject_path))
+    for (column, value) in zip(self.columns, (
+        start_time, end_time, kwh, start_time_uncertainty,
+        end_time_uncertainty, kwh_uncertainty)):
+      column.append(value)
+
+  def AppendSeries(self, subject_path, start_times, end_times, kwhs,
+                   start_time_uncertainty, end_time_uncertainty,
+                   kwh_uncertainty):
+    """Appends the measurements of a subject, given by lists of fields.
+
+    Args:
+      subject_path: the subject of all of them
+      start_times, end_times, kwhs: lists of the same length
+      start_time_uncertainty, end_time_uncertainty, kwh_uncertainty: the
+          uncertainties, the same for all of them
+    """
+    count = len(start_times)
+    self.indexes.extend(array.array('i', [self._Index(subject_path)]) * count)
+    for (column, values) in zip(self.columns, (
+        start_times, end_times, kwhs,
+        [start_time_uncertainty] * count, [end_time_uncertainty] * count,
+        [kwh_uncertainty] * count)):
+      column.extend(values)
+
+  def Extend(self, other):
+    """Appends the measurements of other DurMeasurementColumns."""
+    indexes = [self._Index(path) for path in other.subjects]
+    self.indexes.extend(array.array('i', [indexes[index]
+                                          for index in other.indexes]))
+    for (column, values) in zip(self.columns, other.columns):
+      column.extend(values)
+
+  def __len__(self):
+    return len(self.indexes)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      columns = DurMeasurementColumns()
+      columns.subjects = list(self.subjects)
+      columns._indexes = dict(self._indexes)
+      columns.indexes = self.indexes[index]
+      columns.columns = [column[index] for column in self.columns]
+      return columns
+    (start_time, end_time, kwh, start_time_uncertainty,
+     end_time_uncertainty, kwh_uncertainty) = [
+         column[index] for column in self.columns]
+    return DurMeasurement(
+        self.subjects[self.indexes[index]], start_time, end_time,
+        kwh * units.KILOWATT_HOUR, start_time_uncertainty,
+        end_time_uncertainty, kwh_uncertainty * units.KILOWATT_HOUR)
+
+  def __delitem__(self, index):
+    del self.indexes[index]
+    for column in self.columns:
+      del column[index]
+
+  def __iter__(self):
+    for index in xrange(len(self)):
+      yield self[index]
+
+  def Entries(self):
+    """Yields the XML <entry> element of each measurement, in order."""
+    for (index, fields) in zip(self.indexes, zip(*self.columns)):
+      yield DurMeasurementXml(self.subjects[index], *fields)
+
+  def Pack(self):
+    """Packs the columns, far smaller to pickle than events.
+
+    Returns:
+      a (subject paths, subject indexes, start times, end times, kWh, start
+      time uncertainties, end time uncertainties, kWh uncertainties) tuple;
+      the indexes point into the tuple of distinct paths.  The indexes and
+      numbers are the bytes of arrays of ints and doubles.
+    """
+    return tuple([tuple(self.subjects)] +
+                 [column.tostring()
+                  for column in [self.indexes] + self.columns])
+
+
+def _SerializeDurMeasurementColumns(columns):
+  """Returns the list of the XML entries of packed DurMeasurementColumns."""
+  subjects = columns[0]
+  indexes = array.array('i', columns[1])
+  numbers = [array.array('d', column) for column in columns[2:]]
+  return [DurMeasurementXml(subjects[index], *fields)
+          for (index, fields) in zip(indexes, zip(*numbers))]
+
+
+class _Serialized(object):
+  """The entries of a chunk serialized in the calling process."""
+
+  def __init__(self, entries):
+    self.entries = entries
+
+  def get(self):
+    return self.entries
+
+
+class ProcessSerializer(object):
+  """Produces the XML entries of events in a pool of worker processes.
+
+  Events are cut into chunks of chunk_size, sent to the workers as packed
+  DurMeasurementColumns rather than pickled objects.  The entries
+  come back in the order of the events, while the workers go on with the
+  next chunks: at most lookahead chunks are serialized ahead of the one
+  being read.  Events other than DurMeasurements are serialized in the
+  calling process.
+  """
+
+  def __init__(self, processes=None, chunk_size=500, lookahead=None):
+    """Starts the worker processes.
+
+    Args:
+      processes: the number of workers (default: one per CPU)
+      chunk_size: the number of events sent to a worker at once
+      lookahead: the most chunks being serialized at once (default: twice
+          the number of workers)
+    """
+    import multiprocessing
+    self.processes = processes or multiprocessing.cpu_count()
+    self.chunk_size = chunk_size
+    self.lookahead = lookahead or 2 * self.processes
+    self.pool = multiprocessing.Pool(self.processes)
+
+  def __repr__(self):
+    return '<ProcessSerializer of %d processes>' % self.processes
+
+  def Entries(self, events):
+    """Yields the XML <entry> element of each event, in order.
+
+    Args:
+      events: a list of events, or DurMeasurementColumns
+    """
+    pending = []
+    for start in range(0, len(events), self.chunk_size):
+      chunk = events[start:start + self.chunk_size]
+      if isinstance(chunk, DurMeasurementColumns):
+        pending.append(self.pool.apply_async(
+            _SerializeDurMeasurementColumns, (chunk.Pack(),)))
+      elif [event for event in chunk
+            if not isinstance(event, DurMeasurement)]:
+        pending.append(_Serialized([event.ToXml() for event in chunk]))
+      else:
+        pending.append(self.pool.apply_async(
+            _SerializeDurMeasurementColumns,
+            (DurMeasurementColumns(chunk).Pack(),)))
+      if len(pending) >= self.lookahead:
+        for entry in pending.pop(0).get():
+          yield entry
+    for result in pending:
+      for entry in result.get():
+        yield entry
+
+  def Close(self):
+    """Stops the worker processes."""
+    self.pool.close()
+    self.pool.join()
+
+
+class ConnectionPool(object):
+  """Keep-alive connections, shared by any number of Service objects.
+
+  Requests sent through the pool ask for the connection to be kept open.
+  When the reply allows it, the connection is kept for the next request to
+  the same host; a kept connection that turns out to have been closed by
+  the server is replaced once, transparently.
+  """
+
+  def __init__(self, max_idle=4):
+    """Creates an empty pool.
+
+    Args:
+      max_idle: the number of idle connections kept per host
+    """
+    import threading
+    self.max_idle = max_idle
+    self.idle = {}  # (scheme, host, port) => list of (sock, sockfile)
+    self.lock = threading.Lock()
+
+  def __repr__(self):
+    return '<ConnectionPool of %d idle connections>' % sum(
+        [len(connections) for connections in self.idle.values()])
+
+  def Exchange(self, scheme, host, port, request, timeout=None):
+    """Sends a request and reads its reply.
+
+    Returns:
+      a (connected time, sent time, reply) tuple
+    """
+    import socket
+    key = (scheme, host, port)
+    request = request.replace('\n', '\nConnection: keep-alive\n', 1)
+    connection = self._Acquire(key)
+    if connection is not None:
+      try:
+        return self._Exchange(key, connection, time.time(), request)
+      except (socket.error, EOFError):
+        pass  # the server closed it meanwhile
+    connection = self._Connect(key, timeout)
+    return self._Exchange(key, connection, time.time(), request)
+
+  def Close(self):
+    """Closes all the idle connections."""
+    self.lock.acquire()
+    try:
+      for connections in self.idle.values():
+        for sock, sockfile in connections:
+          sock.close()
+      self.idle = {}
+    finally:
+      self.lock.release()
+
+  def _Acquire(self, key):
+    self.lock.acquire()
+    try:
+      connections = self.idle.get(key)
+      if connections:
+        return connections.pop()
+    finally:
+      self.lock.release()
+
+  def _Release(self, key, connection):
+    self.lock.acquire()
+    try:
+      connections = self.idle.setdefault(key, [])
+      if len(connections) < self.max_idle:
+        connections.append(connection)
+        return
+    finally:
+      self.lock.release()
+    connection[0].close()
+
+  def _Connect(self, key, timeout):
+    import socket
+    scheme, host, port = key
+    sock = socket.socket()
+    if timeout is not None:
+      sock.settimeout(timeout)
+    sock.connect((host, port))
+    if scheme == 'https':
+      import ssl
+      sock = ssl.wrap_socket(sock)
+    return (sock, sock.makefile('rb'))
+
+  def _Exchange(self, key, connection, connected, request):
+    sock, sockfile = connection
+    try:
+      sock.sendall(request)
+      sent = time.time()
+
+      # Read the status line and headers, then a body of Content-Length
+      # bytes, or up to the end of the connection.
+      status = sockfile.readline()
+      if not status:
+        raise EOFError('connection closed by %s:%d' % key[1:])
+      lines = [status]
+      length = None
+      connection_header = ''
+      while lines[-1].strip():
+        line = sockfile.readline()
+        lines.append(line)
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+          length = int(value)
+        elif name == 'connection':
+          connection_header = value.strip().lower()
+      code = status.split(' ', 2)[1:2]
+      if code in (['204'], ['304']):
+        body = ''
+      elif length is not None:
+        body = sockfile.read(length)
+      else:
+        body = sockfile.read()
+      keep = length is not None or code in (['204'], ['304'])
+      if status.startswith('HTTP/1.0'):
+        keep = keep and connection_header == 'keep-alive'
+      else:
+        keep = keep and connection_header != 'close'
+    except:
+      sock.close()
+      raise
+    if keep:
+      self._Release(key, connection)
+    else:
+      sock.close()
+    return connected, sent, ''.join(lines) + body
+
+
+class CachedEntries(object):
+  """The parsed entries of a path in an EntityCache, and their validators."""
+
+  def __init__(self, cache, entities, etag, last_modified, fetched):
+    self.cache = cache
+    self.entities = entities
+    self.etag = etag
+    self.last_modified = last_modified
+    self.fetched = fetched  # when they were last got or revalidated
+    self.used = 0  # the cache's use counter when they were last looked up
+
+  def IsFresh(self):
+    """Whether they may still be used without asking the server."""
+    return self.cache.clock() - self.fetched < self.cache.ttl
+
+
+class EntityCache(object):
+  """Parsed entities by path, bounded in age and in number.
+
+  Entries younger than ttl are used as they are.  Older ones are still
+  kept: the Service asks the server whether they changed (If-None-Match
+  with their ETag, If-Modified-Since with their Last-Modified date), and a
+  304 reply makes them fresh again.  Beyond max_entries paths, the least
+  recently used ones are dropped.
+
+  With a filename, the entries are also kept in a sqlite file (the XML
+  content, parsed again when first looked up), so that the next runs start
+  with them.
+  """
+
+  def __init__(self, ttl=3600, max_entries=1000, filename=None,
+               clock=time.time):
+    """Creates an entity cache.
+
+    Args:
+      ttl: seconds during which entries are used without asking the server
+      max_entries: the most paths kept in memory
+      filename: a sqlite file keeping the entries between runs, or None
+      clock: function returning the current time
+    """
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.entries = {}  # path => CachedEntries
+    self.uses = 0
+    self.con = None
+    if filename is not None:
+      import sqlite3
+      self.con = sqlite3.connect(filename)
+      self.con.execute('CREATE TABLE IF NOT EXISTS entity_cache ('
+                       'path TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                       'fetched REAL NOT NULL, content BLOB NOT NULL)')
+      self.con.commit()
+
+  def __repr__(self):
+    return '<EntityCache of %d paths>' % len(self.entries)
+
+  def Lookup(self, path):
+    """Returns the CachedEntries of a path, fresh or not, or None."""
+    cached = self.entries.get(path)
+    if cached is None and self.con is not None:
+      row = self.con.execute('SELECT etag, last_modified, fetched, content '
+                             'FROM entity_cache WHERE path = ?',
+                             (path,)).fetchone()
+      if row is not None:
+        etag, last_modified, fetched, content = row
+        cached = self._Add(path, CachedEntries(
+            self, ParseEntries(str(content)), etag, last_modified, fetched))
+    if cached is not None:
+      self.uses += 1
+      cached.used = self.uses
+    return cached
+
+  def Store(self, path, content, entities, etag=None, last_modified=None):
+    """Keeps the entities got from a path.
+
+    Args:
+      path: the path they were got from
+      content: the XML they were parsed from
+      entities: the list of parsed entities
+      etag: the ETag of the reply, if any
+      last_modified: the Last-Modified date of the reply, if any
+    """
+    fetched = self.clock()
+    self._Add(path, CachedEntries(self, entities, etag, last_modified,
+                                  fetched))
+    if self.con is not None:
+      import sqlite3
+      self.con.execute('INSERT OR REPLACE INTO entity_cache '
+                       '(path, etag, last_modified, fetched, content) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (path, etag, last_modified, fetched,
+                        sqlite3.Binary(content)))
+      self.con.execute('DELETE FROM entity_cache WHERE path NOT IN ('
+                       'SELECT path FROM entity_cache '
+                       'ORDER BY fetched DESC LIMIT ?)', (self.max_entries,))
+      self.con.commit()
+
+  def Revalidated(self, path):
+    """Makes the entities of a path fresh again, after a 304 reply."""
+    cached = self.entries[path]
+    cached.fetched = self.clock()
+    if self.con is not None:
+      self.con.execute('UPDATE entity_cache SET fetched = ? WHERE path = ?',
+                       (cached.fetched, path))
+      self.con.commit()
+
+  def Close(self):
+    if self.con is not None:
+      self.con.close()
+      self.con = None
+
+  def _Add(self, path, cached):
+    self.entries[path] = cached
+    self.uses += 1
+    cached.used = self.uses
+    if len(self.entries) > self.max_entries:
+      oldest = min(self.entries, key=lambda path: self.entries[path].used)
+      del self.entries[oldest]
+    return cached
+
+
 class Service(object):
   """Authenticated access to a Google Meter service."""
 
-  def __init__(self, token, uri_prefix=DEFAULT_URI_PREFIX, log=Log()):
+  def __init__(self, token, uri_prefix=DEFAULT_URI_PREFIX, log=Log(),
+               metrics=None, compress_threshold=None, batch_sizer=None,
+               timeout=None, max_retries=5, retry_delay=1, pool=None,
+               serializer=None, entity_cache=None):
     """Sets up access to a service that provides the Google Meter API.
 
     Args:
       token: AuthSub token to use for all requests
       uri_prefix: URI prefix under which feeds are located
       log: Log object to which messages will be logged
+      metrics: Metrics object to update (default: a new one, without sink)
+      compress_threshold: the size from which posted content is sent
+          gzip-compressed, in bytes (default: None, never compress)
+      batch_sizer: BatchSizer choosing the size of batch posts
+          (default: a new one, starting at MAX_BATCH_POST_COUNT)
+      timeout: the socket timeout of requests, in seconds (default: None)
+      max_retries: the number of times a failing batch post is retried
+      retry_delay: the delay before the first retry of a throttled or timed
+          out batch post, doubled on each retry, in seconds
+      pool: ConnectionPool to send requests through, keeping connections
+          open between requests (default: None, one connection per request)
+      serializer: ProcessSerializer producing the XML of batch posted events
+          (default: None, serialized in this process, batch by batch)
+      entity_cache: EntityCache keeping the entities got by GetEntity and
+          GetEntities (default: None, got again every time)
     """
+    import urlparse
     self.token = token
-    self.scheme, hostport, self.path, _, _, _ = urlparse.urlparse(uri_prefix)
+    parts = urlparse.urlparse(uri_prefix)
+    self.scheme, self.path = parts.scheme, parts.path
     default_port = {'http': 80, 'https': 443}[self.scheme]
-    self.host, self.port = urllib.splitnport(hostport, default_port)
+    self.host, self.port = parts.hostname, parts.port or default_port
     self.log = log
+    self.metrics = metrics or Metrics()
+    self.compress_threshold = compress_threshold
+    self.batch_sizer = batch_sizer or BatchSizer()
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.retry_delay = retry_delay
+    self.pool = pool
+    self.serializer = serializer
+    self.entity_cache = entity_cache
 
   def __str__(self):
     return '%s:%d' % (self.host, self.port)
@@ -555,59 +1355,116 @@ class Service(object):
   def __repr__(self):
     return '<Google Meter service at %s:%d>' % (self.host, self.port)
 
-  def Request(self, request):
-    """Connects and sends a single HTTP request."""
-    self.log.Log(2, '=== sending to %s:%d ===\n%s\n=== end of request ===\n' %
-                 (self.host, self.port, request))
-    
-    # Get a file object for an appropriate socket (with or without SSL).
-    sock = socket.socket()
-    sock.connect((self.host, self.port))
-    if self.scheme == 'https':
-      sockfile = socket.ssl(sock)
-    else:
-      sockfile = sock.makefile()
+  def Request(self, request, headers=None):
+    """Connects and sends a single HTTP request.
 
-    # Send the HTTP request.
-    sockfile.write(request)
-    if hasattr(sockfile, 'flush'):
-      sockfile.flush()
-
-    # Read back the entire reply.
-    reply = []
-    try:
-      while reply[-1:] != ['']:
-        reply.append(sockfile.read())
-    except socket.error, e:
-      # Usually SSL_ERROR_EOF just means we reached end-of-file.
-      if e.args[0] != socket.SSL_ERROR_EOF:
-        raise
-    reply = ''.join(reply)
-    self.log.Log(2, '--- reply from %s:%d ---\n%s\n--- end of reply ---\n' %
-                 (self.host, self.port, reply))
-    sock.close()
+    Args:
+      request: the HTTP request
+      headers: a dict to fill with the headers of the reply, by lowercase
+          name, or None
+    Returns:
+      the content of the reply, uncompressed, or None for a 304 reply (Not
+      Modified) to a conditional request
+    Raises:
+      IOError: if the request failed or the reply isn't a success.
+    """
+    self.log.Log(2, '=== sending to %s:%d ===\n%s\n=== end of request ===\n',
+                 self.host, self.port, request)
+    start = time.time()
+    if self.pool is not None:
+      connected, sent, reply = self.pool.Exchange(
+          self.scheme, self.host, self.port, request, self.timeout)
+      done = time.time()
+    else:
+      import socket
+      # Get a file object for an appropriate socket (with or without SSL).
+      sock = socket.socket()
+      if self.timeout is not None:
+        sock.settimeout(self.timeout)
+      sock.connect((self.host, self.port))
+      if self.scheme == 'https':
+        sockfile = socket.ssl(sock)
+      else:
+        sockfile = sock.makefile()
+      connected = time.time()
+
+      # Send the HTTP request.
+      sockfile.write(request)
+      if hasattr(sockfile, 'flush'):
+        sockfile.flush()
+      sent = time.time()
+
+      # Read back the entire reply.
+      reply = []
+      try:
+        while reply[-1:] != ['']:
+          reply.append(sockfile.read())
+      except socket.error, e:
+        # Usually SSL_ERROR_EOF just means we reached end-of-file.
+        if e.args[0] != socket.SSL_ERROR_EOF:
+          raise
+      reply = ''.join(reply)
+      done = time.time()
+      sock.close()
+    self.log.Log(2, '--- reply from %s:%d ---\n%s\n--- end of reply ---\n',
+                 self.host, self.port, reply)
+
+    metrics = self.metrics
+    metrics.Count('requests')
+    metrics.Count('bytes_sent', len(request))
+    metrics.Count('bytes_received', len(reply))
+    metrics.Observe('request_seconds', done - start)
+    metrics.Observe('connect_seconds', connected - start)
+    metrics.Observe('wait_seconds', done - sent)
 
     # Check the status code in the reply.
     status = reply.split('\n', 1)[0].strip()
-    if not re.search(r' 2\d\d ', status):
+    match = _HEADERS_END_RE.search(reply)
+    if headers is not None and match:
+      for line in reply[:match.start()].split('\n')[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if _STATUS_NOT_MODIFIED_RE.search(status):
+      metrics.Count('not_modified')
+      metrics.MaybeFlush()
+      return None
+    if not _STATUS_OK_RE.search(status):
+      metrics.Count('errors')
+      if _STATUS_THROTTLE_RE.search(status):
+        metrics.Count('throttles')
+      metrics.MaybeFlush()
       raise IOError(status)
+    metrics.MaybeFlush()
 
-    # Return the content in the reply.
-    match = re.search('\n\r?\n', reply)
+    # Return the content in the reply, uncompressed.
     if match:
-      return reply[match.end():]
+      content = reply[match.end():]
+      if _GZIP_ENCODING_RE.search(reply, 0, match.start()):
+        content = Gunzip(content)
+      return content
 
   def Post(self, path, content):
-    """Connects and sends a single HTTP POST request."""
+    """Connects and sends a single HTTP POST request.
+
+    The content is gzip-compressed if it is at least compress_threshold
+    bytes long.  Exactly Content-Length bytes follow the headers: on a kept
+    alive connection, anything more would be read as the next request.
+    """
+    encoding = ''
+    if (self.compress_threshold is not None and
+        len(content) >= self.compress_threshold):
+      content = Gzip(content)
+      encoding = 'Content-Encoding: gzip\n'
     self.Request('''
 POST %s HTTP/1.0
 Host: %s
 Authorization: AuthSub token="%s"
+Accept-Encoding: gzip
 Content-Type: application/atom+xml
-Content-Length: %d
+%sContent-Length: %d
 
-%s
-'''.lstrip() % (self.path + path, self.host, self.token, len(content), content))
+'''.lstrip() % (self.path + path, self.host, self.token, encoding,
+               len(content)) + content)
 
   def PostXml(self, path, element):
     """Posts a single XML element to this service."""
@@ -616,36 +1473,122 @@ Content-Length: %d
   def PostEntity(self, entity):
     """Posts an entity to this service."""
     self.PostXml(entity.feed_path, entity.ToXml())
-    self.log.Log(1, '%s <- %r' % (self, entity))
+    self.log.Log(1, '%s <- %r', self, entity)
 
   def PostEvent(self, event):
     """Posts a single event to this service."""
     self.PostXml(event.subject_path + '/' + event.kind, event.ToXml())
-    self.log.Log(1, '%s <- %s' % (self, event))
+    self.log.Log(1, '%s <- %s', self, event)
 
   def BatchPostEvents(self, events):
-    """Batch upload a list of usage events."""
-    event_list = list(events)  # make a copy, since we'll mutate it
+    """Batch upload a list of usage events.
 
-    # We can only upload MAX_BATCH_POST_COUNT at a time.
-    while event_list:
-      sublist = event_list[0:MAX_BATCH_POST_COUNT]
-      event_list = event_list[MAX_BATCH_POST_COUNT:]
+    Batches are sized by self.batch_sizer.  A batch that times out, is too
+    large or is throttled is retried (smaller) up to max_retries times; the
+    size is cut down on the last failure too, for the next calls.
+    Events are serialized once, by self.serializer if any, ahead of the
+    posts.
+
+    Args:
+      events: a list of events, or DurMeasurementColumns
+    """
+    # make a copy, since we'll mutate it
+    if isinstance(events, DurMeasurementColumns):
+      event_list = events[:]
+    else:
+      event_list = list(events)
+    sizer = self.batch_sizer
+    retries = 0
+    if self.serializer is not None:
+      entries = self.serializer.Entries(event_list)
+    elif isinstance(event_list, DurMeasurementColumns):
+      entries = event_list.Entries()
+    else:
+      entries = (event.ToXml() for event in event_list)
+    serialized = []  # the entries of the first events of event_list
 
-      entries = ''.join(event.ToXml() for event in sublist)
-      feed = '<feed%s>%s</feed>' % (XMLNS_ATTRIBUTES, entries)
-      self.PostXml('/event', feed)
-      self.log.Log(1, '%s <- batch-posted %d events\n' %
-                   (self, len(sublist)))
+    while event_list:
+      sublist = event_list[0:sizer.size]
+
+      start = time.time()
+      while len(serialized) < len(sublist):
+        serialized.append(entries.next())
+      feed = '<feed%s>%s</feed>' % (XMLNS_ATTRIBUTES,
+                                    ''.join(serialized[:len(sublist)]))
+      self.metrics.Observe('serialize_seconds', time.time() - start)
+
+      start = time.time()
+      try:
+        self.PostXml('/event', feed)
+      except IOError, e:  # socket.error is an IOError too
+        status = GetStatusCode(e)
+        if status is not None and status != 413 and (
+            status not in THROTTLE_STATUS_CODES):
+          raise
+        retries += 1
+        sizer.Failed(len(sublist))
+        if retries > self.max_retries:
+          raise
+        self.metrics.Count('retries')
+        self.log.Log(1, '%s <- batch of %d events failed (%s), retrying with %r',
+                     self, len(sublist), e, sizer)
+        if status != 413:
+          time.sleep(self.retry_delay * 2 ** (retries - 1))
+        continue
+
+      sizer.Succeeded(len(sublist), time.time() - start)
+      self.metrics.Observe('events_per_batch', len(sublist))
+      event_list = event_list[len(sublist):]
+      del serialized[:len(sublist)]
+      retries = 0
+      self.log.Log(1, '%s <- batch-posted %d events\n', self, len(sublist))
+
+  def Get(self, path, etag=None, last_modified=None, headers=None):
+    """Connects and sends a single HTTP GET request.
 
-  def Get(self, path):
-    """Connects and sends a single HTTP GET request."""
+    Args:
+      path: the path of the feed or entry
+      etag: if given, only get it if its ETag changed (If-None-Match)
+      last_modified: if given, only get it if modified since that
+          Last-Modified date (If-Modified-Since)
+      headers: a dict to fill with the headers of the reply, or None
+    Returns:
+      the content of the reply, or None if it wasn't modified
+    """
+    conditions = IncludeIfTrue(etag, 'If-None-Match: %s\n' % etag)
+    conditions += IncludeIfTrue(last_modified,
+                                'If-Modified-Since: %s\n' % last_modified)
     return self.Request('''
 GET %s HTTP/1.0
 Host: %s
 Authorization: AuthSub token="%s"
-
-'''.lstrip() % (self.path + path, self.host, self.token))
+Accept-Encoding: gzip
+%s
+'''.lstrip() % (self.path + path, self.host, self.token, conditions), headers)
+
+  def _GetEntries(self, path):
+    """Gets and parses the entries of a path, through the entity cache."""
+    cache = self.entity_cache
+    if cache is None:
+      return ParseEntries(self.Get(path))
+    cached = cache.Lookup(path)
+    if cached is not None and cached.IsFresh():
+      self.metrics.Count('entity_cache_hits')
+      return list(cached.entities)
+    headers = {}
+    content = self.Get(path, cached and cached.etag,
+                       cached and cached.last_modified, headers)
+    if content is None:
+      if cached is None:
+        raise IOError('%s: not modified, but not in the cache' % path)
+      self.metrics.Count('entity_cache_hits')
+      cache.Revalidated(path)
+      return list(cached.entities)
+    self.metrics.Count('entity_cache_misses')
+    entities = ParseEntries(content)
+    cache.Store(path, content, entities, headers.get('etag'),
+                headers.get('last-modified'))
+    return list(entities)
 
   def GetEntity(self, path):
     """Retrieves a single entity.
@@ -654,7 +1597,7 @@ Authorization: AuthSub token="%s"
       path: the entity path (this path should have the entity type and
           entity ID as its last two components)
     """
-    return ParseEntries(self.Get(path))[0]
+    return self._GetEntries(path)[0]
 
   def GetEntities(self, path):
     """Retrieves a list of entities under a given path.
@@ -663,7 +1606,7 @@ Authorization: AuthSub token="%s"
       path: the parent path of the entities to be retrieved (this path should
           have the entity type as its last component)
     """
-    return ParseEntries(self.Get(path))
+    return self._GetEntries(path)
 
   def GetEvent(self, subject, kind, key_time):
     """Retrieves a single event.
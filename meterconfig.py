@@ -0,0 +1,253 @@
+#	meterconfig
+#	 Configuration of the uploads to Google PowerMeter.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+
+"""Configuration of the uploads to Google PowerMeter.
+
+A config file is parsed once into a Config, a read-only list of Sites.
+Each site has its own token, database, per-sensor variables and upload
+settings, and is described by a section:
+
+  [site:home]
+  token: auth_token
+  database: /var/lib/cc128/home.db
+  variable: /user/123456789/1234567890/variable/home.d1
+  interval: 600
+  batch_max: 500
+
+  [sensor:home:1]
+  variable: /user/123456789/1234567890/variable/fridge.d1
+
+The variable of a site is the one of its sensor #0, the [sensor:<site>:<n>]
+sections give the variables of the others.  The original single-site
+format, a [main] section with token, variable and variable<n> entries, is
+read as a site named 'main', and [sensor:<n>] sections belong to it.
+Entries of the [DEFAULT] section apply to every site.
+
+A Reloader reloads its file when the process gets a SIGHUP.
+"""
+
+import collections
+import ConfigParser
+import re
+import signal
+
+MAIN_SITE = 'main'
+
+# upload settings of a site, with their type and default value
+SETTINGS = (
+    ('interval', float, 600.0),   # minimum seconds between two batches of a token
+    ('burst', int, 1),            # batches a token may post at once after being idle
+    ('batch_min', int, 10),       # smallest number of events per batch post
+    ('batch_max', int, 1000),     # largest number of events per batch post
+    ('compress', int, None),      # gzip posted batches of at least this size
+)
+
+_VARIABLE_OPTION_RE = re.compile(r'variable(\d+)$')
+_SENSOR_SECTION_RE = re.compile(r'sensor:(?:([^:]+):)?(\d+)$')
+
+
+class Error(Exception):
+  """An invalid config file."""
+
+
+class Site(collections.namedtuple('Site', ('name', 'token', 'database', 'variables')
+                                  + tuple(name for (name, _, _) in SETTINGS))):
+  """The upload settings of one site.
+
+  variables is a tuple of (sensor, variable path) pairs, sorted by sensor.
+  """
+
+  __slots__ = ()
+
+  def Variables(self):
+    """Returns a dict mapping sensor numbers to variable paths."""
+    return dict(self.variables)
+
+  def Replace(self, **kwargs):
+    """Returns a copy of the site with some settings changed.
+
+    Args:
+      kwargs: the settings to change, those set to None are left as is.
+    """
+    changes = {}
+    for (name, value) in kwargs.items():
+      if value is not None:
+        changes[name] = value
+    if 'variables' in changes and isinstance(changes['variables'], dict):
+      changes['variables'] = tuple(sorted(changes['variables'].items()))
+    return self._replace(**changes)
+
+
+class Config(collections.namedtuple('Config', ('filename', 'sites'))):
+  """A parsed config file, sites is a tuple of Site."""
+
+  __slots__ = ()
+
+  def GetSite(self, name=None):
+    """Returns the site of that name, or the first one if name is None.
+
+    Raises:
+      Error: if there is no such site.
+    """
+    for site in self.sites:
+      if name is None or site.name == name:
+        return site
+    if name is None:
+      raise Error('%s: no site configured' % self.filename)
+    raise Error("%s: no site '%s'" % (self.filename, name))
+
+
+def NewSite(name, **kwargs):
+  """Returns a Site with default settings.
+
+  Args:
+    name: name of the site.
+    kwargs: the fields to set instead of their default.
+  """
+  fields = {'token': None, 'database': None, 'variables': ()}
+  for (setting, _, default) in SETTINGS:
+    fields[setting] = default
+  fields.update(kwargs)
+  return Site(name=name, **fields)
+
+
+def _GetSetting(parser, section, name, kind, default):
+  if not parser.has_option(section, name):
+    return default
+  value = parser.get(section, name)
+  try:
+    return kind(value)
+  except ValueError:
+    raise Error("[%s] %s: invalid value '%s'" % (section, name, value))
+
+
+def Parse(parser, filename='<config>'):
+  """Builds the Config of an already read SafeConfigParser.
+
+  Args:
+    parser: a ConfigParser holding the config file.
+    filename: the name of the file, for error messages.
+  Returns:
+    a Config.
+  Raises:
+    Error: if a section is invalid.
+  """
+  sites = []
+  variables = {}  # site name => {sensor: variable}
+  for section in parser.sections():
+    if section == MAIN_SITE:
+      name = MAIN_SITE
+    elif section.startswith('site:'):
+      name = section[len('site:'):]
+    else:
+      match = _SENSOR_SECTION_RE.match(section)
+      if not match:
+        raise Error("%s: unknown section [%s]" % (filename, section))
+      if not parser.has_option(section, 'variable'):
+        raise Error("%s: [%s] has no variable" % (filename, section))
+      site_variables = variables.setdefault(match.group(1) or MAIN_SITE, {})
+      site_variables[int(match.group(2))] = parser.get(section, 'variable')
+      continue
+
+    site_variables = variables.setdefault(name, {})
+    for (option, value) in parser.items(section):
+      match = _VARIABLE_OPTION_RE.match(option)
+      if match:
+        site_variables.setdefault(int(match.group(1)), value)
+    if parser.has_option(section, 'variable'):
+      site_variables[0] = parser.get(section, 'variable')
+
+    settings = {}
+    for (setting, kind, default) in SETTINGS:
+      settings[setting] = _GetSetting(parser, section, setting, kind, default)
+    token = parser.has_option(section, 'token') and parser.get(section, 'token') or None
+    database = parser.has_option(section, 'database') and parser.get(section, 'database') or None
+    sites.append(NewSite(name, token=token, database=database, **settings))
+
+  names = [site.name for site in sites]
+  for name in variables:
+    if name not in names:
+      raise Error("%s: sensor variables of unknown site '%s'" % (filename, name))
+  sites = [site.Replace(variables=variables[site.name]) for site in sites]
+  return Config(filename, tuple(sites))
+
+
+def Load(filename):
+  """Reads and parses a config file.
+
+  Args:
+    filename: path of the config file.
+  Returns:
+    a Config.
+  Raises:
+    Error: if the file can not be read or is invalid.
+  """
+  parser = ConfigParser.SafeConfigParser()
+  try:
+    f = open(filename)
+    try:
+      parser.readfp(f)
+    finally:
+      f.close()
+  except (IOError, ConfigParser.Error), e:
+    raise Error('%s: %s' % (filename, e))
+  return Parse(parser, filename)
+
+
+class Reloader(object):
+  """Keeps the Config of a file, loading it again on SIGHUP.
+
+  The signal handler only takes note of the signal, the file is reloaded by
+  the next call to Get.  When the new file is invalid, the previous Config
+  is kept.
+  """
+
+  def __init__(self, filename, load=Load, log=None):
+    """Loads the file and installs the SIGHUP handler.
+
+    Args:
+      filename: path of the config file, passed to load.
+      load: function returning the Config of filename.
+      log: google_meter.Log reporting reloads and errors, or None.
+    Raises:
+      Error: if the file is invalid.
+    """
+    self.filename = filename
+    self.load = load
+    self.log = log
+    self.config = load(filename)
+    self.generation = 0  # incremented on every successful reload
+    self._hangup = False
+    signal.signal(signal.SIGHUP, self._OnHangup)
+
+  def _OnHangup(self, signum, frame):
+    self._hangup = True
+
+  def Get(self):
+    """Returns the current Config, reloading it if a SIGHUP came in."""
+    if self._hangup:
+      self._hangup = False
+      try:
+        self.config = self.load(self.filename)
+        self.generation += 1
+        if self.log:
+          self.log.Log(1, 'Reloaded %s', self.filename)
+      except Error, e:
+        if self.log:
+          self.log.Log(0, 'Error: %s, keeping the previous config', e)
+    return self.config
@@ -14,10 +14,12 @@
 
 """Conversions to and from RFC 3339 timestamp format."""
 
-import calendar
 import re
 import time
 
+_TIMESTAMP_RE = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d)(?::(\d\d\.?\d*))?'
+                           r'(Z|[-+]\d+:?(\d\d)?)')
+
 
 def ToTimestamp(unix_time):
   """Converts a Unix time to an RFC 3339 timestamp in UTC.
@@ -67,8 +69,7 @@ def FromTimestamp(timestamp):
   # Remove any whitespace in the timestamp.
   timestamp = ''.join(timestamp.split())
 
-  match = re.match(r'(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d)(?::(\d\d\.?\d*))?'
-                   r'(Z|[-+]\d+:?(\d\d)?)', timestamp)
+  match = _TIMESTAMP_RE.match(timestamp)
   if not match:
     raise ValueError('not a valid timestamp: %r' % timestamp)
   year, month, day, hour, minute, second, zone, zone_minutes = match.groups()
@@ -90,5 +91,6 @@ def FromTimestamp(timestamp):
     if zone[0] == '-':
       zone_offset = -zone_offset
 
+  import calendar  # only loaded by the scripts parsing timestamps
   integer_time = calendar.timegm(time_tuple) - zone_offset
   return (integer_time * 1000 + milliseconds) * 0.001
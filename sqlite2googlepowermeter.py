@@ -50,22 +50,26 @@
 #							 
 
 import os
+import signal
+import sqlite3
 import sys
+import time
+# when the run started, for --profile: the imports below are part of startup
+started = (time.time(), time.clock())
 from optparse import OptionParser
 import google_meter
-import ConfigParser as cp
-import sqlite3
-from google_meter import DurMeasurement
-import units
+import cc128db
+import cc128sinks
+import meterconfig
 
 programVersion = '0.1'
 programName = 'sqlite2googlepowermeter'
 config_filename = 'config'
 
 def parseArguments():
-	op = OptionParser('%prog [--token <token>] [--variable <variable>] Filename.db \n\n' + '''
+	op = OptionParser('%prog [--token <token>] [--variable <variable>] [Filename.db] \n\n' + '''
 arguments:
-	Filename.db				The sqlite datafile (required)''', version="%s %s" % (programName, programVersion))
+	Filename.db				The sqlite datafile (default: database entry of the config file)''', version="%s %s" % (programName, programVersion))
 	op.add_option('', '--token', metavar='<token>',
 								help='Google PowerMeter OAUTH Token'
 										 ' (default: None)')
@@ -75,13 +79,55 @@ arguments:
 	op.add_option('', '--service', metavar='<URI>',
 								help='URI prefix of the GData service to contact '
 										 '(default: https://www.google.com/powermeter/feeds)')
+	op.add_option('', '--metrics', metavar='<sink>',
+								help='Where to write upload metrics: prometheus:<file>, statsd[:host[:port]]'
+										 ' (default: None)')
+	op.add_option('', '--compress', type='int', metavar='<bytes>',
+								help='Gzip-compress posted batches of at least this size'
+										 ' (default: compress entry of the config file, or None)')
+	op.add_option('', '--timeout', type='float', metavar='<seconds>',
+								help='Give up a request whose connection or reply takes longer, batch posts are then retried smaller'
+										 ' (default: 60)')
+	op.add_option('', '--batch-min', type='int', metavar='<events>',
+								help='Smallest number of events per batch post'
+										 ' (default: batch_min entry of the config file, or 10)')
+	op.add_option('', '--batch-max', type='int', metavar='<events>',
+								help='Largest number of events per batch post'
+										 ' (default: batch_max entry of the config file, or 1000)')
+	op.add_option('', '--site', metavar='<name>',
+								help='Site of the config file to upload, [site:<name>] section'
+										 ' (default: the first one)')
+	op.add_option('', '--profile', metavar='<file>',
+								help='Profile the run, write cProfile stats to file and print the time, memory and objects allocated per phase'
+										 ' (default: None)')
+	op.add_option('', '--daemon', action='store_true',
+								help='Stay running, uploading new records as soon as they are stored'
+										 ' (default: upload once and exit)')
+	op.add_option('', '--poll', type='float', metavar='<seconds>',
+								help='Delay between two checks of the database for new records in daemon mode'
+										 ' (default: 2)')
+	op.add_option('', '--processes', type='int', metavar='<n>',
+								help='Serialize the events in n worker processes, ahead of the posts (for large backfills)'
+										 ' (default: 0, in the upload process)')
+	op.add_option('', '--validate', action='store_true',
+								help='Check that the variables exist before uploading, skipping the sensors of missing ones'
+										 ' (default: no check)')
+	op.add_option('', '--entity-cache', metavar='<file.db>',
+								help='Keep the variables checked by --validate in this sqlite file, asking again only'
+										 ' whether they changed after an hour (default: None, kept in memory)')
+	op.add_option('', '--sink', metavar='<sink>', action='append', dest='sinks',
+								help='Where to write the records, may be repeated: meter (the service), csv:<file>, ndjson:<file>,'
+										 ' influx[:host[:port]] (line protocol over UDP), influx-tcp[:host[:port]], sqlite:<file.db>'
+										 ' (default: meter)')
 	op.add_option('-f','--configFile', metavar='<configFile>', help="Path and filename of configuration file (default: ~/.local/%s/config)" % programName)
 
 	op.set_defaults(service='https://www.google.com/powermeter/feeds',
-									unit='kW h', uncertainty=0.001, time_uncertainty=1)
+									unit='kW h', uncertainty=0.001, time_uncertainty=1, timeout=60, daemon=False, poll=2, processes=0, validate=False)
 
 	# Parse and validate the command-line options.
 	options, args = op.parse_args()
+	if not options.sinks:
+		options.sinks = ['meter']
 
 	# Check for config file, setup default otherwise
 	if options.configFile == None:
@@ -102,87 +148,412 @@ arguments:
 					sys.stderr.write("Error: Can not find config file '%s'\n" % options.configFile)
 					exit(2)
 	
-	if options.token == None:
-		if checkConfigfile(options.configFile,'token'):
-			options.token = getConfigfile(options.configFile,'token')
-		else:
-			sys.stderr.write('Error: Missing Google Power Meter OAuth token. \nToken must be supplied via --token or in the config file (token entry).\n')
-			op.exit(2, op.format_help())
-	if options.variable == None:
-		if checkConfigfile(options.configFile,'variable'):
-			options.variable = getConfigfile(options.configFile,'variable')
-		else:
-			sys.stderr.write('Error: Missing Google Power Meter variable.\nVariable must be supplied via --variable or in the config file (variable entry).\n')
-			op.exit(2,op.format_help())
+	# the site to upload, from the config file, the command line overriding it
+	config = None
+	if options.configFile != None:
+		try:
+			config = meterconfig.Load(options.configFile)
+		except meterconfig.Error, e:
+			sys.stderr.write("Error: %s\n" % e)
+			exit(2)
+	try:
+		site = getSite(config, options, args)
+	except meterconfig.Error, e:
+		sys.stderr.write("Error: %s\n" % e)
+		exit(2)
 
-	if len(args) < 1:
+	if site.token == None and 'meter' in options.sinks:
+		sys.stderr.write('Error: Missing Google Power Meter OAuth token. \nToken must be supplied via --token or in the config file (token entry).\n')
+		op.exit(2, op.format_help())
+	if not site.variables and 'meter' in options.sinks:
+		sys.stderr.write('Error: Missing Google Power Meter variable.\nVariable must be supplied via --variable or in the config file (variable entry).\n')
+		op.exit(2,op.format_help())
+	if site.database == None:
 		sys.stderr.write('Error: No input file specified.\n')
 		op.exit(2, op.format_help())
+	options.settings = site # the --site name stays in options.site
 
 	return (args, options)
 
+def getSite(config, options, args):
+	# the site of the config (if any) with the command-line options applied
+	site = meterconfig.NewSite(meterconfig.MAIN_SITE)
+	if config != None:
+		site = config.GetSite(options.site)
+	variables = site.Variables()
+	if options.variable != None:
+		variables[0] = options.variable
+	return site.Replace(token=options.token, variables=variables, database=args and args[0] or None,
+		batch_min=options.batch_min, batch_max=options.batch_max, compress=options.compress)
 
-def checkConfigfile(filename,var):
-	# if no configfile, the answer is always false !
-	if filename == None:
-		return False
-	
-	with open(filename) as f:
-		parser = cp.SafeConfigParser()
+
+def getMetricsSink(spec):
+	# prometheus:<file> or statsd[:host[:port]]
+	if spec == None:
+		return None
+	kind, sep, where = spec.partition(':')
+	if kind == 'prometheus' and where:
+		return google_meter.PrometheusFileSink(where)
+	if kind == 'statsd':
+		host, sep, port = where.partition(':')
+		return google_meter.StatsdSink(host or '127.0.0.1', int(port or 8125))
+	sys.stderr.write("Error: Unknown metrics sink '%s'\n" % spec)
+	exit(2)
+
+def getSink(spec, service, variables, options):
+	# meter, csv:<file>, ndjson:<file>, influx[-tcp][:host[:port]] or sqlite:<file.db>
+	kind, sep, where = spec.partition(':')
+	if kind == 'meter' and not where:
+		return cc128sinks.ServiceSink(service, variables, options.time_uncertainty, options.uncertainty)
+	if kind in cc128sinks.FileSink.FORMATS and where:
+		return cc128sinks.FileSink(where, kind)
+	if kind in ('influx', 'influx-tcp'):
+		host, sep, port = where.partition(':')
+		return cc128sinks.LineProtocolSink(host or '127.0.0.1', int(port or 8089), kind == 'influx-tcp' and 'tcp' or 'udp')
+	if kind == 'sqlite' and where:
+		return cc128sinks.SqliteSink(where)
+	sys.stderr.write("Error: Unknown sink '%s'\n" % spec)
+	exit(2)
+
+class Profile(object):
+	"""Wall time, CPU time, memory and allocations per phase of the run (--profile).
+
+	The memory is the peak resident set size of the process (getrusage), the
+	only measure python 2 has : a phase shows the peak at its end and how much
+	it grew the peak, not what it freed. The allocations are the objects the
+	garbage collector tracks (containers and instances, not numbers or
+	strings) : a phase shows how many are alive at its end and how many more
+	than at its start."""
+
+	def __init__(self, filename, started):
+		# started: the (wall, cpu) times the run started at
+		import cProfile
+		import gc
+		self.gc = gc
+		self.filename = filename
+		self.phases = []
+		try:
+			import resource
+			self.resource = resource
+		except ImportError: # not on windows
+			self.resource = None
+		self.current = ('startup', started[0], started[1], 0, 0)
+		self.profiler = cProfile.Profile()
+		self.profiler.enable()
+
+	def maxRss(self):
+		# peak resident set size in KB (linux reports KB), None if unknown
+		if self.resource == None:
+			return None
+		return self.resource.getrusage(self.resource.RUSAGE_SELF).ru_maxrss
+
+	def phase(self, name):
+		"""Ends the current phase (if any) and starts a new one."""
+		now = (time.time(), time.clock())
+		rss = self.maxRss()
+		objects = len(self.gc.get_objects())
+		if self.current != None:
+			(current, wall, cpu, before, objects_before) = self.current
+			memory = None
+			if rss != None:
+				memory = (rss, rss - before)
+			self.phases.append((current, now[0] - wall, now[1] - cpu, memory, (objects, objects - objects_before)))
+		if name != None:
+			self.current = (name, now[0], now[1], rss, objects)
+		else:
+			self.current = None
+
+	def stop(self, metrics):
+		self.phase(None)
+		self.profiler.disable()
+		self.profiler.dump_stats(self.filename)
+
+		print "Profile (cProfile stats written to %s):" % self.filename
+		print "  %-24s %10s %10s %12s %12s %10s %10s" % ('phase', 'wall s', 'cpu s', 'max RSS KB', 'growth KB', 'objects', 'new')
+		for (name, wall, cpu, memory, objects) in self.phases:
+			if memory == None:
+				memory = ('n/a', 'n/a')
+			print "  %-24s %10.3f %10.3f %12s %12s %10d %+10d" % ((name, wall, cpu) + memory + objects)
+		# the upload phase, as seen by google_meter.Service
+		for (name, histogram) in (('  serialize (ToXml)', 'serialize_seconds'), ('  connect (TCP + TLS)', 'connect_seconds'), ('  server wait', 'wait_seconds')):
+			if histogram in metrics.histograms:
+				print "  %-24s %10.3f" % (name, metrics.histograms[histogram].sum)
+
+def readSeries(store, variables, since={}, skipped=None):
+	# (sensor, variable, rows) for each run of contiguous records of the
+	# sensors having a variable, rows being (ts, kwatt) records after
+	# since[sensor] (if any), the last one uploaded. The hours missing between
+	# two runs are warned about, nothing is uploaded for them (see
+	# toMeasures). store is a cc128db.Router, reading the yearly partitions
+	# as well.
+	# skipped is the set of the sensors (and variables) of the site already
+	# warned about, to warn once when readSeries runs again and again
+	if skipped == None:
+		skipped = set()
+	series = list()
+	for sensor in store.GetSensors():
+		if sensor not in variables:
+			if sensor not in skipped:
+				sys.stderr.write("Warning: No variable configured for sensor #%d, skipping it.\n" % sensor)
+				skipped.add(sensor)
+			continue
+		skipped.discard(sensor) # configured since
+		min_ts = since.get(sensor)
+		if min_ts != None:
+			min_ts += 1
+		rows = store.ReadSeries(sensor, min_ts=min_ts)
+		ranges = store.GetCoverage(sensor, min_ts=min_ts)
+		i = 0
+		for (start, end) in ranges:
+			if i > 0:
+				sys.stderr.write("Warning: No data for sensor #%d from %s to %s, not uploaded.\n" % (sensor,
+					time.strftime('%Y-%m-%d %H:%M', time.localtime(rows[i - 1][0] + cc128db.HISTORY_STEP)), time.strftime('%Y-%m-%d %H:%M', time.localtime(start))))
+			first = i
+			while i < len(rows) and rows[i][0] <= end:
+				i += 1
+			series.append((sensor, variables[sensor], rows[first:i]))
+	return series
+
+def validateVariables(service, variables, log, skipped=None):
+	# the variables of the sensors that exist on the service, the others are
+	# skipped. Variables are got through the service entity cache : once
+	# known, they are only asked again (with a conditional GET) after its ttl.
+	# skipped is the set of the variables (and sensors) of the site already
+	# warned about : a missing variable is reported once, and again when it
+	# is found back
+	if skipped == None:
+		skipped = set()
+	valid = dict()
+	for (sensor, variable) in sorted(variables.items()):
 		try:
-			parser.readfp(f)
-			hasVar = parser.has_option('main',var)
-			return hasVar
-		except cp.MissingSectionHeaderError:
-			sys.stderr.write("Error: Config file seems to be invalid (Missing Section 'main')\n")
-			exit(1)
-	return False
-
-def getConfigfile(filename,var):
-	with open(filename) as f:
-		parser = cp.SafeConfigParser()
-		parser.readfp(f)
-		return parser.get('main',var)
-	return None
-						
+			service.GetEntity(variable)
+		except IOError, e:
+			if google_meter.GetStatusCode(e) in (400, 403, 404):
+				if variable not in skipped:
+					log.Log(0, 'Error: Variable %s of sensor #%d not found (%s), skipping the sensor', variable, sensor, e)
+					skipped.add(variable)
+				continue
+			# the upload itself will tell whether the service is reachable
+			log.Log(1, 'Warning: Can not check variable %s (%s)', variable, e)
+		if variable in skipped:
+			log.Log(0, 'Variable %s of sensor #%d found, uploading the sensor again', variable, sensor)
+			skipped.discard(variable)
+		valid[sensor] = variable
+	return valid
+
+def toMeasures(series, time_uncertainty, uncertainty):
+	# one DurMeasurement per hourly record, over the 2-hour block it starts
+	# (see cc128sinks.HourlyMeasurements, the rule the meter sink follows too),
+	# kept as google_meter.DurMeasurementColumns : built from the records,
+	# without an object per measure
+	measures = google_meter.DurMeasurementColumns()
+	for (sensor, variable, rows) in series:
+		cc128sinks.HourlyMeasurements(variable, rows, time_uncertainty, uncertainty, measures)
+	return measures
+
+def uploadedSince(since):
+	# since (sensor => ts of its last record uploaded), as the positions of
+	# cc128db.SetUploaded
+	return dict(((sensor, cc128db.TOTAL_CHANNEL, cc128db.HOURLY), ts) for (sensor, ts) in since.items())
+
+def rewindSince(since, uploaded, stored):
+	# sets since back for the series whose position in the database is not
+	# the one the uploader left, uploaded : not stored yet, or set back by a
+	# correction of a record uploaded already (see cc128db.SetUploaded)
+	for ((sensor, channel, resolution), ts) in stored.items():
+		if (channel, resolution) == (cc128db.TOTAL_CHANNEL, cc128db.HOURLY) and ts != uploaded.get((sensor, channel, resolution)):
+			since[sensor] = min(since.get(sensor, ts), ts)
+
+def runDaemon(store, service, options, filenames, log, fanout=None):
+	# uploads the records stored, until killed (or writes them to the sinks
+	# of fanout, a cc128sinks.Fanout, if given). The first pass uploads the
+	# whole history, or what is left of it : how far the uploads went is
+	# kept in the database, and set back there when a record uploaded
+	# already is corrected, the next pass uploading it again.
+	#
+	# The connection stays open: PRAGMA data_version changes whenever another
+	# connection (the acquisition, cc128archive.py) commits to the file, so
+	# checking it costs no read of the tables, and the statements of
+	# readSeries stay prepared in the connection cache. The service keeps its
+	# HTTPS connections alive.
+	reloader = None
+	if options.configFile != None:
+		reloader = meterconfig.Reloader(options.configFile, log=log)
+	generation = 0
+	site = options.settings
+	since = {} # sensor => ts of its last record read (the fanout keeps its own)
+	uploader = '%s:%s' % (programName, site.name)
+	uploaded = {} # the positions stored in the database, see cc128db.GetUploaded
+	skipped = set() # sensors and variables warned about
+	pending = google_meter.DurMeasurementColumns()
+	unflushed = False # a sink failed, what it missed is read again
+	version = None
+	while True:
+		config = reloader and reloader.Get()
+		if reloader != None and reloader.generation != generation:
+			generation = reloader.generation
+			try:
+				new = getSite(config, options, filenames)
+			except meterconfig.Error, e:
+				log.Log(0, 'Error: %s, keeping the previous settings', e)
+				new = site
+			if new.database != site.database:
+				log.Log(0, 'Error: Can not change the database of a running upload, keeping %s', site.database)
+				new = new.Replace(database=site.database)
+			if new.token != site.token:
+				service.token = new.token
+			service.batch_sizer.minimum = new.batch_min
+			service.batch_sizer.maximum = new.batch_max
+			service.batch_sizer.size = max(new.batch_min, min(new.batch_max, service.batch_sizer.size))
+			service.compress_threshold = new.compress
+			site = new
+
+		current = store.con.execute('PRAGMA data_version').fetchone()[0]
+		if current != version or unflushed:
+			version = current
+			store.Refresh()
+			variables = site.Variables()
+			if options.validate:
+				variables = validateVariables(service, variables, log, skipped)
+			if fanout != None:
+				for sink in fanout.sinks:
+					if isinstance(sink, cc128sinks.ServiceSink):
+						sink.variables = variables
+				for columns in cc128sinks.ReadBatches(store, fanout.Since()):
+					fanout.WriteBatch(columns)
+				# each sink goes on from what it flushed
+				try:
+					fanout.Flush()
+					unflushed = False
+				except cc128sinks.Error, e:
+					log.Log(0, 'Error: Writing to the sinks failed (%s), will retry', e)
+					unflushed = True
+			else:
+				stored = cc128db.GetUploaded(store.con, uploader)
+				rewindSince(since, uploaded, stored)
+				uploaded = stored
+				series = readSeries(store, variables, since, skipped)
+				pending.Extend(toMeasures(series, options.time_uncertainty, options.uncertainty))
+				for (sensor, variable, rows) in series:
+					if rows:
+						since[sensor] = rows[-1][0]
+
+		if pending:
+			try:
+				service.BatchPostEvents(pending)
+				del pending[:]
+			except IOError, e:
+				log.Log(0, 'Error: Upload failed (%s), will retry', e)
+			if not pending:
+				# all that was read is uploaded
+				written = uploadedSince(since)
+				try:
+					cc128db.SetUploaded(store.con, uploader, written, uploaded)
+					uploaded.update(written)
+				except sqlite3.Error, e:
+					store.con.rollback()
+					log.Log(0, 'Error: Can not save how far the upload went (%s), saved with the next upload', e)
+		service.metrics.MaybeFlush()
+		time.sleep(options.poll)
+
 if __name__ == '__main__':
 
 	# parse cmd line and options	
 	(filenames, options) = parseArguments()
-	token = options.token
-	variable = options.variable
+	profile = None
+	if options.profile:
+		# the startup phase runs from the import of the script
+		profile = Profile(options.profile, started)
+	site = options.settings
 
-	# open sqlite file 
-	db_file = filenames[0] # need only first arg wich is the db filename 
-	con = sqlite3.connect(db_file)
-	con.row_factory = sqlite3.Row # be able to access by row name ...
-	
-	# fetch all records ...
-	measures = list()
-	rows = con.execute("select date, kwatt from consumption order by date asc")
-	start = None
-	for row in rows:
-		
-		# skip first record
-		if start == None:
-			start = row['date']
-			continue
+	# open sqlite file (and its yearly partitions, when read)
+	store = cc128db.Router(site.database)
+
+	# init google load ...
+	log = google_meter.Log(1)
+	metrics = google_meter.Metrics(getMetricsSink(options.metrics))
+	sizer = google_meter.BatchSizer(minimum=site.batch_min, maximum=site.batch_max)
+	pool = None
+	if options.daemon:
+		pool = google_meter.ConnectionPool()
+	serializer = None
+	if options.processes > 0:
+		# workers receive columns of numbers, not pickled events
+		serializer = google_meter.ProcessSerializer(options.processes)
+	cache = None
+	if options.validate:
+		cache = google_meter.EntityCache(filename=options.entity_cache)
+	service = google_meter.Service(site.token, options.service, log=log, metrics=metrics, compress_threshold=site.compress, batch_sizer=sizer, timeout=options.timeout, pool=pool, serializer=serializer, entity_cache=cache)
+	fanout = None
+	if options.sinks != ['meter']:
+		# one read of the database, written to every sink concurrently
+		fanout = cc128sinks.Fanout([getSink(spec, service, site.Variables(), options) for spec in options.sinks])
+
+	if options.daemon:
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			try:
+				runDaemon(store, service, options, filenames, log, fanout)
+			except KeyboardInterrupt:
+				pass
+		finally:
+			if fanout:
+				try:
+					fanout.Close()
+				except cc128sinks.Error, e:
+					log.Log(0, 'Error: %s', e)
+			metrics.Flush()
+			pool.Close()
+			if serializer:
+				serializer.Close()
+		sys.exit(0)
 	
-		#print str(row["date"]) + ' > ' + str(row["kwatt"])
-		#measures.append({'date': row["date"], 'kwatt': row["kwatt"]})
-		measures.append(DurMeasurement(variable, start, row['date'], row['kwatt'] * units.KILOWATT_HOUR, options.time_uncertainty, options.time_uncertainty, options.uncertainty * units.KILOWATT_HOUR))
-		
-		start = row['date'] # store end date as start date for next record...
+	# fetch all records, one google variable per sensor ...
+	if profile:
+		profile.phase('sqlite scan')
+	variables = site.Variables()
+	if options.validate:
+		variables = validateVariables(service, variables, log)
+	if fanout:
+		for sink in fanout.sinks:
+			if isinstance(sink, cc128sinks.ServiceSink):
+				sink.variables = variables
+		try:
+			try:
+				for columns in cc128sinks.ReadBatches(store):
+					fanout.WriteBatch(columns)
+			finally:
+				fanout.Close()
+		except cc128sinks.Error, e:
+			sys.stderr.write("Error: %s\n" % e)
+			sys.exit(1)
+		finally:
+			if serializer:
+				serializer.Close()
+			metrics.Flush()
+			if profile:
+				profile.stop(metrics)
+		sys.exit(0)
+	series = readSeries(store, variables)
+
+	if profile:
+		profile.phase('DurMeasurement')
+	measures = toMeasures(series, options.time_uncertainty, options.uncertainty)
 		
 	#print len(measures)
 	#print measures
 		
-		
-	# init google load ...
-	log = google_meter.Log(1)
-	service = google_meter.Service(token, options.service, log=log)
 	#service = google_meter.BatchAdapter(service)
-	service.BatchPostEvents(measures) 
+	if profile:
+		profile.phase('upload')
+	try:
+		service.BatchPostEvents(measures) 
+	finally:
+		if serializer:
+			serializer.Close()
+		metrics.Flush()
+		if profile:
+			profile.stop(metrics)
 
 	#service.Flush()
 	#meter = google_meter.Meter(
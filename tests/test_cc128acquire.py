@@ -0,0 +1,126 @@
+#	test_cc128acquire
+#	 Tests of the writer of cc128acquire, storing the spooled frames.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128acquire
+import cc128db
+import cc128spool
+
+FRAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench',
+                      'cc128_frames.txt')
+
+
+class Options(object):
+
+  def __init__(self, directory):
+    self.database = os.path.join(directory, 'cc128.db')
+    self.spool = os.path.join(directory, 'cc128.spool')
+    self.batch_frames = 10
+    self.batch_seconds = 1
+    self.retention = 7
+
+
+class Crash(Exception):
+  pass
+
+
+class WriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.options = Options(self.directory)
+    self.commit = cc128spool.SpoolReader.Commit
+    # the frames are read now, the instantaneous ones are not expired
+    read_time = time.time()
+    spool = cc128spool.Spool(self.options.spool)
+    for line in open(FRAMES):
+      spool.Append(0, read_time, line.rstrip('\n'))
+    self.end = (spool.number, spool.offset)
+    spool.Close()
+
+  def tearDown(self):
+    cc128spool.SpoolReader.Commit = self.commit
+    shutil.rmtree(self.directory)
+
+  def Run(self):
+    """Runs a writer until it stored the whole spool, or died."""
+    writer = cc128acquire.Writer(self.options)
+    writer.start()
+    deadline = time.time() + 30
+    while (writer.isAlive() and getattr(writer, 'committed', None) != self.end
+           and time.time() < deadline):
+      time.sleep(0.05)
+    writer.stopping.set()
+    writer.join()
+    return writer
+
+  def Stored(self):
+    con = cc128db.Connect(self.options.database)
+    try:
+      return (con.execute('SELECT * FROM consumption ORDER BY 1, 2, 3, 4'
+                          ).fetchall(),
+              [cc128db.ReadInstant(con, sensor, channel) for (sensor, channel)
+               in con.execute('SELECT DISTINCT sensor, channel FROM instant '
+                              'ORDER BY 1, 2')],
+              cc128db.GetSpoolPosition(con, self.options.spool))
+    finally:
+      con.close()
+
+  def testStoresEverythingOnce(self):
+    writer = self.Run()
+    self.assertEqual(writer.committed, self.end)
+    stored = self.Stored()
+    self.assertEqual(stored[2], self.end)
+    for readings in stored[1]:
+      self.assertEqual(len(readings), len(set(readings)))
+    # started again, nothing is read twice
+    writer = self.Run()
+    self.assertEqual(writer.frames, 0)
+    self.assertEqual(self.Stored(), stored)
+
+  def testCrashAfterTheCommitReplaysNothing(self):
+    clean = tempfile.mkdtemp()
+    try:
+      options = self.options
+      self.options = Options(clean)
+      shutil.copytree(options.spool, self.options.spool)
+      self.Run()
+      expected = self.Stored()[:2]
+    finally:
+      shutil.rmtree(clean)
+      self.options = options
+
+    # the writer dies after its third commit, before releasing the spool
+    commits = []
+    def Commit(reader, position):
+      commits.append(position)
+      if len(commits) == 3:
+        raise Crash()
+      self.commit(reader, position)
+    cc128spool.SpoolReader.Commit = Commit
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+      writer = self.Run()
+    finally:
+      sys.stderr.close()
+      sys.stderr = stderr
+    self.assertFalse(writer.isAlive())
+    self.assertNotEqual(writer.committed, self.end)
+    cc128spool.SpoolReader.Commit = self.commit
+    self.Run()
+    self.assertEqual(self.Stored()[:2], expected)
+
+
+if __name__ == '__main__':
+  unittest.main()
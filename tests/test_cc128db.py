@@ -0,0 +1,393 @@
+#	test_cc128db
+#	 Tests of the cc128db storage.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128
+import cc128db
+
+FRAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench',
+                      'cc128_frames.txt')
+HOUR = 3600
+STEP = cc128db.HISTORY_STEP
+START = 1286000000 - 1286000000 % STEP
+
+
+def Hourly(sensor, blocks, kwatt=0.5):
+  """History readings of a sensor total, at the given blocks from START."""
+  return [(sensor, cc128db.TOTAL_CHANNEL, cc128db.HOURLY, START + STEP * b,
+           kwatt) for b in blocks]
+
+
+class StoreReadingsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.con = cc128db.Connect(':memory:')
+
+  def tearDown(self):
+    self.con.close()
+
+  def testNewReadingsAreInserted(self):
+    self.assertEqual(cc128db.StoreReadings(self.con, Hourly(0, range(5))),
+                     (5, 0, 0))
+
+  def testOverlappingDumpIsCounted(self):
+    cc128db.StoreReadings(self.con, Hourly(0, range(5)))
+    self.assertEqual(cc128db.StoreReadings(
+        self.con, Hourly(0, [0, 1, 3, 4]) + Hourly(0, [2], 0.7) +
+        Hourly(0, [5, 6])), (2, 1, 4))
+    self.assertEqual(self.con.execute(
+        'SELECT kwatt FROM consumption WHERE ts = ?',
+        (START + 2 * STEP,)).fetchone(), (0.7,))
+
+  def testMissingValues(self):
+    cc128db.StoreReadings(self.con, Hourly(0, [0]) + Hourly(0, [1], None))
+    # a value lost, a value found, a value still missing
+    self.assertEqual(cc128db.StoreReadings(
+        self.con, Hourly(0, [0], None) + Hourly(0, [1], None)), (0, 1, 1))
+    self.assertEqual(cc128db.StoreReadings(self.con, Hourly(0, [0, 1])),
+                     (0, 2, 0))
+
+  def testSeriesAreApart(self):
+    cc128db.StoreReadings(self.con, Hourly(0, range(3)))
+    self.assertEqual(cc128db.StoreReadings(
+        self.con, Hourly(1, range(3), 0.7) + Hourly(0, range(3))), (3, 0, 3))
+
+
+class ArchiveTest(unittest.TestCase):
+
+  def RoundTrip(self, rows, kind):
+    data = cc128db.PackArchive(rows)
+    self.assertEqual(zlib.decompress(data)[0], kind)
+    self.assertEqual(cc128db.UnpackArchive(rows[0][0], len(rows), data),
+                     rows)
+
+  def testRegularFixedPointRoundTrip(self):
+    self.RoundTrip([(START + HOUR * h, round(h % 7 * 0.1, 1))
+                    for h in range(744)], 'F')
+
+  def testIrregularTimestampsRoundTrip(self):
+    self.RoundTrip([(START, 0.5), (START + HOUR, 0.25),
+                    (START + 5 * HOUR, 1.125), (START + 6 * HOUR, 0.0),
+                    (START + 30 * HOUR, -0.5)], 'F')
+
+  def testNullsRoundTrip(self):
+    self.RoundTrip([(START, 0.5), (START + HOUR, None),
+                    (START + 3 * HOUR, 0.25), (START + 4 * HOUR, None)], 'X')
+
+  def testFloatsRoundTrip(self):
+    self.RoundTrip([(START + HOUR * h, h / 3.0) for h in range(24)], 'X')
+
+  def testShortBlocksRoundTrip(self):
+    self.RoundTrip([(START, None)], 'X')
+    self.RoundTrip([(START, 0.5), (START + 7 * HOUR, 1.5)], 'F')
+
+  def testArchivedMonthReadsTheSame(self):
+    con = cc128db.Connect(':memory:')
+    try:
+      month = int(time.mktime((2010, 3, 1, 0, 0, 0, 0, 0, -1)))
+      rows = [(month + HOUR * h, round(h % 7 * 0.1, 1)) for h in range(48)]
+      rows[5] = (rows[5][0], None)
+      cc128db.StoreReadings(con, [(0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY,
+                                   ts, kwatt) for (ts, kwatt) in rows])
+      now = time.mktime((2010, 6, 1, 0, 0, 0, 0, 0, -1))
+      self.assertEqual(cc128db.ArchiveMonths(con, now), 48)
+      self.assertEqual(con.execute(
+          'SELECT count(*) FROM consumption').fetchone()[0], 0)
+      self.assertEqual(cc128db.ReadSeries(con, 0), rows)
+      # a reading of the month stored again is merged into its block
+      cc128db.StoreReadings(con, [(0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY,
+                                   rows[5][0], 1.5)])
+      cc128db.ArchiveMonths(con, now)
+      rows[5] = (rows[5][0], 1.5)
+      self.assertEqual(cc128db.ReadSeries(con, 0), rows)
+      self.assertEqual(con.execute(
+          'SELECT count(*) FROM archive').fetchone()[0], 1)
+    finally:
+      con.close()
+
+
+class RouterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'cc128.db')
+    self.rows = []
+    for (year, month, day) in ((2008, 3, 1), (2008, 12, 31), (2009, 12, 31),
+                               (2010, 3, 1)):
+      start = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+      self.rows.extend((start + HOUR * h, round(h % 7 * 0.1, 1))
+                       for h in range(48))
+    con = cc128db.Connect(self.filename)
+    cc128db.StoreReadings(con, [(0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY,
+                                 ts, kwatt) for (ts, kwatt) in self.rows])
+    now = time.mktime((2010, 6, 1, 0, 0, 0, 0, 0, -1))
+    cc128db.ArchiveMonths(con, now)
+    self.assertEqual(cc128db.FreezeYears(con, self.filename, now),
+                     [2008, 2009])
+    con.close()
+
+  def tearDown(self):
+    for name in os.listdir(self.directory):
+      os.chmod(os.path.join(self.directory, name), 0644)
+    shutil.rmtree(self.directory)
+
+  def Year(self, year):
+    return [row for row in self.rows
+            if time.localtime(row[0]).tm_year == year]
+
+  def testReadsEveryPartition(self):
+    router = cc128db.Router(self.filename)
+    try:
+      self.assertEqual(router.years, [2008, 2009])
+      self.assertEqual(router.ReadSeries(0), self.rows)
+    finally:
+      router.Close()
+
+  def testReadAttachesOnlyItsYears(self):
+    router = cc128db.Router(self.filename)
+    try:
+      rows = self.Year(2009)
+      self.assertEqual(router.ReadSeries(0, min_ts=rows[0][0],
+                                         max_ts=rows[-1][0]), rows)
+      self.assertEqual(router._attached, [2009])
+    finally:
+      router.Close()
+
+  def testDatabaseRowsTakePrecedence(self):
+    ts = self.Year(2008)[5][0]
+    con = cc128db.Connect(self.filename)
+    cc128db.StoreReadings(con, [(0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY,
+                                 ts, 9.5)])
+    con.close()
+    router = cc128db.Router(self.filename)
+    try:
+      self.assertEqual(dict(router.ReadSeries(0))[ts], 9.5)
+      self.assertEqual(len(router.ReadSeries(0)), len(self.rows))
+    finally:
+      router.Close()
+
+  def testLeastRecentlyReadIsDetached(self):
+    router = cc128db.Router(self.filename, max_attached=1)
+    try:
+      for year in (2008, 2009, 2008):
+        rows = self.Year(year)
+        self.assertEqual(router.ReadSeries(0, min_ts=rows[0][0],
+                                           max_ts=rows[-1][0]), rows)
+        self.assertEqual(router._attached, [year])
+    finally:
+      router.Close()
+
+
+class CoverageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.con = cc128db.Connect(':memory:')
+
+  def tearDown(self):
+    self.con.close()
+
+  def Coverage(self, sensor=0):
+    return [(start - START, end - START)
+            for (start, end) in cc128db.GetCoverage(self.con, sensor)]
+
+  def testContiguousReadingsMakeOneRange(self):
+    cc128db.StoreReadings(self.con, Hourly(0, range(5)))
+    self.assertEqual(self.Coverage(), [(0, 4 * STEP)])
+
+  def testGapSplitsRanges(self):
+    cc128db.StoreReadings(self.con, Hourly(0, [0, 1, 3, 4]))
+    self.assertEqual(self.Coverage(), [(0, STEP), (3 * STEP, 4 * STEP)])
+    self.assertEqual(cc128db.GetGaps(self.con, 0),
+                     [(START + STEP, START + 3 * STEP)])
+
+  def testFilledGapJoinsRanges(self):
+    cc128db.StoreReadings(self.con, Hourly(0, [0, 1, 3, 4]))
+    cc128db.StoreReadings(self.con, Hourly(0, [2]))
+    self.assertEqual(self.Coverage(), [(0, 4 * STEP)])
+
+  def testOlderReadingsExtendRange(self):
+    cc128db.StoreReadings(self.con, Hourly(0, [5, 6]))
+    cc128db.StoreReadings(self.con, Hourly(0, [4, 3]))
+    self.assertEqual(self.Coverage(), [(3 * STEP, 6 * STEP)])
+
+  def testSeriesAreCoveredApart(self):
+    cc128db.StoreReadings(self.con, Hourly(0, [0, 1]) + Hourly(1, [1, 2]))
+    self.assertEqual(self.Coverage(0), [(0, STEP)])
+    self.assertEqual(self.Coverage(1), [(STEP, 2 * STEP)])
+
+  def testSameAsRebuild(self):
+    for hours in ([7, 2, 9], [3, 4, 12], [0, 20, 10, 11], [5, 6, 8]):
+      cc128db.StoreReadings(self.con, Hourly(0, hours))
+    stored = self.Coverage()
+    cc128db.RebuildCoverage(self.con)
+    self.assertEqual(self.Coverage(), stored)
+
+  def testArchivedRangeIsExtended(self):
+    # the rows of the range are archived, the new readings still join it
+    cc128db.StoreReadings(self.con, Hourly(0, range(3)))
+    self.con.execute('DELETE FROM consumption')
+    cc128db.StoreReadings(self.con, Hourly(0, [3]))
+    self.assertEqual(self.Coverage(), [(0, 3 * STEP)])
+
+  def testHistoryDumpIsOneRange(self):
+    # the even hNNN tags of a real dump, read at 13:07
+    now = time.mktime((2010, 10, 2, 13, 30, 0, 0, 0, -1))
+    for frame in cc128.DecodeFrames(open(FRAMES)):
+      if frame[0] == cc128.HISTORY:
+        cc128db.StoreReadings(self.con, cc128.HistoryReadings(frame, now))
+    rows = cc128db.ReadSeries(self.con, 0)
+    self.assertEqual(set(rows[i + 1][0] - rows[i][0]
+                         for i in range(len(rows) - 1)), set([STEP]))
+    for sensor in cc128db.GetSensors(self.con):
+      rows = cc128db.ReadSeries(self.con, sensor)
+      self.assertEqual(cc128db.GetCoverage(self.con, sensor),
+                       [(rows[0][0], rows[-1][0])])
+
+  def testRangesCutOnEveryBlockAreJoined(self):
+    # written while the step was an hour
+    cc128db.StoreReadings(self.con, Hourly(0, [0, 1, 2, 5, 6]))
+    self.con.execute('DELETE FROM coverage')
+    self.con.executemany(
+        'INSERT INTO coverage VALUES (0, 0, ?, ?, ?)',
+        [(cc128db.HOURLY, START + STEP * b, START + STEP * b)
+         for b in (0, 1, 2, 5, 6)])
+    cc128db.CreateSchema(self.con)
+    self.assertEqual(self.Coverage(), [(0, 2 * STEP), (5 * STEP, 6 * STEP)])
+
+  def testNoTrigger(self):
+    self.assertEqual(self.con.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"
+        ).fetchone()[0], 0)
+
+
+class UploadedTest(unittest.TestCase):
+
+  KEY = (0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY)
+
+  def setUp(self):
+    self.con = cc128db.Connect(':memory:')
+    cc128db.StoreReadings(self.con, Hourly(0, range(10)))
+    cc128db.SetUploaded(self.con, 'up', {self.KEY: START + 9 * STEP}, {})
+
+  def tearDown(self):
+    self.con.close()
+
+  def testCorrectionSetsTheUploadBack(self):
+    cc128db.StoreReadings(self.con, Hourly(0, range(10), 0.5) +
+                          Hourly(0, [4], 0.7))
+    self.assertEqual(cc128db.GetUploaded(self.con, 'up'),
+                     {self.KEY: START + 4 * STEP - 1})
+
+  def testUnchangedReadingsLeaveTheUpload(self):
+    cc128db.StoreReadings(self.con, Hourly(0, range(12)))
+    self.assertEqual(cc128db.GetUploaded(self.con, 'up'),
+                     {self.KEY: START + 9 * STEP})
+
+  def testLaterCorrectionLeavesTheUpload(self):
+    cc128db.SetUploaded(self.con, 'up', {self.KEY: START + 2 * STEP},
+                        {self.KEY: START + 9 * STEP})
+    cc128db.StoreReadings(self.con, Hourly(0, [5], 0.7))
+    self.assertEqual(cc128db.GetUploaded(self.con, 'up'),
+                     {self.KEY: START + 2 * STEP})
+
+  def testSetBackPositionIsKept(self):
+    previous = cc128db.GetUploaded(self.con, 'up')
+    # corrected while the uploader posted the next readings
+    cc128db.StoreReadings(self.con, Hourly(0, [3], 0.7))
+    cc128db.SetUploaded(self.con, 'up', {self.KEY: START + 12 * STEP},
+                        previous)
+    self.assertEqual(cc128db.GetUploaded(self.con, 'up'),
+                     {self.KEY: START + 3 * STEP - 1})
+
+
+class InstantStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.con = cc128db.Connect(':memory:')
+    self.now = START
+
+  def tearDown(self):
+    self.con.close()
+
+  def Store(self):
+    return cc128db.InstantStore(self.con, batch_frames=10**9,
+                                batch_seconds=10**9, retention=HOUR,
+                                clock=lambda: self.now)
+
+  def Append(self, store, frames, first=0, watts=1000):
+    for i in range(first, first + frames):
+      store.Append(1, START + cc128db.FRAME_INTERVAL * i, [watts])
+    store.Flush()
+
+  def Hourly(self):
+    return [(ts - START, round(kwatt, 6)) for (ts, kwatt) in self.con.execute(
+        'SELECT ts, kwatt FROM consumption WHERE sensor = 1 AND channel = 1 '
+        'ORDER BY ts')]
+
+  def testBlocksAreRolledUp(self):
+    self.Append(self.Store(), 1200)
+    self.now = START + 3 * HOUR
+    self.Store().Flush()
+    self.assertEqual(self.Hourly(), [(0, 1.0), (HOUR, 1.0)])
+    self.assertEqual(self.con.execute(
+        'SELECT count(*) FROM instant').fetchone()[0], 0)
+
+  def testReplayedFramesMergeWithTheirBlock(self):
+    self.Append(self.Store(), 300)
+    # after a restart, the first frames are read again
+    self.Append(self.Store(), 100)
+    self.assertEqual(self.con.execute(
+        'SELECT count FROM instant').fetchall(), [(300,)])
+    self.assertEqual(cc128db.ReadInstant(self.con, 1, 1)[-1],
+                     (START + cc128db.FRAME_INTERVAL * 299, 1000))
+
+  def testReplayedBlockIsNotCountedTwice(self):
+    self.Append(self.Store(), 600)
+    self.now = START + 3 * HOUR
+    self.Store().Flush()
+    self.Append(self.Store(), 100, first=10)
+    self.now = START + 6 * HOUR
+    self.Store().Flush()
+    self.assertEqual(self.Hourly(), [(0, 1.0)])
+
+  def testHourIsComputedAgainNotAddedTo(self):
+    store = self.Store()
+    self.Append(store, 300)
+    self.now = START + 3 * HOUR
+    store.Flush()
+    self.con.execute('UPDATE consumption SET kwatt = 99')
+    self.Append(store, 300, first=300)
+    self.now = START + 6 * HOUR
+    store.Flush()
+    self.assertEqual(self.Hourly(), [(0, 1.0)])
+
+
+class PackReadingsTest(unittest.TestCase):
+
+  def testReadingsRoundTrip(self):
+    # irregular frames, up to the largest delta of a block
+    readings = [(START, 0), (START + 6, 1234), (START + 18, 4294967295),
+                (START + 25, 7), (START + 25 + 65535, 12)]
+    data = cc128db.PackReadings(readings)
+    self.assertEqual(len(data), 6 * len(readings))
+    self.assertEqual(cc128db.UnpackReadings(START, len(readings), data),
+                     readings)
+
+  def testSingleReadingRoundTrip(self):
+    self.assertEqual(cc128db.UnpackReadings(
+        START, 1, cc128db.PackReadings([(START, 850)])), [(START, 850)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,128 @@
+#	test_cc128sinks
+#	 Tests of the batched outputs of the CC128 readings.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128db
+import cc128sinks
+
+STEP = cc128db.HISTORY_STEP
+START = 1286000000 - 1286000000 % STEP
+KEY = (0, cc128db.TOTAL_CHANNEL, cc128db.HOURLY)
+
+
+class ListSink(object):
+  """Keeps the hours flushed; fails its writes while failing is set."""
+
+  def __init__(self):
+    self.written = []
+    self.flushed = []
+    self.failing = False
+
+  def WriteBatch(self, columns):
+    if self.failing:
+      raise IOError('unreachable')
+    self.written.extend((ts - START) / STEP for ts in columns['ts'])
+
+  def Flush(self):
+    self.flushed.extend(self.written)
+    self.written = []
+
+  def Close(self):
+    self.Flush()
+
+
+class FakeService(object):
+
+  def __init__(self):
+    self.posted = []
+    self.failing = False
+
+  def BatchPostEvents(self, events):
+    if self.failing:
+      raise IOError('HTTP/1.1 503 Service Unavailable')
+    self.posted.extend(events)
+
+
+def Batch(hours):
+  return dict(sensor=[KEY[0]] * len(hours), channel=[KEY[1]] * len(hours),
+              resolution=[KEY[2]] * len(hours),
+              ts=[START + STEP * h for h in hours], kwatt=[0.5] * len(hours))
+
+
+class FanoutTest(unittest.TestCase):
+
+  def setUp(self):
+    self.good = ListSink()
+    self.bad = ListSink()
+    self.fanout = cc128sinks.Fanout([self.good, self.bad])
+
+  def tearDown(self):
+    self.fanout.Close()
+
+  def testPositionsAdvanceOnFlush(self):
+    self.fanout.WriteBatch(Batch(range(3)))
+    self.assertEqual(self.fanout.Since(), {})
+    self.fanout.Flush()
+    self.assertEqual(self.fanout.Since(), {KEY: START + 2 * STEP})
+
+  def testFailedSinkIsWrittenAgain(self):
+    self.bad.failing = True
+    self.fanout.WriteBatch(Batch(range(3)))
+    self.assertRaises(cc128sinks.Error, self.fanout.Flush)
+    self.assertEqual(self.fanout.Since(), {})
+    self.bad.failing = False
+    # read again from Since, the sink that flushed skips what it has
+    self.fanout.WriteBatch(Batch(range(5)))
+    self.fanout.Flush()
+    self.assertEqual(self.good.flushed, range(5))
+    self.assertEqual(self.bad.flushed, range(5))
+    self.assertEqual(self.fanout.Since(), {KEY: START + 4 * STEP})
+
+  def testFailedFlushKeepsThePosition(self):
+    self.fanout.WriteBatch(Batch(range(2)))
+    self.fanout.Flush()
+    def Flush():
+      raise IOError('disk full')
+    self.bad.Flush = Flush
+    self.fanout.WriteBatch(Batch(range(2, 4)))
+    self.assertRaises(cc128sinks.Error, self.fanout.Flush)
+    self.assertEqual(self.fanout.positions,
+                     [{KEY: START + 3 * STEP}, {KEY: START + STEP}])
+    self.assertEqual(self.fanout.Since(), {KEY: START + STEP})
+    del self.bad.Flush
+
+
+class ServiceSinkTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeService()
+    self.sink = cc128sinks.ServiceSink(self.service, {0: '/variable/s0'})
+
+  def testReadingIsTheBlockItStarts(self):
+    batch = Batch(range(3))
+    batch['kwatt'][1] = None
+    batch['sensor'][2] = 1  # no variable
+    self.sink.WriteBatch(batch)
+    self.sink.Flush()
+    self.assertEqual([(m.subject_path, m.start_time, m.end_time)
+                      for m in self.service.posted],
+                     [('/variable/s0', START, START + STEP)])
+
+  def testFailedPostIsDropped(self):
+    self.sink.WriteBatch(Batch(range(3)))
+    self.service.failing = True
+    self.assertRaises(IOError, self.sink.Flush)
+    self.service.failing = False
+    self.sink.Flush()
+    self.assertEqual(self.service.posted, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
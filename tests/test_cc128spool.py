@@ -0,0 +1,116 @@
+#	test_cc128spool
+#	 Tests of the spool of the raw lines read from the CC128 ports.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128spool
+
+SEGMENT = 4096
+
+
+class SpoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def Append(self, lines, first=0):
+    spool = cc128spool.Spool(self.directory, segment_size=SEGMENT)
+    for i in range(first, first + lines):
+      self.assertTrue(spool.Append(i % 4, 1286000000 + i, 'line %d' % i))
+    spool.Close()
+
+  def Read(self, position=None):
+    reader = cc128spool.SpoolReader(self.directory, position)
+    try:
+      return reader.Read(10**6)
+    finally:
+      reader.Close()
+
+  def Lines(self, position=None):
+    return [record[3] for record in self.Read(position)]
+
+  def Write(self, number, offset, data):
+    """Writes bytes into a segment, as a crash would have left them."""
+    f = open(os.path.join(self.directory, '%08d.spool' % number), 'r+b')
+    try:
+      f.seek(offset)
+      f.write(data)
+    finally:
+      f.close()
+
+  def testTornRecordIsDropped(self):
+    self.Append(10)
+    number, offset = self.Read()[8][0]
+    # the line of the last record only partly reached the disk
+    self.Write(number, offset + struct.calcsize('<IIid'), 'X')
+    self.assertEqual(self.Lines(), ['line %d' % i for i in range(9)])
+    # the writer goes on after the last valid record
+    self.Append(5, first=10)
+    self.assertEqual(self.Lines(), ['line %d' % i
+                                    for i in range(9) + range(10, 15)])
+
+  def testUnfinishedRecordIsOverwritten(self):
+    self.Append(20)
+    number, offset = self.Read()[18][0]
+    # crashed before writing the length, the record itself is there
+    self.Write(number, offset, struct.pack('<I', 0))
+    self.assertEqual(len(self.Read()), 19)
+    # a shorter record, the rest of the unfinished one is cleared
+    self.Append(1)
+    self.assertEqual(self.Lines()[18:], ['line 18', 'line 0'])
+
+  def testSegmentEndedBeforeTheNextOne(self):
+    self.Append(5)
+    number, offset = self.Read()[-1][0]
+    # crashed after the end mark, before creating the next segment
+    self.Write(number, offset, struct.pack('<I', 0xffffffff))
+    self.assertEqual(len(self.Read()), 5)
+    self.Append(5, first=5)
+    self.assertEqual(sorted(name for name in os.listdir(self.directory)),
+                     ['00000001.spool', '00000002.spool'])
+    self.assertEqual(self.Lines(), ['line %d' % i for i in range(10)])
+
+  def testRecordsGoOnInTheNextSegments(self):
+    self.Append(1000)
+    self.assertTrue(len(os.listdir(self.directory)) > 2)
+    self.assertEqual(self.Lines(), ['line %d' % i for i in range(1000)])
+
+  def testCommittedRecordsAreNotReadAgain(self):
+    self.Append(300)
+    reader = cc128spool.SpoolReader(self.directory)
+    records = reader.Read(100)
+    reader.Commit(records[-1][0])
+    reader.Close()
+    self.assertEqual([record[3] for record in self.Read()],
+                     ['line %d' % i for i in range(100, 300)])
+
+  def testPositionGivenOverridesCheckpoint(self):
+    self.Append(10)
+    records = self.Read()
+    reader = cc128spool.SpoolReader(self.directory)
+    reader.Commit(records[-1][0])
+    reader.Close()
+    self.assertEqual(len(self.Read(records[4][0])), 5)
+
+  def testUnreadableCheckpointReadsFromTheStart(self):
+    self.Append(10)
+    f = open(os.path.join(self.directory, cc128spool.CHECKPOINT), 'w')
+    f.write('1 ')  # torn by a crash
+    f.close()
+    self.assertEqual(len(self.Read()), 10)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+#	test_cc128stats
+#	 Tests of the statistics of the stored consumption series.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128
+import cc128db
+import cc128stats
+
+FRAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench',
+                      'cc128_frames.txt')
+STEP = cc128db.HISTORY_STEP
+
+
+def HistoryDump():
+  """The (ts, kwatt) columns of the sensor #0 total of a real dump."""
+  con = cc128db.Connect(':memory:')
+  # the even hNNN tags, read at 13:07
+  now = time.mktime((2010, 10, 2, 13, 30, 0, 0, 0, -1))
+  for frame in cc128.DecodeFrames(open(FRAMES)):
+    if frame[0] == cc128.HISTORY:
+      cc128db.StoreReadings(con, cc128.HistoryReadings(frame, now))
+  rows = cc128db.ReadSeries(con, 0)
+  con.close()
+  return [ts for (ts, _) in rows], [kwatt for (_, kwatt) in rows]
+
+
+class AnalyzeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.hourly = HistoryDump()
+    self.numpy = cc128stats._Numpy
+
+  def tearDown(self):
+    cc128stats._Numpy = self.numpy
+
+  def Check(self):
+    summary = cc128stats.Analyze(self.hourly, period=cc128stats.DAY)
+    self.assertEqual(summary.readings, len(self.hourly[0]))
+    self.assertNotEqual(summary.baseline, None)
+    self.assertFalse(None in summary.daily_profile)
+    for profile in summary.weekly_profile:
+      self.assertFalse(None in profile)
+    # the days between the first and the last blocks are whole
+    self.assertEqual(set(hours for (_, _, hours, _) in summary.periods[1:-1]),
+                     set([24]))
+    total = sum(kwh for (_, kwh, _, _) in summary.periods)
+    self.assertAlmostEqual(total, sum(self.hourly[1]))
+    return summary
+
+  def testHistoryBlocksCoverTheirTwoHours(self):
+    summary = self.Check()
+    cc128stats._Numpy = lambda: None
+    self.assertEqual(self.Check(), summary)
+
+  def testBlockIsSharedBetweenItsHours(self):
+    start = 1286000000 - 1286000000 % STEP
+    for numpy in (self.numpy, lambda: None):
+      cc128stats._Numpy = numpy
+      # the next reading cuts the second block, the last one has its 2 hours
+      ts, kwatt = cc128stats._SpreadBlocks(
+          [start, start + STEP, start + STEP + 3600], [1.0, None, 0.5])
+      self.assertEqual(list(ts), [start + 3600 * h for h in range(5)])
+      self.assertEqual([k == k and k or None for k in kwatt],
+                       [0.5, 0.5, None, 0.25, 0.25])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,118 @@
+#	test_google_meter
+#	 Tests of google_meter against the local stand-in server.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import google_meter
+import meterserver
+import units
+
+VARIABLE = '/user/12345678901234567890/example.com/variable/s0.d1'
+
+
+def Measures(count, start=1286000000):
+  return [google_meter.DurMeasurement(
+      VARIABLE, start + 3600 * i, start + 3600 * (i + 1),
+      0.5 * units.KILOWATT_HOUR, 1, 1, 0.001 * units.KILOWATT_HOUR)
+          for i in range(count)]
+
+
+class ServiceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = meterserver.MeterServer()
+    self.server.start()
+    self.pool = google_meter.ConnectionPool()
+    self.service = google_meter.Service('token', self.server.uri(),
+                                        log=google_meter.Log(0),
+                                        pool=self.pool)
+
+  def tearDown(self):
+    self.pool.Close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testPostsShareOneConnection(self):
+    for i in range(5):
+      self.service.BatchPostEvents(Measures(3, 1286000000 + 36000 * i))
+    self.assertEqual(self.server.stats['batches'], 5)
+    self.assertEqual(self.server.stats['events'], 15)
+    self.assertEqual(self.server.stats['connections'], 1)
+
+  def testPostsAndGetsShareOneConnection(self):
+    for i in range(3):
+      self.service.BatchPostEvents(Measures(2, 1286000000 + 36000 * i))
+      self.service.GetEntity(VARIABLE)
+    self.assertEqual(self.server.stats['requests'], 6)
+    self.assertEqual(self.server.stats['connections'], 1)
+
+  def testCompressedPostsShareOneConnection(self):
+    self.service.compress_threshold = 100
+    for i in range(3):
+      self.service.BatchPostEvents(Measures(10, 1286000000 + 36000 * i))
+    self.assertEqual(self.server.stats['events'], 30)
+    self.assertEqual(self.server.stats['connections'], 1)
+
+  def testTimeoutShrinksBatches(self):
+    self.server.latency = 0.3
+    # the replies come after the client gave up on them
+    self.server.handle_error = lambda request, client_address: None
+    self.service.timeout = 0.1
+    self.service.max_retries = 2
+    self.service.retry_delay = 0
+    size = self.service.batch_sizer.size
+    self.assertRaises(IOError, self.service.BatchPostEvents, Measures(50))
+    self.assertTrue(self.service.batch_sizer.size < size)
+    self.assertEqual(self.service.metrics.counters['retries'], 2)
+
+  def testPostWithoutPool(self):
+    self.service.pool = None
+    self.service.BatchPostEvents(Measures(4))
+    self.service.BatchPostEvents(Measures(4, 1286100000))
+    self.assertEqual(self.server.stats['events'], 8)
+    self.assertEqual(self.server.stats['connections'], 2)
+
+  def testPostColumns(self):
+    self.service.BatchPostEvents(
+        google_meter.DurMeasurementColumns(Measures(4)))
+    self.assertEqual(self.server.stats['events'], 4)
+
+
+class DurMeasurementColumnsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.events = Measures(5)
+    self.columns = google_meter.DurMeasurementColumns(self.events)
+
+  def testSameEntriesAsTheEvents(self):
+    self.assertEqual(list(self.columns.Entries()),
+                     [event.ToXml() for event in self.events])
+    self.assertEqual(google_meter._SerializeDurMeasurementColumns(
+        self.columns.Pack()), [event.ToXml() for event in self.events])
+
+  def testSequenceOfEvents(self):
+    self.assertEqual(len(self.columns), 5)
+    self.assertEqual(self.columns[3], self.events[3])
+    self.assertEqual(list(self.columns[1:3]), self.events[1:3])
+    del self.columns[:2]
+    self.assertEqual(list(self.columns), self.events[2:])
+
+  def testExtendMapsTheSubjects(self):
+    other = google_meter.DurMeasurementColumns()
+    other.AppendSeries(VARIABLE + '2', [0, 3600], [3600, 7200], [1.0, 2.0],
+                       1, 1, 0.001)
+    other.Extend(self.columns)
+    self.assertEqual(other.subjects, [VARIABLE + '2', VARIABLE])
+    self.assertEqual(list(other)[2:], self.events)
+    self.assertEqual(other[1].subject_path, VARIABLE + '2')
+
+
+if __name__ == '__main__':
+  unittest.main()
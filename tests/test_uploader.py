@@ -0,0 +1,155 @@
+#	test_uploader
+#	 Tests of the helpers sqlite2googlepowermeter and uploadscheduler share.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cc128db
+import sqlite2googlepowermeter
+
+VARIABLE = '/user/12345678901234567890/example.com/variable/s%d.d1'
+HOUR = 3600
+STEP = cc128db.HISTORY_STEP
+START = 1286000000 - 1286000000 % STEP
+
+
+class FakeService(object):
+  """Answers GetEntity with a 404 for the variables in missing."""
+
+  def __init__(self):
+    self.missing = set()
+
+  def GetEntity(self, path):
+    if path in self.missing:
+      raise IOError('HTTP/1.1 404 Not Found')
+
+
+class FakeLog(object):
+
+  def __init__(self):
+    self.messages = []
+
+  def Log(self, level, message, *args):
+    self.messages.append(message % args)
+
+
+class ValidateVariablesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.service = FakeService()
+    self.log = FakeLog()
+    self.variables = {1: VARIABLE % 1, 2: VARIABLE % 2}
+
+  def testMissingVariableIsSkippedAndReportedOnce(self):
+    self.service.missing.add(VARIABLE % 2)
+    skipped = set()
+    for i in range(3):
+      valid = sqlite2googlepowermeter.validateVariables(
+          self.service, self.variables, self.log, skipped)
+      self.assertEqual(valid, {1: VARIABLE % 1})
+    self.assertEqual(len(self.log.messages), 1)
+    self.assertEqual(skipped, set([VARIABLE % 2]))
+
+  def testVariableFoundAgainIsUploaded(self):
+    self.service.missing.add(VARIABLE % 2)
+    skipped = set()
+    sqlite2googlepowermeter.validateVariables(
+        self.service, self.variables, self.log, skipped)
+    self.service.missing.clear()
+    valid = sqlite2googlepowermeter.validateVariables(
+        self.service, self.variables, self.log, skipped)
+    self.assertEqual(valid, self.variables)
+    self.assertEqual(skipped, set())
+    self.assertEqual(len(self.log.messages), 2)
+
+  def testSitesSkipOnTheirOwn(self):
+    # the same sensor number is a different variable on another site
+    self.service.missing.add(VARIABLE % 2)
+    first = set()
+    second = set()
+    sqlite2googlepowermeter.validateVariables(
+        self.service, self.variables, self.log, first)
+    other = {2: VARIABLE.replace('example.com', 'example.org') % 2}
+    valid = sqlite2googlepowermeter.validateVariables(
+        self.service, other, self.log, second)
+    self.assertEqual(valid, other)
+    self.assertEqual(second, set())
+
+
+class MeasuresTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'cc128.db')
+    self.Store([0, 1, 2, 5, 6])
+    self.store = cc128db.Router(self.filename)
+    self.stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+
+  def tearDown(self):
+    sys.stderr.close()
+    sys.stderr = self.stderr
+    self.store.Close()
+    shutil.rmtree(self.directory)
+
+  def Store(self, blocks, kwatt=0.5, offset=0):
+    con = cc128db.Connect(self.filename)
+    cc128db.StoreReadings(con, [(0, 0, cc128db.HOURLY,
+                                 START + STEP * b + offset, kwatt)
+                                for b in blocks])
+    con.close()
+
+  def Measures(self, since={}):
+    series = sqlite2googlepowermeter.readSeries(
+        self.store, {0: VARIABLE % 0}, since)
+    return [(m.start_time - START, m.end_time - START) for m in
+            sqlite2googlepowermeter.toMeasures(series, 1, 0.001)]
+
+  def testEveryReadingIsTheBlockItStarts(self):
+    # the first reading, and the first after the gap, are uploaded too
+    self.assertEqual(self.Measures(), [(b * STEP, (b + 1) * STEP)
+                                       for b in (0, 1, 2, 5, 6)])
+
+  def testBlockEndsAtAnEarlierReading(self):
+    # a dump dated an hour later, its blocks start on the odd hours
+    self.Store([6], offset=HOUR)
+    self.store.Refresh()
+    self.assertEqual(self.Measures({0: START + 5 * STEP}),
+                     [(6 * STEP, 6 * STEP + HOUR),
+                      (6 * STEP + HOUR, 7 * STEP + HOUR)])
+
+  def testSinceIsTheLastUploaded(self):
+    self.assertEqual(self.Measures({0: START + 5 * STEP}),
+                     [(6 * STEP, 7 * STEP)])
+
+  def testCorrectedRecordIsUploadedAgain(self):
+    uploaded = {}
+    since = {}
+    sqlite2googlepowermeter.rewindSince(
+        since, uploaded, cc128db.GetUploaded(self.store.con, 'up'))
+    self.assertEqual(len(self.Measures(since)), 5)
+    since = {0: START + 6 * STEP}
+    written = sqlite2googlepowermeter.uploadedSince(since)
+    cc128db.SetUploaded(self.store.con, 'up', written, uploaded)
+    uploaded.update(written)
+    self.Store([1], 0.7)
+    stored = cc128db.GetUploaded(self.store.con, 'up')
+    sqlite2googlepowermeter.rewindSince(since, uploaded, stored)
+    self.assertEqual(self.Measures(since), [(b * STEP, (b + 1) * STEP)
+                                            for b in (1, 2, 5, 6)])
+
+  def testMissingValuesAreNotUploaded(self):
+    self.Store([7], None)
+    self.store.Refresh()
+    self.assertEqual(len(self.Measures()), 5)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,118 @@
+#	test_uploadscheduler
+#	 Tests of the sites of uploadscheduler, against the local stand-in server.
+#
+#	Run the tests from the top directory with:
+#	  python -m unittest discover -s tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import cc128db
+import google_meter
+import meterconfig
+import meterserver
+import uploadscheduler
+
+VARIABLE = '/user/12345678901234567890/example.com/variable/s0.d1'
+HOUR = 3600
+START = 1286000000 - 1286000000 % HOUR
+
+
+class Options(object):
+  max_pending = 10
+  validate = False
+  time_uncertainty = 1
+  uncertainty = 0.001
+
+
+class ScheduleOptions(Options):
+  service = None  # the stand-in server
+  timeout = 10
+  interval = None
+  burst = None
+  compress = None
+
+
+class UploadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.database = os.path.join(self.directory, 'site.db')
+    self.Store(range(25))
+    self.site = meterconfig.NewSite('site', token='token',
+                                    database=self.database,
+                                    variables=((0, VARIABLE),))
+    self.server = meterserver.MeterServer()
+    self.server.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def Store(self, hours, kwatt=0.5):
+    con = cc128db.Connect(self.database)
+    cc128db.StoreReadings(con, [(0, 0, cc128db.HOURLY, START + HOUR * h, kwatt)
+                                for h in hours])
+    con.close()
+
+  def Upload(self):
+    service = google_meter.Service('token', self.server.uri(),
+                                   log=google_meter.Log(0))
+    return uploadscheduler.Upload(self.site, service)
+
+  def Starts(self, upload):
+    return [(m.start_time - START) / HOUR for m in upload.pending]
+
+  def testPendingIsCapped(self):
+    upload = self.Upload()
+    upload.scan(Options)
+    self.assertEqual(self.Starts(upload), range(10))
+    upload.scan(Options)  # full, not read again
+    self.assertEqual(self.Starts(upload), range(10))
+    upload.postBatch()
+    upload.scan(Options)
+    self.assertEqual(self.Starts(upload), range(10, 20))
+
+  def testRestartGoesOnFromTheDatabase(self):
+    upload = self.Upload()
+    upload.scan(Options)
+    upload.postBatch()
+    upload = self.Upload()
+    upload.scan(Options)
+    self.assertEqual(self.Starts(upload), range(10, 20))
+
+  def testCorrectedRecordIsUploadedAgain(self):
+    upload = self.Upload()
+    upload.scan(Options)
+    upload.postBatch()
+    self.Store([4], 0.7)
+    upload.scan(Options)
+    self.assertEqual(self.Starts(upload), range(4, 14))
+
+  def testFailedBatchWaitsForTheNextTurn(self):
+    self.server.max_batch = 4
+    config = meterconfig.Config(self.directory, (
+        self.site.Replace(batch_min=2, batch_max=8),))
+    options = ScheduleOptions()
+    options.service = self.server.uri()
+    upload = uploadscheduler.updateUploads(
+        [], config, options, None, google_meter.Log(0),
+        google_meter.Metrics())[0]
+    upload.scan(Options)
+    # one POST of 8 refused, not retried smaller within the call
+    self.assertRaises(IOError, upload.postBatch)
+    self.assertEqual(self.server.stats['requests'], 1)
+    self.assertEqual(self.Starts(upload), range(10))
+    upload.postBatch()
+    self.assertEqual(self.server.stats['requests'], 2)
+    self.assertEqual(self.Starts(upload), range(4, 10))
+
+
+if __name__ == '__main__':
+  unittest.main()
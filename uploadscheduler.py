@@ -0,0 +1,318 @@
+#!/usr/bin/python2.6
+# uploadscheduler
+#	Uploads the sqlite data of many sites to Google PowerMeter from one
+#	long-running process.
+#
+#	Copyright (C) 2010	Sebastien Person
+#
+#	 This program is free software: you can redistribute it and/or modify
+#	 it under the terms of the GNU General Public License as published by
+#	 the Free Software Foundation, either version 3 of the License, or
+#	 (at your option) any later version.
+#
+#	 This program is distributed in the hope that it will be useful,
+#	 but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+#	 GNU General Public License for more details.
+#
+#	 You should have received a copy of the GNU General Public License
+#	 along with this program.	If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Each file of the sites directory is a config file of one or many sites
+# (see meterconfig.py), e.g. the config of sqlite2googlepowermeter.py plus
+# the path of the site database :
+#
+#	[main]
+#	token:auth_token
+#	variable:/user/123456789/1234567890/variable/myvar.d1
+#	database:/var/lib/cc128/site1.db
+#
+# Every --scan seconds the new records of each site are read, up to
+# --max-pending measures waiting to be posted per site (a long history is
+# read a piece at a time). Batches are then posted one at a time, going
+# round the sites with pending data, each token being allowed one batch
+# every interval seconds (Google blocks tokens uploading too fast). A batch
+# that fails is not retried at once: it is posted again, smaller if it timed
+# out or was refused, at the next turn its token allows. All the requests go
+# through one pool of keep-alive connections. How far each site
+# got is kept in its database, a restart goes on from there (and records
+# corrected once uploaded are uploaded again).
+#
+# On SIGHUP the directory is read again: new sites are added, removed ones
+# dropped, and the others keep their progress with their new settings.
+
+import os
+import sqlite3
+import sys
+import time
+from optparse import OptionParser
+
+import cc128db
+import google_meter
+import meterconfig
+from sqlite2googlepowermeter import getMetricsSink, readSeries, rewindSince, toMeasures, uploadedSince, validateVariables
+
+programVersion = '0.1'
+programName = 'uploadscheduler'
+
+def parseArguments():
+	op = OptionParser('%prog [options] sites_directory', version="%s %s" % (programName, programVersion))
+	op.add_option('', '--service', metavar='<URI>',
+								help='URI prefix of the GData service to contact '
+										 '(default: https://www.google.com/powermeter/feeds)')
+	op.add_option('', '--interval', type='float', metavar='<seconds>',
+								help='Minimum delay between two batches of the same token (default: interval entry of the site, or 600)')
+	op.add_option('', '--burst', type='int', metavar='<batches>',
+								help='Batches a token may post at once after being idle (default: burst entry of the site, or 1)')
+	op.add_option('', '--scan', type='float', metavar='<seconds>',
+								help='Delay between two reads of the site databases (default: 600)')
+	op.add_option('', '--compress', type='int', metavar='<bytes>',
+								help='Gzip-compress posted batches of at least this size (default: compress entry of the site, or None)')
+	op.add_option('', '--max-pending', type='int', metavar='<measures>',
+								help='Measures read ahead of the posts per site, scans of a site skip it while it has that many (default: 10000)')
+	op.add_option('', '--timeout', type='float', metavar='<seconds>',
+								help='Give up a request whose connection or reply takes longer, the batch is then posted again smaller at a later turn (default: 60)')
+	op.add_option('', '--metrics', metavar='<sink>',
+								help='Where to write upload metrics: prometheus:<file>, statsd[:host[:port]] (default: None)')
+	op.add_option('', '--validate', action='store_true',
+								help='Check that the variables of a site exist before each scan, skipping the sensors of missing ones (default: no check)')
+	op.add_option('', '--entity-cache', metavar='<file.db>',
+								help='Keep the variables checked by --validate in this sqlite file (default: None, kept in memory)')
+	op.set_defaults(service='https://www.google.com/powermeter/feeds', scan=600, max_pending=10000, timeout=60,
+									uncertainty=0.001, time_uncertainty=1, validate=False)
+	options, args = op.parse_args()
+	if len(args) < 1:
+		sys.stderr.write('Error: No sites directory specified.\n')
+		op.exit(2, op.format_help())
+	return (args[0], options)
+
+
+class TokenBucket(object):
+	"""Allows one batch every interval seconds, up to burst at once."""
+
+	def __init__(self, interval, burst, clock=time.time):
+		self.interval = interval
+		self.burst = burst
+		self.clock = clock
+		self.tokens = burst
+		self.last = clock()
+
+	def refill(self):
+		now = self.clock()
+		if self.interval > 0:
+			self.tokens = min(self.burst, self.tokens + (now - self.last) / self.interval)
+		else:
+			self.tokens = self.burst
+		self.last = now
+
+	def take(self):
+		"""Takes a token if there is one, returns true if it did."""
+		self.refill()
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return True
+		return False
+
+	def delay(self):
+		"""Seconds until the next token."""
+		self.refill()
+		return max(0, (1 - self.tokens) * self.interval)
+
+
+class Upload(object):
+	"""A site: its settings, its upload progress and its pending measures."""
+
+	def __init__(self, site, service):
+		self.site = site
+		self.service = service
+		self.since = {} # sensor => ts of its last record read
+		self.pending = google_meter.DurMeasurementColumns()
+		self.skipped = set() # sensors and variables of the site warned about
+		self.uploader = '%s:%s' % (programName, site.name)
+		self.uploaded = {} # the positions stored in the database, see cc128db.GetUploaded
+
+	def scan(self, options):
+		"""Reads the records added since the last scan, up to
+		options.max_pending pending measures."""
+		if len(self.pending) >= options.max_pending:
+			return
+		variables = self.site.Variables()
+		if options.validate:
+			variables = validateVariables(self.service, variables, self.service.log, self.skipped)
+		store = cc128db.Router(self.site.database)
+		try:
+			stored = cc128db.GetUploaded(store.con, self.uploader)
+			rewindSince(self.since, self.uploaded, stored)
+			self.uploaded = stored
+			series = readSeries(store, variables, self.since, self.skipped)
+		finally:
+			store.Close()
+		room = options.max_pending - len(self.pending)
+		for (sensor, variable, rows) in series:
+			if room <= 0:
+				break # the rest is read by the next scans
+			rows = rows[:room]
+			self.pending.Extend(toMeasures([(sensor, variable, rows)], options.time_uncertainty, options.uncertainty))
+			room -= len(rows)
+			if rows:
+				self.since[sensor] = rows[-1][0]
+
+	def postBatch(self):
+		"""Posts one batch of pending measures, and once none is left saves
+		how far the site got. The batch is kept pending if the post fails."""
+		batch = self.pending[:self.service.batch_sizer.size]
+		self.service.BatchPostEvents(batch)
+		del self.pending[:len(batch)]
+		if not self.pending:
+			self.save()
+
+	def save(self):
+		"""Stores in the site database that all it read is uploaded."""
+		written = uploadedSince(self.since)
+		try:
+			con = cc128db.Connect(self.site.database)
+			try:
+				cc128db.SetUploaded(con, self.uploader, written, self.uploaded)
+			finally:
+				con.close()
+			self.uploaded.update(written)
+		except sqlite3.Error, e:
+			self.service.log.Log(0, "Error: Can not save how far site %s went (%s), saved after its next upload", self.site.name, e)
+
+
+def loadSites(directory):
+	"""The sites of every config file of the directory, as a meterconfig.Config."""
+	sites = []
+	for filename in sorted(os.listdir(directory)):
+		path = os.path.join(directory, filename)
+		if filename.startswith('.') or not os.path.isfile(path):
+			continue
+		try:
+			config = meterconfig.Load(path)
+		except meterconfig.Error, e:
+			sys.stderr.write("Warning: Ignoring site config (%s)\n" % e)
+			continue
+		for site in config.sites:
+			# sites are named after their file, and their section if any
+			if site.name == meterconfig.MAIN_SITE:
+				site = site.Replace(name=filename)
+			else:
+				site = site.Replace(name='%s/%s' % (filename, site.name))
+			if site.token == None or site.database == None or not site.variables:
+				sys.stderr.write("Warning: Ignoring site %s (needs token, database and variable)\n" % site.name)
+				continue
+			sites.append(site)
+	return meterconfig.Config(directory, tuple(sites))
+
+def updateUploads(uploads, config, options, pool, log, metrics, cache=None):
+	"""The uploads of the config sites, keeping the progress of known ones."""
+	by_name = dict((upload.site.name, upload) for upload in uploads)
+	updated = []
+	for site in config.sites:
+		site = site.Replace(interval=options.interval, burst=options.burst, compress=options.compress)
+		upload = by_name.get(site.name)
+		if upload != None and upload.site == site:
+			updated.append(upload)
+			continue
+		sizer = google_meter.BatchSizer(minimum=site.batch_min, maximum=site.batch_max)
+		# one POST per token taken: a failed batch waits for a later turn
+		# rather than being retried in the call, holding up the other sites
+		service = google_meter.Service(site.token, options.service, log=log, metrics=metrics,
+			compress_threshold=site.compress, batch_sizer=sizer, timeout=options.timeout, max_retries=0,
+			pool=pool, entity_cache=cache)
+		new = Upload(site, service)
+		if upload != None and upload.site.database == site.database and upload.site.variables == site.variables:
+			new.since = upload.since
+			new.pending = upload.pending
+			new.uploaded = upload.uploaded
+		if upload != None:
+			new.skipped = upload.skipped
+		updated.append(new)
+	return updated
+
+def getBuckets(uploads, buckets):
+	"""One bucket per token, whichever sites share it, at the pace of the slowest one."""
+	paces = {}
+	for upload in uploads:
+		pace = paces.get(upload.site.token, (0, None))
+		paces[upload.site.token] = (max(pace[0], upload.site.interval),
+			pace[1] == None and upload.site.burst or min(pace[1], upload.site.burst))
+	updated = {}
+	for (token, (interval, burst)) in paces.items():
+		bucket = buckets.get(token)
+		if bucket == None:
+			bucket = TokenBucket(interval, burst)
+		bucket.interval = interval
+		bucket.burst = burst
+		updated[token] = bucket
+	return updated
+
+def schedule(reloader, options, pool, log, metrics, cache=None):
+	"""Scans and uploads until interrupted."""
+	uploads = updateUploads([], reloader.Get(), options, pool, log, metrics, cache)
+	buckets = getBuckets(uploads, {})
+	generation = reloader.generation
+	log.Log(1, '%d sites, %d tokens', len(uploads), len(buckets))
+
+	next_scan = 0
+	while True:
+		config = reloader.Get()
+		if reloader.generation != generation:
+			generation = reloader.generation
+			uploads = updateUploads(uploads, config, options, pool, log, metrics, cache)
+			buckets = getBuckets(uploads, buckets)
+			log.Log(1, '%d sites, %d tokens', len(uploads), len(buckets))
+			next_scan = 0
+
+		if time.time() >= next_scan:
+			for upload in uploads:
+				try:
+					upload.scan(options)
+				except Exception, e:
+					log.Log(0, "Error: Can not read '%s' of site %s (%s)", upload.site.database, upload.site.name, e)
+			next_scan = time.time() + options.scan
+
+		# one batch per site with pending data and budget, in turn
+		posted = False
+		for upload in uploads:
+			if upload.pending and buckets[upload.site.token].take():
+				try:
+					upload.postBatch()
+				except IOError, e:
+					log.Log(0, "Error: Upload of site %s failed (%s), will retry", upload.site.name, e)
+				posted = True
+		# start the next round with the next site
+		if uploads:
+			uploads.append(uploads.pop(0))
+
+		if not posted:
+			waits = [buckets[upload.site.token].delay() for upload in uploads if upload.pending]
+			waits.append(max(0, next_scan - time.time()))
+			time.sleep(max(0.1, min(waits)))
+
+if __name__ == '__main__':
+	(directory, options) = parseArguments()
+
+	log = google_meter.Log(1)
+	metrics = google_meter.Metrics(getMetricsSink(options.metrics))
+	pool = google_meter.ConnectionPool()
+	cache = None
+	if options.validate:
+		# one cache for every site, variable paths include their user
+		cache = google_meter.EntityCache(filename=options.entity_cache)
+	reloader = meterconfig.Reloader(directory, loadSites, log)
+	if not reloader.Get().sites:
+		sys.stderr.write("Error: No site config found in '%s'\n" % directory)
+		sys.exit(2)
+
+	try:
+		try:
+			schedule(reloader, options, pool, log, metrics, cache)
+		except KeyboardInterrupt:
+			pass
+	finally:
+		metrics.Flush()
+		pool.Close()
+		if cache:
+			cache.Close()